@@ -1,62 +1,194 @@
-import hashlib
 import logging
-import pickle
+import math
+import random
+import time
 
 from longitude.core.common.query_response import LongitudeQueryResponse
 
+from .keys import check_key_hash, query_key
+from .serializers import build_serializer
+
 
 class LongitudeCache():
 
     def __init__(self, options={}):
+        """
+        :param expiration_time_s: Default amount of seconds for payloads to be stored, used when .put(...) does not
+            receive one. None means no expiration.
+        :param stale_ttl_s: Seconds an expired payload is still kept and served (stale) while it is refreshed in the
+            background. None (default) disables stale-while-revalidate.
+        :param early_refresh_beta: If set (usually 1.0), payloads are refreshed before they expire with a probability
+            that grows as the expiration approaches and with the time the query took (XFetch algorithm). Higher values
+            refresh earlier.
+        :param key_hash: Hash used to generate keys: 'sha256' (default), 'blake2b' (faster) or 'xxhash' (fastest,
+            non-cryptographic, needs the xxhash package)
+        :param serializer: How payloads are converted to bytes: 'pickle' (default), 'msgpack', 'arrow' or a
+            PayloadSerializer instance. See also the 'compression' options in serializers.build_serializer.
+        :param namespace: Prefix of every key written by this cache (default: 'longitude'), so it can be flushed
+            without touching other data in a shared backend. Use a different one per data source/tenant if needed.
+        """
         self.logger = logging.getLogger(self.__class__.__module__)
+        self.expiration_time = options.get('expiration_time_s')
+        self.stale_ttl_s = options.get('stale_ttl_s')
+        self.early_refresh_beta = options.get('early_refresh_beta')
+        self.key_hash = options.get('key_hash', 'sha256')
+        check_key_hash(self.key_hash)
+        self.serializer = build_serializer(options)
+        self.namespace = options.get('namespace', 'longitude')
+
+    @property
+    def refreshes_early(self):
+        return bool(self.stale_ttl_s or self.early_refresh_beta)
 
     @staticmethod
-    def generate_key(query_template, params):
+    def generate_key(query_template, params, hash_name='sha256'):
         """
-        This is the default key generation algorithm, based in a digest from the sha256 hash of the query and parameters
+        This is the default key generation algorithm, based in a digest from the hash of the query and a canonical
+        representation of the parameters, so logically identical parameters (i.e. dictionaries with a different
+        ordering) generate the same key. Digests of the query templates are memoized.
 
         Override this method to provide your own key generation in case you need a specific way to store your cache.
 
         :param query_template: Query template (including placeholders) as it should be asked to the database
         :param params: Dictionary of values to be replaced in the placeholders in a safe manner
+        :param hash_name: Hash algorithm (see the key_hash option)
         :return: A (most likely) unique hash, generated from the query text
         """
-        query_payload = str(query_template) + str(params)
-        return hashlib.sha256(query_payload.encode('utf-8')).hexdigest()
+        return query_key(query_template, params, hash_name)
+
+    def cache_key(self, query_template, params):
+        """
+        :return: The key used by this cache for the query, including the namespace
+        """
+        if type(self).generate_key is LongitudeCache.generate_key:
+            key = query_key(query_template, params, self.key_hash)
+        else:
+            # Overridden key generation keeps its documented (query_template, params) signature
+            key = self.generate_key(query_template, params)
+        return self.namespaced(key)
+
+    def namespaced(self, name):
+        if self.namespace:
+            return '%s:%s' % (self.namespace, name)
+        return name
 
     def get(self, query_template, query_params=None):
         if query_params is None:
             query_params = {}
-        payload = self.execute_get(self.generate_key(query_template, query_params))
+        payload = self.execute_get(self.cache_key(query_template, query_params))
         return self.deserialize_payload(payload)
 
     async def get_async(self, query_template, query_params=None):
         if query_params is None:
             query_params = {}
-        payload = await self.execute_get_async(self.generate_key(query_template, query_params))
+        payload = await self.execute_get_async(self.cache_key(query_template, query_params))
         return self.deserialize_payload(payload)
 
-    def put(self, query_template, payload, query_params=None, expiration_time_s=None):
+    def put(self, query_template, payload, query_params=None, expiration_time_s=None, tags=None):
+        """
+        :param tags: Optional list of tags (i.e. names of the tables read by the query) to invalidate the payload
+            later with .invalidate_tags(...)
+        """
         if query_params is None:
             query_params = {}
         if not isinstance(payload, LongitudeQueryResponse):
             raise TypeError('Payloads must be instances of LongitudeQueryResponse!')
-        return self.execute_put(
-            self.generate_key(query_template, query_params),
-            self.serialize_payload(payload),
-            expiration_time_s=expiration_time_s
-        )
+        expiration_time_s = self._prepare_expiration(payload, expiration_time_s)
+        key = self.cache_key(query_template, query_params)
+        is_overwrite = self.execute_put(key, self.serialize_payload(payload), expiration_time_s=expiration_time_s)
+        if tags:
+            self.execute_tag(key, tags)
+        return is_overwrite
 
-    async def put_async(self, query_template, payload, query_params=None, expiration_time_s=None):
+    async def put_async(self, query_template, payload, query_params=None, expiration_time_s=None, tags=None):
         if query_params is None:
             query_params = {}
         if not isinstance(payload, LongitudeQueryResponse):
             raise TypeError('Payloads must be instances of LongitudeQueryResponse!')
-        return await self.execute_put_async(
-            self.generate_key(query_template, query_params),
-            self.serialize_payload(payload),
-            expiration_time_s=expiration_time_s
+        expiration_time_s = self._prepare_expiration(payload, expiration_time_s)
+        key = self.cache_key(query_template, query_params)
+        is_overwrite = await self.execute_put_async(
+            key, self.serialize_payload(payload), expiration_time_s=expiration_time_s
         )
+        if tags:
+            await self.execute_tag_async(key, tags)
+        return is_overwrite
+
+    def invalidate_tags(self, tags):
+        """
+        Removes every payload put with any of the tags.
+
+        :param tags: List of tags
+        :return: Number of removed payloads
+        """
+        return self.execute_invalidate_tags(tags)
+
+    async def invalidate_tags_async(self, tags):
+        return await self.execute_invalidate_tags_async(tags)
+
+    def get_many(self, queries):
+        """
+        Batch version of .get(...). Backends that support it resolve every key in a single round trip.
+
+        :param queries: List of (query_template, query_params) tuples
+        :return: List of responses (None for misses), in the same order as queries
+        """
+        keys = [self.cache_key(query_template, query_params or {}) for query_template, query_params in queries]
+        return [self.deserialize_payload(payload) for payload in self.execute_get_many(keys)]
+
+    async def get_many_async(self, queries):
+        keys = [self.cache_key(query_template, query_params or {}) for query_template, query_params in queries]
+        return [self.deserialize_payload(payload) for payload in await self.execute_get_many_async(keys)]
+
+    def put_many(self, items, expiration_time_s=None):
+        """
+        Batch version of .put(...). Backends that support it store every payload in a single round trip.
+
+        :param items: List of (query_template, query_params, payload) tuples
+        :return: List telling, for each item, if its key was overwritten
+        """
+        return self.execute_put_many(*self._prepare_many(items, expiration_time_s))
+
+    async def put_many_async(self, items, expiration_time_s=None):
+        return await self.execute_put_many_async(*self._prepare_many(items, expiration_time_s))
+
+    def _prepare_many(self, items, expiration_time_s):
+        prepared = []
+        storage_expiration = expiration_time_s
+        for query_template, query_params, payload in items:
+            if not isinstance(payload, LongitudeQueryResponse):
+                raise TypeError('Payloads must be instances of LongitudeQueryResponse!')
+            storage_expiration = self._prepare_expiration(payload, expiration_time_s)
+            prepared.append((self.cache_key(query_template, query_params or {}), self.serialize_payload(payload)))
+        return prepared, storage_expiration
+
+    def _prepare_expiration(self, payload, expiration_time_s):
+        """
+        Stamps the logical expiration in the payload and returns the expiration for the storage, which keeps the
+        payload for stale_ttl_s more seconds when stale-while-revalidate is enabled.
+        """
+        expiration_time_s = expiration_time_s or self.expiration_time
+        if not (expiration_time_s and self.refreshes_early):
+            return expiration_time_s
+        payload.expires_at = time.time() + expiration_time_s
+        return expiration_time_s + (self.stale_ttl_s or 0)
+
+    def needs_refresh(self, payload):
+        """
+        :param payload: Response returned by .get(...)
+        :return: True if the payload is stale or, with early refresh enabled, if it has been chosen to be refreshed
+            before it expires
+        """
+        if payload.expires_at is None:
+            return False
+        now = time.time()
+        if now >= payload.expires_at:
+            return True
+        if self.early_refresh_beta and payload.compute_time_s:
+            # 1 - random() is in (0, 1], so the logarithm is always defined
+            gap = payload.compute_time_s * self.early_refresh_beta * -math.log(1 - random.random())
+            return now + gap >= payload.expires_at
+        return False
 
     def execute_get(self, key):
         """
@@ -82,9 +214,66 @@ class LongitudeCache():
     async def execute_put_async(self, key, payload, expiration_time_s=None):
         raise NotImplementedError
 
+    def execute_get_many(self, keys):
+        """
+        Custom batch get action. Override it if the backend can get many keys at once; by default, keys are read one
+        by one.
+
+        :return: List of payloads (None for misses), in the same order as keys
+        """
+        return [self.execute_get(key) for key in keys]
+
+    async def execute_get_many_async(self, keys):
+        return [await self.execute_get_async(key) for key in keys]
+
+    def execute_put_many(self, items, expiration_time_s=None):
+        """
+        Custom batch put action. Override it if the backend can put many keys at once; by default, keys are written
+        one by one.
+
+        :param items: List of (key, payload) tuples
+        :return: List telling, for each key, if it was overwritten
+        """
+        return [self.execute_put(key, payload, expiration_time_s=expiration_time_s) for key, payload in items]
+
+    async def execute_put_many_async(self, items, expiration_time_s=None):
+        return [await self.execute_put_async(key, payload, expiration_time_s=expiration_time_s)
+                for key, payload in items]
+
+    def execute_delete_many(self, keys):
+        """
+        Custom action to remove keys from the cache
+
+        :return: Number of removed keys
+        """
+        raise NotImplementedError
+
+    async def execute_delete_many_async(self, keys):
+        raise NotImplementedError
+
+    def execute_tag(self, key, tags):
+        """
+        Custom action to associate a key with tags, so it can be removed by .invalidate_tags(...)
+        """
+        raise NotImplementedError
+
+    async def execute_tag_async(self, key, tags):
+        raise NotImplementedError
+
+    def execute_invalidate_tags(self, tags):
+        """
+        Custom action to remove every key associated with any of the tags
+
+        :return: Number of removed keys
+        """
+        raise NotImplementedError
+
+    async def execute_invalidate_tags_async(self, tags):
+        raise NotImplementedError
+
     def flush(self):
         """
-        Custom action to make the cache empty
+        Custom action to make the cache empty. Only the payloads of this cache (i.e. its namespace) are removed.
 
         :return:
         """
@@ -93,14 +282,16 @@ class LongitudeCache():
     async def flush_async(self):
         raise NotImplementedError
 
-    @staticmethod
-    def serialize_payload(payload):
+    def serialize_payload(self, payload):
         if payload:
-            return pickle.dumps(payload)
+            return self.serializer.dumps(payload)
         return None
 
-    @staticmethod
-    def deserialize_payload(payload):
+    def deserialize_payload(self, payload):
         if payload:
-            return pickle.loads(payload)
+            try:
+                return self.serializer.loads(payload)
+            except Exception as e:
+                # i.e. payloads written by another serializer or code version. They are handled as misses.
+                self.logger.warning('Cached payload cannot be deserialized and will be ignored: %s' % e)
         return None
@@ -0,0 +1,79 @@
+import datetime
+import decimal
+import hashlib
+import json
+import uuid
+from functools import lru_cache
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from ..common.exceptions import LongitudeConfigError
+
+
+def _xxhash_hexdigest(data):
+    return xxhash.xxh3_128_hexdigest(data)
+
+
+KEY_HASHES = {
+    # Cryptographic, default. Keys are the same as in any other process/version using sha256.
+    'sha256': lambda data: hashlib.sha256(data).hexdigest(),
+    # Cryptographic and faster than sha256 for the short payloads used in keys
+    'blake2b': lambda data: hashlib.blake2b(data, digest_size=16).hexdigest(),
+    # Non-cryptographic and the fastest. Needs the optional 'xxhash' package.
+    'xxhash': _xxhash_hexdigest,
+}
+
+
+def check_key_hash(hash_name):
+    if hash_name not in KEY_HASHES:
+        raise LongitudeConfigError('Unknown key hash %s. Available: %s' % (hash_name, ', '.join(KEY_HASHES)))
+    if hash_name == 'xxhash' and xxhash is None:
+        raise LongitudeConfigError('The xxhash key hash needs the xxhash package to be installed')
+
+
+def _canonical(value):
+    """
+    Converts query parameters into JSON-serializable structures that do not depend on dictionary ordering. Types
+    that are adapted differently by the database drivers (i.e. tuples and lists) are tagged so they do not collide.
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, dict):
+        return {k if isinstance(k, str) else '%s:%r' % (type(k).__name__, k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return {'__tuple__': [_canonical(v) for v in value]}
+    if isinstance(value, list):
+        return [_canonical(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {'__set__': sorted(json.dumps(_canonical(v), sort_keys=True) for v in value)}
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return {'__%s__' % type(value).__name__: value.isoformat()}
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return {'__%s__' % type(value).__name__: str(value)}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'__bytes__': bytes(value).hex()}
+    return {'__%s__' % type(value).__name__: repr(value)}
+
+
+def canonical_params(params):
+    """
+    :param params: Query parameters
+    :return: String that is the same for logically identical parameters (i.e. regardless of dictionary ordering)
+    """
+    return json.dumps(_canonical(params), sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+@lru_cache(maxsize=4096)
+def template_digest(query_template, hash_name='sha256'):
+    """
+    Digest of a query template. Memoized, as the same templates are hashed over and over.
+    """
+    return KEY_HASHES[hash_name](query_template.encode('utf-8'))
+
+
+def query_key(query_template, params, hash_name='sha256'):
+    payload = template_digest(str(query_template), hash_name) + canonical_params(params)
+    return KEY_HASHES[hash_name](payload.encode('utf-8'))
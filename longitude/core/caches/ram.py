@@ -1,30 +1,275 @@
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+
 from .base import LongitudeCache
 
 
+class RamStore:
+    """
+    Thread-safe, bounded, in-memory storage used by RamCache.
+
+    When it is full, the least recently used entries are evicted. Entries expire after their expiration time, if any.
+    """
+
+    def __init__(self, max_entries=None, max_size_bytes=None):
+        self.max_entries = max_entries
+        self.max_size_bytes = max_size_bytes
+
+        # key -> (payload, expiration timestamp or None, size in bytes). Least recently used first.
+        self._values = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+
+        # tag -> set of keys, and key -> set of tags, so tags are cleaned when their keys are removed
+        self._tags = {}
+        self._key_tags = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._values),
+                'size_bytes': self._size_bytes
+            }
+
+    def _payload_size(self, payload):
+        # Sizes are only needed (and worth computing) when there is a size limit
+        if self.max_size_bytes is None:
+            return 0
+        try:
+            return len(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return sys.getsizeof(payload)
+
+    def _remove(self, key):
+        _, _, size = self._values.pop(key)
+        self._size_bytes -= size
+        for tag in self._key_tags.pop(key, ()):
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def _evict(self):
+        while self._values and (
+                (self.max_entries is not None and len(self._values) > self.max_entries) or
+                (self.max_size_bytes is not None and self._size_bytes > self.max_size_bytes)):
+            self._remove(next(iter(self._values)))
+            self.evictions += 1
+
+    def _get(self, key):
+        # Must be called with the lock acquired
+        entry = self._values.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        payload, expires_at, _ = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._values.move_to_end(key)
+        self.hits += 1
+        return payload
+
+    def _put(self, key, payload, expires_at, size):
+        # Must be called with the lock acquired
+        is_overwrite = key in self._values
+        if is_overwrite:
+            self._remove(key)
+
+        if self.max_size_bytes is not None and size > self.max_size_bytes:
+            return is_overwrite
+
+        self._values[key] = (payload, expires_at, size)
+        self._size_bytes += size
+        self._evict()
+        return is_overwrite
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def get_many(self, keys):
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def put(self, key, payload, expiration_time_s=None):
+        """
+        :return: True if key was overwritten. False if key was new in the store.
+        """
+        return self.put_many([(key, payload)], expiration_time_s=expiration_time_s)[0]
+
+    def put_many(self, items, expiration_time_s=None):
+        """
+        :param items: List of (key, payload) tuples
+        :return: List telling, for each key, if it was overwritten
+        """
+        expires_at = time.monotonic() + expiration_time_s if expiration_time_s else None
+        # Computed out of the lock, as pickling big payloads may be slow
+        sized = [(key, payload, self._payload_size(payload)) for key, payload in items]
+
+        with self._lock:
+            return [self._put(key, payload, expires_at, size) for key, payload, size in sized]
+
+    def delete_many(self, keys):
+        """
+        :return: Number of removed keys
+        """
+        with self._lock:
+            present = [key for key in keys if key in self._values]
+            for key in present:
+                self._remove(key)
+            return len(present)
+
+    def delete_prefix(self, prefix):
+        """
+        :return: Number of removed keys
+        """
+        with self._lock:
+            keys = [key for key in self._values if key.startswith(prefix)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def tag(self, key, tags):
+        with self._lock:
+            if key not in self._values:
+                return
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            self._key_tags.setdefault(key, set()).update(tags)
+
+    def invalidate_tags(self, tags):
+        """
+        :return: Number of removed keys
+        """
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._tags.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._size_bytes = 0
+            self._tags.clear()
+            self._key_tags.clear()
+
+
 class RamCache(LongitudeCache):
     """
     This is the simplest cache we can use: a dictionary in memory.
+
+    Each instance has its own RamStore unless a 'store_name' is given. Instances with the same store name share the
+    same store (and its limits, which are set by the first instance that creates it).
     """
-    _values = {}
+    DEFAULT_MAX_ENTRIES = 1000
+
+    _shared_stores = {}
+    _shared_stores_lock = threading.Lock()
+
+    def __init__(self, options={}):
+        """
+        :param max_entries: Maximum number of stored payloads (default: 1000). None means unbounded.
+        :param max_size_bytes: Maximum total size of the stored payloads, estimated from their pickled size.
+            None (default) means unbounded.
+        :param expiration_time_s: Default expiration for payloads put without one
+        :param store_name: Name of a store shared with other RamCache instances. None (default) for a private store.
+        """
+        super().__init__(options)
+        self.store_name = options.get('store_name')
+
+        store_options = {
+            'max_entries': options.get('max_entries', self.DEFAULT_MAX_ENTRIES),
+            'max_size_bytes': options.get('max_size_bytes')
+        }
+        if self.store_name is None:
+            self._store = RamStore(**store_options)
+        else:
+            with self._shared_stores_lock:
+                if self.store_name not in self._shared_stores:
+                    self._shared_stores[self.store_name] = RamStore(**store_options)
+                self._store = self._shared_stores[self.store_name]
+
+    @classmethod
+    def drop_shared_store(cls, store_name):
+        """
+        Forgets a shared store. Instances already using it keep it; new ones get a fresh store.
+        """
+        with cls._shared_stores_lock:
+            cls._shared_stores.pop(store_name, None)
+
+    @property
+    def stats(self):
+        return self._store.stats
 
     def execute_get(self, key):
-        return self._values.get(key)
+        return self._store.get(key)
 
     async def execute_get_async(self, key):
         return self.execute_get(key)
 
     def execute_put(self, key, payload, expiration_time_s=None):
-        if expiration_time_s:
-            self.logger.warning("RamCache does not support expiration time. Ignoring configuration.")
-        is_overwrite = key in self._values.keys()
-        self._values[key] = payload
-        return is_overwrite
+        return self._store.put(key, payload, expiration_time_s=expiration_time_s or self.expiration_time)
 
     async def execute_put_async(self, key, payload, expiration_time_s=None):
-        return self.execute_put(key, payload, expiration_time_s=None)
+        return self.execute_put(key, payload, expiration_time_s=expiration_time_s)
+
+    def execute_get_many(self, keys):
+        return self._store.get_many(keys)
+
+    async def execute_get_many_async(self, keys):
+        return self.execute_get_many(keys)
+
+    def execute_put_many(self, items, expiration_time_s=None):
+        return self._store.put_many(items, expiration_time_s=expiration_time_s or self.expiration_time)
+
+    async def execute_put_many_async(self, items, expiration_time_s=None):
+        return self.execute_put_many(items, expiration_time_s=expiration_time_s)
+
+    def execute_delete_many(self, keys):
+        return self._store.delete_many(keys)
+
+    async def execute_delete_many_async(self, keys):
+        return self.execute_delete_many(keys)
+
+    def execute_tag(self, key, tags):
+        self._store.tag(key, tags)
+
+    async def execute_tag_async(self, key, tags):
+        self.execute_tag(key, tags)
+
+    def execute_invalidate_tags(self, tags):
+        return self._store.invalidate_tags(tags)
+
+    async def execute_invalidate_tags_async(self, tags):
+        return self.execute_invalidate_tags(tags)
 
     def flush(self):
-        self._values = {}
+        # Only the namespace of this cache is removed from the store, which may be shared with other namespaces
+        if self.namespace:
+            self._store.delete_prefix(self.namespaced(''))
+        else:
+            self._store.clear()
 
     async def flush_async(self):
         self.flush()
@@ -1,50 +1,135 @@
+import itertools
+import threading
+
+import aredis
 import redis
 from aredis import StrictRedis
 
 from .base import LongitudeCache
 
 
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _members_async(scored_members):
+    async for member, _ in scored_members:
+        yield member
+
+
+# Adds the key (KEYS[1]) to the tags (KEYS[2:]), sorted sets scored by the expiration time of each key. Expired keys
+# are pruned and the set expires with its last key, so tags do not grow forever. Keys without expiration keep the
+# set alive. The TTL is read from the key itself, with the clock of the Redis server.
+TAG_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl == -2 then
+    return 0
+end
+local expires_at = '+inf'
+if ttl >= 0 then
+    expires_at = string.format('%.3f', now + ttl / 1000)
+end
+for i = 2, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', string.format('%.3f', now))
+    redis.call('ZADD', KEYS[i], expires_at, KEYS[1])
+    local last = redis.call('ZRANGE', KEYS[i], -1, -1, 'WITHSCORES')
+    if last[2] == 'inf' then
+        redis.call('PERSIST', KEYS[i])
+    else
+        redis.call('PEXPIREAT', KEYS[i], math.ceil(tonumber(last[2]) * 1000) + 1000)
+    end
+end
+return #KEYS - 1
+"""
+
+
 class RedisCache(LongitudeCache):
+    """
+    Cache stored in a Redis server. Keys are prefixed by the cache namespace, so .flush() and tag invalidation only
+    remove keys of this cache, incrementally (SCAN) and without blocking the server (UNLINK).
+    """
     _default_config = {
         'host': 'localhost',
         'port': 6379,
         'db': 0,
         'password': None,
-        'expiration_time_s': None
+        'expiration_time_s': None,
+        'max_connections': 50,
+        'socket_timeout_s': None,
+        'namespace': 'longitude',
+        'scan_count': 1000
     }
 
+    # Connection pools are shared by every RedisCache instance pointing to the same server and database
+    _connection_pools = {}
+    _async_connection_pools = {}
+    _connection_pools_lock = threading.Lock()
+
     def __init__(self, options={}):
         super().__init__(options)
         self._options = options
 
         self._async_redis_client = None
         self._redis_client = None
-        self.expiration_time = options.get('expiration_time_s')
+        self.scan_count = options.get('scan_count', 1000)
+        self._scripts = {}
+        self._async_scripts = {}
+
+    def _pool_config(self):
+        return {
+            'host': self._options.get('host', 'localhost'),
+            'port': self._options.get('port', 6379),
+            'db': self._options.get('db', 0),
+            'password': self._options.get('password'),
+            'max_connections': self._options.get('max_connections', 50)
+        }
+
+    def _shared_pool(self, pools, create_pool):
+        config = self._pool_config()
+        timeout = self._options.get('socket_timeout_s')
+        key = tuple(sorted(config.items())) + (('timeout', timeout),)
+        with self._connection_pools_lock:
+            if key not in pools:
+                pools[key] = create_pool(config, timeout)
+            return pools[key]
 
     @property
     def _redis(self):
         # Lazy initialization of the syncronous redis client
         if not self._redis_client:
-            self._redis_client = redis.Redis(
-                host=self._options.get('host', 'localhost'),
-                port=self._options.get('port', 6379),
-                db=self._options.get('db', 0),
-                password=self._options.get('password')
+            pool = self._shared_pool(
+                self._connection_pools,
+                lambda config, timeout: redis.ConnectionPool(socket_timeout=timeout, **config)
             )
+            self._redis_client = redis.Redis(connection_pool=pool)
         return self._redis_client
 
     @property
     def _aredis(self):
         # Lazy initialization of the async redis client
         if not self._async_redis_client:
-            self._async_redis_client = StrictRedis(
-                host=self._options.get('host', 'localhost'),
-                port=self._options.get('port', 6379),
-                db=self._options.get('db', 0),
-                password=self._options.get('password')
+            pool = self._shared_pool(
+                self._async_connection_pools,
+                lambda config, timeout: aredis.ConnectionPool(stream_timeout=timeout, **config)
             )
+            self._async_redis_client = StrictRedis(connection_pool=pool)
         return self._async_redis_client
 
+    def _set_options(self, expiration_time_s):
+        opt = {}
+        expiration_time_s = expiration_time_s or self.expiration_time
+        if expiration_time_s:
+            opt['ex'] = expiration_time_s
+        return opt
+
     def execute_get(self, key):
         return self._redis.get(name=key)
 
@@ -52,29 +137,159 @@ class RedisCache(LongitudeCache):
         return await self._aredis.get(name=key)
 
     def execute_put(self, key, payload, expiration_time_s=None):
-        overwrite = self._redis.exists(key) == 1
+        # EXISTS and SET go in the same MULTI/EXEC transaction: one round trip and no races with other writers
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.exists(key)
+        pipe.set(name=key, value=payload, **self._set_options(expiration_time_s))
+        existed, _ = pipe.execute()
+        return existed == 1
 
-        opt = {}
-        expiration_time_s = expiration_time_s or self.expiration_time
-        if expiration_time_s:
-            opt['ex'] = expiration_time_s
+    async def execute_put_async(self, key, payload, expiration_time_s=None):
+        pipe = await self._aredis.pipeline(transaction=True)
+        await pipe.exists(key)
+        await pipe.set(name=key, value=payload, **self._set_options(expiration_time_s))
+        existed, _ = await pipe.execute()
+        return existed == 1
 
-        self._redis.set(name=key, value=payload, **opt)
-        return overwrite
+    def execute_get_many(self, keys):
+        """
+        :return: List of payloads (None for misses), in the same order as keys. One round trip.
+        """
+        if not keys:
+            return []
+        return self._redis.mget(keys)
 
-    async def execute_put_async(self, key, payload, expiration_time_s=None):
-        overwrite = await self._aredis.exists(key) == 1
+    async def execute_get_many_async(self, keys):
+        if not keys:
+            return []
+        return await self._aredis.mget(keys)
 
-        opt = {}
-        expiration_time_s = expiration_time_s or self.expiration_time
-        if expiration_time_s:
-            opt['ex'] = expiration_time_s
+    def execute_put_many(self, items, expiration_time_s=None):
+        """
+        :param items: List of (key, payload) tuples
+        :return: List telling, for each key, if it was overwritten. One round trip.
+        """
+        if not items:
+            return []
+        pipe = self._redis.pipeline(transaction=False)
+        opt = self._set_options(expiration_time_s)
+        for key, payload in items:
+            pipe.exists(key)
+            pipe.set(name=key, value=payload, **opt)
+        return [existed == 1 for existed in pipe.execute()[::2]]
+
+    async def execute_put_many_async(self, items, expiration_time_s=None):
+        if not items:
+            return []
+        pipe = await self._aredis.pipeline(transaction=False)
+        opt = self._set_options(expiration_time_s)
+        for key, payload in items:
+            await pipe.exists(key)
+            await pipe.set(name=key, value=payload, **opt)
+        return [existed == 1 for existed in (await pipe.execute())[::2]]
+
+    def execute_delete_many(self, keys):
+        return self._unlink_all(keys)
+
+    async def execute_delete_many_async(self, keys):
+        removed = 0
+        for chunk in _chunks(keys, self.scan_count):
+            removed += await self._aredis.unlink(*chunk)
+        return removed
+
+    def _tag_key(self, tag):
+        return self.namespaced('tag:%s' % tag)
+
+    def execute_tag(self, key, tags):
+        # After the put: the TTL of the payload is read by the script
+        self.run_script(TAG_SCRIPT, [key] + [self._tag_key(tag) for tag in tags])
+
+    async def execute_tag_async(self, key, tags):
+        await self.run_script_async(TAG_SCRIPT, [key] + [self._tag_key(tag) for tag in tags])
 
-        await self._aredis.set(name=key, value=payload, **opt)
-        return overwrite
+    def _unlink_all(self, keys):
+        removed = 0
+        for chunk in _chunks(keys, self.scan_count):
+            removed += self._redis.unlink(*chunk)
+        return removed
+
+    async def _unlink_all_async(self, keys):
+        removed = 0
+        chunk = []
+        async for key in keys:
+            chunk.append(key)
+            if len(chunk) >= self.scan_count:
+                removed += await self._aredis.unlink(*chunk)
+                chunk = []
+        if chunk:
+            removed += await self._aredis.unlink(*chunk)
+        return removed
+
+    def execute_invalidate_tags(self, tags):
+        removed = 0
+        for tag in tags:
+            tag_key = self._tag_key(tag)
+            members = self._redis.zscan_iter(tag_key, count=self.scan_count)
+            removed += self._unlink_all(member for member, _ in members)
+            self._redis.unlink(tag_key)
+        return removed
+
+    async def execute_invalidate_tags_async(self, tags):
+        removed = 0
+        for tag in tags:
+            tag_key = self._tag_key(tag)
+            members = self._aredis.zscan_iter(tag_key, count=self.scan_count)
+            removed += await self._unlink_all_async(_members_async(members))
+            await self._aredis.unlink(tag_key)
+        return removed
 
     def flush(self):
-        self._redis.flushall()
+        """
+        Removes the keys of this cache namespace. Without namespace, the current database is flushed (never the
+        whole server).
+        """
+        if not self.namespace:
+            self._redis.flushdb()
+            return
+        self._unlink_all(self._redis.scan_iter(match='%s:*' % self.namespace, count=self.scan_count))
+
+    async def flush_async(self):
+        if not self.namespace:
+            await self._aredis.flushdb()
+            return
+        await self._unlink_all_async(self._aredis.scan_iter(match='%s:*' % self.namespace, count=self.scan_count))
+
+    def run_script(self, script, keys=(), args=()):
+        """
+        Runs a Lua script atomically in the Redis server. Scripts are sent once and then called by their SHA1.
+
+        :param keys: Keys read or written by the script, as given (not namespaced)
+        """
+        if script not in self._scripts:
+            self._scripts[script] = self._redis.register_script(script)
+        return self._scripts[script](keys=list(keys), args=list(args))
+
+    async def run_script_async(self, script, keys=(), args=()):
+        if script not in self._async_scripts:
+            self._async_scripts[script] = self._aredis.register_script(script)
+        return await self._async_scripts[script].execute(keys=list(keys), args=list(args))
+
+    def publish(self, channel, message):
+        """
+        Publishes a message in a Redis pub/sub channel of this cache namespace
+        """
+        return self._redis.publish(self.namespaced(channel), message)
+
+    async def publish_async(self, channel, message):
+        return await self._aredis.publish(self.namespaced(channel), message)
+
+    def subscribe(self, channel, callback, poll_interval_s=0.1):
+        """
+        Listens to a Redis pub/sub channel of this cache namespace in a daemon thread.
 
-    def flush_async(self):
-        self._aredis.flushall()
+        :param callback: Function receiving the data (bytes) of each message
+        :return: The listener thread. Call its .stop() method to unsubscribe.
+        """
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.namespaced(channel): lambda message: callback(message['data'])})
+        return pubsub.run_in_thread(sleep_time=poll_interval_s, daemon=True)
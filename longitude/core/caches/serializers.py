@@ -0,0 +1,276 @@
+import datetime
+import decimal
+import json
+import pickle
+import uuid
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+from ..common.exceptions import LongitudeConfigError
+from ..common.query_response import LongitudeQueryResponse
+
+
+class PayloadSerializer:
+    """
+    Converts LongitudeQueryResponse objects into bytes (and back) to be stored in caches.
+    """
+
+    def dumps(self, response):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class PickleSerializer(PayloadSerializer):
+    """
+    Default serializer. It handles any value in the rows, but payloads are bound to the code version that wrote them.
+    """
+
+    def dumps(self, response):
+        return pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+def _response_state(response):
+    """
+    Plain representation of a response. Rows are stored as tuples, with one shared list of field names, whenever
+    every row has exactly the response fields.
+    """
+    names = list(response.fields)
+    state = {
+        'fields': response.fields,
+        'meta': response.meta,
+        'compact': response.is_compact,
+        'expires_at': response.expires_at,
+        'compute_time_s': response.compute_time_s
+    }
+    if response.is_compact or all(row.keys() == response.fields.keys() for row in response.rows):
+        state['tuples'] = [list(values) for values in response.tuples]
+    else:
+        state['rows'] = response.rows
+    state['names'] = names
+    return state
+
+
+def _response_from_state(state):
+    if 'tuples' in state:
+        if state['compact']:
+            response = LongitudeQueryResponse(tuples=[tuple(values) for values in state['tuples']],
+                                              fields=state['fields'], meta=state['meta'])
+        else:
+            names = state['names']
+            response = LongitudeQueryResponse(rows=[dict(zip(names, values)) for values in state['tuples']],
+                                              fields=state['fields'], meta=state['meta'])
+    else:
+        response = LongitudeQueryResponse(rows=state['rows'], fields=state['fields'], meta=state['meta'])
+    response.expires_at = state['expires_at']
+    response.compute_time_s = state['compute_time_s']
+    return response
+
+
+# msgpack extension types for values that have no native representation
+_EXT_DATETIME = 1
+_EXT_DATE = 2
+_EXT_TIME = 3
+_EXT_DECIMAL = 4
+_EXT_UUID = 5
+
+_EXT_DECODERS = {
+    _EXT_DATETIME: datetime.datetime.fromisoformat,
+    _EXT_DATE: datetime.date.fromisoformat,
+    _EXT_TIME: datetime.time.fromisoformat,
+    _EXT_DECIMAL: decimal.Decimal,
+    _EXT_UUID: uuid.UUID,
+}
+
+
+def _msgpack_default(value):
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(_EXT_DATETIME, value.isoformat().encode('utf-8'))
+    if isinstance(value, datetime.date):
+        return msgpack.ExtType(_EXT_DATE, value.isoformat().encode('utf-8'))
+    if isinstance(value, datetime.time):
+        return msgpack.ExtType(_EXT_TIME, value.isoformat().encode('utf-8'))
+    if isinstance(value, decimal.Decimal):
+        return msgpack.ExtType(_EXT_DECIMAL, str(value).encode('utf-8'))
+    if isinstance(value, uuid.UUID):
+        return msgpack.ExtType(_EXT_UUID, str(value).encode('utf-8'))
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    raise TypeError('Value of type %s cannot be serialized with msgpack' % type(value).__name__)
+
+
+def _msgpack_ext_hook(code, data):
+    decoder = _EXT_DECODERS.get(code)
+    if decoder is None:
+        return msgpack.ExtType(code, data)
+    return decoder(data.decode('utf-8'))
+
+
+class MsgpackSerializer(PayloadSerializer):
+    """
+    Compact binary serializer that does not depend on the code version. Needs the msgpack package.
+
+    Supports the JSON types plus bytes, dates, times, decimals and UUIDs. Tuples are restored as lists.
+    """
+
+    def __init__(self):
+        if msgpack is None:
+            raise LongitudeConfigError('The msgpack serializer needs the msgpack package to be installed')
+
+    def dumps(self, response):
+        return msgpack.packb(_response_state(response), default=_msgpack_default, use_bin_type=True)
+
+    def loads(self, data):
+        return _response_from_state(msgpack.unpackb(data, ext_hook=_msgpack_ext_hook, raw=False,
+                                                    strict_map_key=False))
+
+
+class ArrowSerializer(PayloadSerializer):
+    """
+    Columnar serializer using the Arrow IPC stream format. Needs the pyarrow package.
+
+    Best suited for big results with homogeneous columns. Every column must hold values of a single type, and fields
+    and meta must be JSON values (with string keys). Other responses raise TypeError instead of changing on the way.
+    """
+
+    def __init__(self):
+        if pyarrow is None:
+            raise LongitudeConfigError('The arrow serializer needs the pyarrow package to be installed')
+
+    def dumps(self, response):
+        state = _response_state(response)
+        if 'tuples' not in state:
+            raise TypeError('Rows with keys other than the response fields cannot be serialized with arrow')
+
+        tuples = state.pop('tuples')
+        names = state['names']
+        if tuples and not names:
+            # A table without columns has no rows
+            raise TypeError('Rows without fields cannot be serialized with arrow')
+        try:
+            metadata = json.dumps(state)
+        except (TypeError, ValueError) as e:
+            raise TypeError('Fields and meta cannot be serialized with arrow: %s' % e) from e
+        if json.loads(metadata) != state:
+            raise TypeError('Fields and meta cannot be serialized with arrow: they do not survive a JSON round trip')
+
+        columns = [[values[i] for values in tuples] for i in range(len(names))]
+        # Positional column names keep duplicated/empty field names working
+        table = pyarrow.table({str(i): column for i, column in enumerate(columns)})
+        table = table.replace_schema_metadata({'longitude': metadata})
+
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+    def loads(self, data):
+        table = pyarrow.ipc.open_stream(data).read_all()
+        state = json.loads(table.schema.metadata[b'longitude'])
+        state['tuples'] = list(zip(*[column.to_pylist() for column in table.columns]))
+        return _response_from_state(state)
+
+
+_CODECS = {
+    # name: (header byte, compress(data, level), decompress(data))
+    'zlib': (b'\x01', lambda data, level: zlib.compress(data, 6 if level is None else level), zlib.decompress),
+    'zstd': (b'\x02',
+             lambda data, level: zstandard.ZstdCompressor(level=3 if level is None else level).compress(data),
+             lambda data: zstandard.ZstdDecompressor().decompress(data)),
+    'lz4': (b'\x03',
+            lambda data, level: lz4_frame.compress(data, compression_level=0 if level is None else level),
+            lambda data: lz4_frame.decompress(data)),
+}
+_CODECS_BY_HEADER = {header: decompress for header, _, decompress in _CODECS.values()}
+_RAW_HEADER = b'\x00'
+
+
+class CompressedSerializer(PayloadSerializer):
+    """
+    Wraps another serializer, compressing its output when it is bigger than a threshold. Payloads are prefixed by one
+    byte telling how they were compressed, so any payload can be read regardless of the current codec.
+    """
+
+    def __init__(self, serializer, codec='zlib', threshold_bytes=1024, level=None):
+        if codec not in _CODECS:
+            raise LongitudeConfigError('Unknown compression %s. Available: %s' % (codec, ', '.join(_CODECS)))
+        if codec == 'zstd' and zstandard is None:
+            raise LongitudeConfigError('The zstd compression needs the zstandard package to be installed')
+        if codec == 'lz4' and lz4_frame is None:
+            raise LongitudeConfigError('The lz4 compression needs the lz4 package to be installed')
+
+        self.serializer = serializer
+        self.codec = codec
+        self.threshold_bytes = threshold_bytes
+        self.level = level
+
+    def dumps(self, response):
+        data = self.serializer.dumps(response)
+        if len(data) < self.threshold_bytes:
+            return _RAW_HEADER + data
+        header, compress, _ = _CODECS[self.codec]
+        return header + compress(data, self.level)
+
+    def loads(self, data):
+        header, data = data[:1], data[1:]
+        if header != _RAW_HEADER:
+            data = _CODECS_BY_HEADER[header](data)
+        return self.serializer.loads(data)
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer,
+    'msgpack': MsgpackSerializer,
+    'arrow': ArrowSerializer,
+}
+
+
+def build_serializer(options):
+    """
+    Creates the serializer described by the cache options:
+
+    :param serializer: PayloadSerializer instance or one of 'pickle' (default), 'msgpack' or 'arrow'
+    :param compression: None (default), 'zlib', 'zstd' or 'lz4'
+    :param compression_threshold_bytes: Payloads smaller than this are stored uncompressed (default: 1024)
+    :param compression_level: Codec specific compression level. None for the codec default.
+    """
+    serializer = options.get('serializer', 'pickle')
+    if not isinstance(serializer, PayloadSerializer):
+        if serializer not in SERIALIZERS:
+            raise LongitudeConfigError(
+                'Unknown serializer %s. Available: %s' % (serializer, ', '.join(SERIALIZERS))
+            )
+        serializer = SERIALIZERS[serializer]()
+
+    compression = options.get('compression')
+    if compression:
+        serializer = CompressedSerializer(
+            serializer,
+            codec=compression,
+            threshold_bytes=options.get('compression_threshold_bytes', 1024),
+            level=options.get('compression_level')
+        )
+    return serializer
@@ -0,0 +1,206 @@
+import json
+import threading
+import uuid
+
+from ..common.exceptions import LongitudeConfigError
+from .base import LongitudeCache
+from .ram import RamCache
+
+
+class TieredCache(LongitudeCache):
+    """
+    Two level cache: a bounded in-process RamCache (L1) in front of a shared cache (L2), usually a RedisCache.
+
+    Reads try L1 first and fall back to L2, copying its hits into L1 (read-through). Writes go to both levels
+    (write-through). L1 entries live for a few seconds only, so they are never much older than the L2 ones.
+
+    If an invalidation channel is set, the keys of every write, tag invalidations and flushes are published in the L2
+    pub/sub (the L2 must provide .publish(...) and .subscribe(...), as RedisCache does), so the other processes drop
+    their L1 copies.
+    """
+    DEFAULT_L1_EXPIRATION_TIME_S = 5
+
+    def __init__(self, options={}):
+        """
+        :param l2: Shared cache (LongitudeCache instance). Keys, expiration and serialization options are the L2 ones.
+        :param l1_expiration_time_s: Seconds each payload is kept in L1 (default: 5)
+        :param l1_max_entries: Maximum number of payloads in L1 (default: 1000)
+        :param l1_max_size_bytes: Maximum total size of the payloads in L1. None (default) means unbounded.
+        :param invalidation_channel: Name of the L2 pub/sub channel used to invalidate the L1 of every process. None
+            (default) disables it.
+        """
+        self.l2 = options.get('l2')
+        if not isinstance(self.l2, LongitudeCache):
+            raise LongitudeConfigError('TieredCache needs a LongitudeCache instance as l2 option')
+        super().__init__(options)
+
+        self.l1_expiration_time_s = options.get('l1_expiration_time_s', self.DEFAULT_L1_EXPIRATION_TIME_S)
+        self.l1 = RamCache({
+            'max_entries': options.get('l1_max_entries', RamCache.DEFAULT_MAX_ENTRIES),
+            'max_size_bytes': options.get('l1_max_size_bytes'),
+            'namespace': ''
+        })
+
+        self.invalidation_channel = options.get('invalidation_channel')
+        if self.invalidation_channel and not (hasattr(self.l2, 'publish') and hasattr(self.l2, 'subscribe')):
+            raise LongitudeConfigError('Invalidation channels need a L2 cache with pub/sub support (i.e. RedisCache)')
+        # Messages published by this instance are ignored when they come back
+        self._node_id = uuid.uuid4().hex
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    @property
+    def refreshes_early(self):
+        return self.l2.refreshes_early
+
+    def cache_key(self, query_template, params):
+        return self.l2.cache_key(query_template, params)
+
+    def needs_refresh(self, payload):
+        return self.l2.needs_refresh(payload)
+
+    def _l1_put(self, key, payload):
+        self._listen()
+        self.l1.execute_put(key, payload, expiration_time_s=self.l1_expiration_time_s)
+
+    def get(self, query_template, query_params=None):
+        key = self.cache_key(query_template, query_params or {})
+        payload = self.l1.execute_get(key)
+        if payload is None:
+            payload = self.l2.get(query_template, query_params)
+            if payload is not None:
+                self._l1_put(key, payload)
+        return payload
+
+    async def get_async(self, query_template, query_params=None):
+        key = self.cache_key(query_template, query_params or {})
+        payload = self.l1.execute_get(key)
+        if payload is None:
+            payload = await self.l2.get_async(query_template, query_params)
+            if payload is not None:
+                self._l1_put(key, payload)
+        return payload
+
+    def put(self, query_template, payload, query_params=None, expiration_time_s=None, tags=None):
+        is_overwrite = self.l2.put(query_template, payload, query_params=query_params,
+                                   expiration_time_s=expiration_time_s, tags=tags)
+        key = self.cache_key(query_template, query_params or {})
+        self._l1_put(key, payload)
+        self._publish({'keys': [key]})
+        return is_overwrite
+
+    async def put_async(self, query_template, payload, query_params=None, expiration_time_s=None, tags=None):
+        is_overwrite = await self.l2.put_async(query_template, payload, query_params=query_params,
+                                               expiration_time_s=expiration_time_s, tags=tags)
+        key = self.cache_key(query_template, query_params or {})
+        self._l1_put(key, payload)
+        await self._publish_async({'keys': [key]})
+        return is_overwrite
+
+    def get_many(self, queries):
+        keys = [self.cache_key(query_template, query_params or {}) for query_template, query_params in queries]
+        payloads = self.l1.execute_get_many(keys)
+        missed = [i for i, payload in enumerate(payloads) if payload is None]
+        if missed:
+            for i, payload in zip(missed, self.l2.get_many([queries[i] for i in missed])):
+                self._fill(keys, payloads, i, payload)
+        return payloads
+
+    async def get_many_async(self, queries):
+        keys = [self.cache_key(query_template, query_params or {}) for query_template, query_params in queries]
+        payloads = self.l1.execute_get_many(keys)
+        missed = [i for i, payload in enumerate(payloads) if payload is None]
+        if missed:
+            for i, payload in zip(missed, await self.l2.get_many_async([queries[i] for i in missed])):
+                self._fill(keys, payloads, i, payload)
+        return payloads
+
+    def _fill(self, keys, payloads, i, payload):
+        if payload is not None:
+            payloads[i] = payload
+            self._l1_put(keys[i], payload)
+
+    def put_many(self, items, expiration_time_s=None):
+        overwritten = self.l2.put_many(items, expiration_time_s=expiration_time_s)
+        self._publish({'keys': self._put_many_in_l1(items)})
+        return overwritten
+
+    async def put_many_async(self, items, expiration_time_s=None):
+        overwritten = await self.l2.put_many_async(items, expiration_time_s=expiration_time_s)
+        await self._publish_async({'keys': self._put_many_in_l1(items)})
+        return overwritten
+
+    def _put_many_in_l1(self, items):
+        """
+        :return: The written keys
+        """
+        self._listen()
+        keyed = [(self.cache_key(query_template, query_params or {}), payload)
+                 for query_template, query_params, payload in items]
+        self.l1.execute_put_many(keyed, expiration_time_s=self.l1_expiration_time_s)
+        return [key for key, _ in keyed]
+
+    def invalidate_tags(self, tags):
+        # L1 copies read from L2 do not know their tags, so the whole (short lived) L1 is dropped
+        removed = self.l2.invalidate_tags(tags)
+        self.l1.flush()
+        self._publish({'flush': True})
+        return removed
+
+    async def invalidate_tags_async(self, tags):
+        removed = await self.l2.invalidate_tags_async(tags)
+        self.l1.flush()
+        await self._publish_async({'flush': True})
+        return removed
+
+    def flush(self):
+        self.l2.flush()
+        self.l1.flush()
+        self._publish({'flush': True})
+
+    async def flush_async(self):
+        await self.l2.flush_async()
+        self.l1.flush()
+        await self._publish_async({'flush': True})
+
+    def close(self):
+        """
+        Stops listening to the invalidation channel, if it was listened
+        """
+        with self._listener_lock:
+            if self._listener is not None:
+                self._listener.stop()
+                self._listener = None
+
+    def _message(self, message):
+        message['node'] = self._node_id
+        return json.dumps(message)
+
+    def _publish(self, message):
+        if self.invalidation_channel and any(message.values()):
+            self.l2.publish(self.invalidation_channel, self._message(message))
+
+    async def _publish_async(self, message):
+        if self.invalidation_channel and any(message.values()):
+            await self.l2.publish_async(self.invalidation_channel, self._message(message))
+
+    def _listen(self):
+        # Subscription starts with the first L1 write: there is nothing to invalidate before
+        if not self.invalidation_channel or self._listener is not None:
+            return
+        with self._listener_lock:
+            if self._listener is None:
+                self._listener = self.l2.subscribe(self.invalidation_channel, self._on_invalidation)
+
+    def _on_invalidation(self, data):
+        try:
+            message = json.loads(data)
+        except (TypeError, ValueError):
+            self.logger.warning('Ignoring malformed cache invalidation message: %r' % data)
+            return
+        if message.get('node') == self._node_id:
+            return
+        if message.get('flush'):
+            self.l1.flush()
+        else:
+            self.l1.execute_delete_many(message.get('keys', []))
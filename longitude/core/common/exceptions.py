@@ -2,15 +2,41 @@ class LongitudeBaseException(Exception):
     pass
 
 
-class LongitudeRetriesExceeded(LongitudeBaseException):
+class LongitudeAppNotReady(LongitudeBaseException):
     pass
 
 
-class LongitudeAppNotReady(LongitudeBaseException):
+class LongitudeQueryCannotBeExecutedException(LongitudeBaseException):
     pass
 
 
-class LongitudeQueryCannotBeExecutedException(LongitudeBaseException):
+class LongitudeQueryTimeoutException(LongitudeQueryCannotBeExecutedException):
+    pass
+
+
+class LongitudeTransientError(LongitudeQueryCannotBeExecutedException):
+    """
+    The query failed for a reason that may go away by itself (i.e. a dropped connection or an overloaded server), so
+    it can be retried.
+    """
+
+    def __init__(self, message, retry_after_s=None):
+        """
+        :param retry_after_s: Seconds to wait before retrying, if the server told (i.e. a Retry-After header)
+        """
+        super().__init__(message)
+        self.retry_after_s = retry_after_s
+
+
+class LongitudeRetriesExceeded(LongitudeQueryCannotBeExecutedException):
+    pass
+
+
+class LongitudeCircuitOpenException(LongitudeQueryCannotBeExecutedException):
+    pass
+
+
+class LongitudeRateLimitExceeded(LongitudeQueryCannotBeExecutedException):
     pass
 
 
@@ -0,0 +1,188 @@
+"""
+Concurrent execution of independent queries, possibly against different data sources, so the total latency is close
+to the one of the slowest query instead of the sum of all of them.
+
+Queries are (data_source, query_template[, params[, options]]) tuples, where options are the keyword arguments of
+DataSource.query (cache, expiration_time_s, query_config, cache_tags...) plus an optional 'timeout_s'.
+
+Identical queries are executed once. Every query goes through DataSource.query, so the cache, the coalescing of
+concurrent misses and the observers of the data source apply as they do to any other query.
+"""
+import asyncio
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from ..caches.keys import query_key
+from ..data_sources.base_async import AsyncDataSource
+from .exceptions import LongitudeQueryTimeoutException
+
+FanOutQuery = namedtuple('FanOutQuery', ['data_source', 'query_template', 'params', 'options'])
+
+DEFAULT_MAX_WORKERS = 16
+
+
+def _normalize(queries):
+    normalized = []
+    for query in queries:
+        data_source, query_template = query[0], query[1]
+        params = query[2] if len(query) > 2 and query[2] is not None else {}
+        options = dict(query[3]) if len(query) > 3 and query[3] else {}
+        normalized.append(FanOutQuery(data_source, query_template, params, options))
+    return normalized
+
+
+def _dedupe(queries):
+    """
+    :return: Tuple (list of unique queries, list with the index of the unique query for each query)
+    """
+    unique = []
+    positions = {}
+    index_of = []
+    for query in queries:
+        key = (id(query.data_source), query_key(query.query_template, [query.params, query.options]))
+        if key not in positions:
+            positions[key] = len(unique)
+            unique.append(query)
+        index_of.append(positions[key])
+    return unique, index_of
+
+
+def _split_options(query, default_timeout_s):
+    """
+    :return: Tuple (keyword arguments for DataSource.query, timeout in seconds)
+    """
+    options = dict(query.options)
+    timeout_s = options.pop('timeout_s', default_timeout_s)
+    return options, timeout_s
+
+
+def _run(query):
+    options, _ = _split_options(query, None)
+    return query.data_source.query(query.query_template, query.params, **options)
+
+
+def _limits(queries, max_concurrency_per_source, lock_class):
+    """
+    :return: Dictionary with the lock limiting the concurrency of each data source id. Data sources that are not
+        thread-safe (i.e. PostgresDataSource out of pooled mode) run one query at a time.
+    """
+    limits = {}
+    for query in queries:
+        data_source = query.data_source
+        if id(data_source) in limits:
+            continue
+        if not isinstance(data_source, AsyncDataSource) and not data_source.thread_safe:
+            limits[id(data_source)] = lock_class(1)
+        elif max_concurrency_per_source:
+            limits[id(data_source)] = lock_class(max_concurrency_per_source)
+    return limits
+
+
+def _timeout_error(query, timeout_s):
+    return LongitudeQueryTimeoutException(
+        'Query to %s took more than %s seconds' % (query.data_source.__class__.__name__, timeout_s)
+    )
+
+
+def fan_out(queries, timeout_s=None, max_workers=None, max_concurrency_per_source=None, return_exceptions=False):
+    """
+    Runs queries against synchronous data sources concurrently, in a pool of threads.
+
+    Timed out queries cannot be interrupted: they keep running in their thread, but their results are discarded.
+
+    :param queries: List of (data_source, query_template[, params[, options]]) tuples
+    :param timeout_s: Default seconds (since the fan-out starts) each query may take. None means no timeout.
+    :param max_workers: Size of the thread pool (default: number of queries to execute, up to 16)
+    :param max_concurrency_per_source: Maximum number of queries executed at the same time in each data source. None
+        means no limit. Data sources that are not thread-safe always run one query at a time.
+    :param return_exceptions: If True, errors are returned in the place of their responses. Otherwise, the first
+        error is raised.
+    :return: List of responses, in the same order as queries
+    """
+    queries = _normalize(queries)
+    for query in queries:
+        if isinstance(query.data_source, AsyncDataSource):
+            raise TypeError('%s is asynchronous. Use fan_out_async instead.' % query.data_source.__class__.__name__)
+
+    start = time.monotonic()
+    unique, index_of = _dedupe(queries)
+    results = [None] * len(unique)
+    if not unique:
+        return []
+
+    limits = _limits(unique, max_concurrency_per_source, threading.BoundedSemaphore)
+
+    def execute(query):
+        limit = limits.get(id(query.data_source))
+        if limit is None:
+            return _run(query)
+        with limit:
+            return _run(query)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or min(len(unique), DEFAULT_MAX_WORKERS))
+    futures = [executor.submit(execute, query) for query in unique]
+    try:
+        for i, future in enumerate(futures):
+            query_timeout_s = _split_options(unique[i], timeout_s)[1]
+            remaining = None if query_timeout_s is None else max(0, start + query_timeout_s - time.monotonic())
+            try:
+                results[i] = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                future.cancel()
+                results[i] = _timeout_error(unique[i], query_timeout_s)
+            except Exception as e:
+                results[i] = e
+            if isinstance(results[i], Exception) and not return_exceptions:
+                raise results[i]
+    finally:
+        # Queries not started yet are dropped; running ones cannot be stopped
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    return [results[i] for i in index_of]
+
+
+async def fan_out_async(queries, timeout_s=None, max_concurrency_per_source=None, return_exceptions=False):
+    """
+    Runs queries concurrently in the current event loop. Queries to asynchronous data sources are gathered; those to
+    synchronous ones run in the default executor of the loop.
+
+    :param queries: List of (data_source, query_template[, params[, options]]) tuples
+    :param timeout_s: Default seconds each query may take, including the wait for a concurrency slot. None means no
+        timeout.
+    :param max_concurrency_per_source: Maximum number of queries executed at the same time in each data source. None
+        means no limit. Synchronous data sources that are not thread-safe always run one query at a time.
+    :param return_exceptions: If True, errors are returned in the place of their responses. Otherwise, the first
+        error is raised.
+    :return: List of responses, in the same order as queries
+    """
+    loop = asyncio.get_running_loop()
+    queries = _normalize(queries)
+    unique, index_of = _dedupe(queries)
+    limits = _limits(unique, max_concurrency_per_source, asyncio.Semaphore)
+
+    async def execute(query):
+        if isinstance(query.data_source, AsyncDataSource):
+            return await _run(query)
+        return await loop.run_in_executor(None, _run, query)
+
+    async def execute_limited(query):
+        limit = limits.get(id(query.data_source))
+        if limit is None:
+            return await execute(query)
+        async with limit:
+            return await execute(query)
+
+    async def execute_with_timeout(query):
+        query_timeout_s = _split_options(query, timeout_s)[1]
+        try:
+            return await asyncio.wait_for(execute_limited(query), query_timeout_s)
+        except asyncio.TimeoutError:
+            raise _timeout_error(query, query_timeout_s)
+
+    results = await asyncio.gather(*[execute_with_timeout(query) for query in unique],
+                                   return_exceptions=return_exceptions)
+    return [results[i] for i in index_of]
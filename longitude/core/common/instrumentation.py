@@ -0,0 +1,293 @@
+"""
+Hooks around the lifecycle of DataSource.query: cache lookup, execution, parse and cache write.
+
+Observers are given to data sources with the 'observers' option. They subclass QueryObserver and override the hooks
+they need. Hooks run synchronously in the thread (or task) of the query, so they must be fast and thread-safe. Errors
+raised by observers are logged and never reach the query.
+
+MetricsObserver keeps Prometheus-style counters and histograms per data source and query template, in process, and
+renders them in the Prometheus text format, so they can be served by any HTTP endpoint.
+"""
+import bisect
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+DEFAULT_DURATION_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DEFAULT_ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+DEFAULT_MAX_TEMPLATE_LENGTH = 200
+
+_WHITESPACE = re.compile(r'\s+')
+
+logger = logging.getLogger(__name__)
+
+
+class QueryObserver:
+    """
+    Base class of observers. Every hook does nothing by default.
+
+    Hooks receive the data source (use its .name as label) and the query template, not the formatted query, so
+    queries with different params are aggregated together.
+    """
+
+    def on_cache_lookup(self, data_source, query_template, hit, duration_s):
+        """
+        :param hit: True if the response was found in the cache
+        :param duration_s: Seconds taken by the lookup. None for lookups done in batch (i.e. .query_many(...))
+        """
+
+    def on_execute(self, data_source, query_template, duration_s, error=None):
+        """
+        :param error: Exception raised by the data source, if any
+        """
+
+    def on_parse(self, data_source, query_template, duration_s, rows):
+        """
+        :param rows: Number of rows in the response
+        """
+
+    def on_cache_write(self, data_source, query_template, duration_s):
+        pass
+
+    def on_query(self, data_source, query_template, duration_s, cached, error=None):
+        """
+        Called once per .query(...), after the rest of hooks.
+
+        :param cached: True if the response came from the cache
+        :param error: Exception raised by the query, if any
+        """
+
+
+class Instrumentation:
+    """
+    Dispatches the events of a data source to its observers.
+    """
+
+    def __init__(self, observers=None):
+        self.observers = list(observers or [])
+        for observer in self.observers:
+            if not isinstance(observer, QueryObserver):
+                raise TypeError('Observers must derive from QueryObserver')
+
+    def __bool__(self):
+        return bool(self.observers)
+
+    def emit(self, hook, *args, **kwargs):
+        for observer in self.observers:
+            try:
+                getattr(observer, hook)(*args, **kwargs)
+            except Exception as e:
+                logger.warning('Query observer %s failed in %s: %s' % (observer.__class__.__name__, hook, e))
+
+
+def template_label(query_template, max_length=DEFAULT_MAX_TEMPLATE_LENGTH):
+    # Whitespace is collapsed, so the same query written with different indentation is a single series
+    label = _WHITESPACE.sub(' ', str(query_template)).strip()
+    if max_length and len(label) > max_length:
+        label = label[:max_length - 3] + '...'
+    return label
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, label_names):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            yield self.name + '_total', list(zip(self.label_names, label_values)), value
+
+    def expose(self):
+        lines = ['# HELP %s_total %s' % (self.name, self.documentation), '# TYPE %s_total counter' % self.name]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, _format_labels(labels), _format_number(value)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, label_names, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        # Per series: [count per bucket (non cumulative, the last one for +Inf), sum]
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][position] += 1
+            series[1] += value
+
+    def count(self, *label_values):
+        series = self._values.get(label_values)
+        return sum(series[0]) if series else 0
+
+    def sum(self, *label_values):
+        series = self._values.get(label_values)
+        return series[1] if series else 0
+
+    def samples(self):
+        with self._lock:
+            items = [(label_values, list(counts), total) for label_values, (counts, total) in self._values.items()]
+        for label_values, counts, total in items:
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', labels + [('le', _format_number(bound))], cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, _format_labels(labels), _format_number(value)))
+        return lines
+
+
+class MetricsObserver(QueryObserver):
+    """
+    In-process metrics, labelled by data source and query template:
+
+    - longitude_queries_total{data_source, query, result="hit"|"miss"|"error"}
+    - longitude_cache_lookups_total{data_source, query, result="hit"|"miss"}
+    - longitude_query_duration_seconds{data_source, query, cached="true"|"false"}
+    - longitude_cache_lookup_duration_seconds, longitude_execute_duration_seconds,
+      longitude_parse_duration_seconds and longitude_cache_write_duration_seconds{data_source, query}
+    - longitude_response_rows{data_source, query}
+
+    A single observer can be shared by several data sources.
+    """
+
+    def __init__(self, options={}):
+        """
+        :param prefix: Prefix of the metric names (default: 'longitude')
+        :param duration_buckets_s: Upper bounds of the buckets of the duration histograms
+        :param rows_buckets: Upper bounds of the buckets of the response rows histogram
+        :param max_template_length: Query templates are truncated to this length in labels (default: 200). None
+            keeps them whole.
+        """
+        prefix = options.get('prefix', 'longitude')
+        duration_buckets_s = options.get('duration_buckets_s', DEFAULT_DURATION_BUCKETS_S)
+        self.max_template_length = options.get('max_template_length', DEFAULT_MAX_TEMPLATE_LENGTH)
+
+        labels = ('data_source', 'query')
+        self.queries = Counter(prefix + '_queries', 'Queries by result', labels + ('result',))
+        self.cache_lookups = Counter(prefix + '_cache_lookups', 'Cache lookups by result', labels + ('result',))
+        self.query_duration = Histogram(
+            prefix + '_query_duration_seconds', 'Duration of whole queries', labels + ('cached',), duration_buckets_s
+        )
+        self.cache_lookup_duration = Histogram(
+            prefix + '_cache_lookup_duration_seconds', 'Duration of cache lookups', labels, duration_buckets_s
+        )
+        self.execute_duration = Histogram(
+            prefix + '_execute_duration_seconds', 'Duration of executions in the data source', labels,
+            duration_buckets_s
+        )
+        self.parse_duration = Histogram(
+            prefix + '_parse_duration_seconds', 'Duration of the parse of responses', labels, duration_buckets_s
+        )
+        self.cache_write_duration = Histogram(
+            prefix + '_cache_write_duration_seconds', 'Duration of cache writes', labels, duration_buckets_s
+        )
+        self.response_rows = Histogram(
+            prefix + '_response_rows', 'Rows per executed query', labels,
+            options.get('rows_buckets', DEFAULT_ROWS_BUCKETS)
+        )
+
+    @property
+    def metrics(self):
+        return [self.queries, self.cache_lookups, self.query_duration, self.cache_lookup_duration,
+                self.execute_duration, self.parse_duration, self.cache_write_duration, self.response_rows]
+
+    def labels(self, data_source, query_template):
+        return data_source.name, template_label(query_template, self.max_template_length)
+
+    def on_cache_lookup(self, data_source, query_template, hit, duration_s):
+        labels = self.labels(data_source, query_template)
+        self.cache_lookups.inc(labels + ('hit' if hit else 'miss',))
+        if duration_s is not None:
+            self.cache_lookup_duration.observe(labels, duration_s)
+
+    def on_execute(self, data_source, query_template, duration_s, error=None):
+        self.execute_duration.observe(self.labels(data_source, query_template), duration_s)
+
+    def on_parse(self, data_source, query_template, duration_s, rows):
+        labels = self.labels(data_source, query_template)
+        self.parse_duration.observe(labels, duration_s)
+        self.response_rows.observe(labels, rows)
+
+    def on_cache_write(self, data_source, query_template, duration_s):
+        self.cache_write_duration.observe(self.labels(data_source, query_template), duration_s)
+
+    def on_query(self, data_source, query_template, duration_s, cached, error=None):
+        labels = self.labels(data_source, query_template)
+        result = 'error' if error is not None else ('hit' if cached else 'miss')
+        self.queries.inc(labels + (result,))
+        self.query_duration.observe(labels + ('true' if cached else 'false',), duration_s)
+
+    def expose(self):
+        """
+        :return: Metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+    def slowest_queries(self, limit=10):
+        """
+        :return: List of (data_source, query, executions, mean execution seconds) tuples, slowest first
+        """
+        stats = []
+        for labels, series in list(self.execute_duration._values.items()):
+            executions = sum(series[0])
+            stats.append(labels + (executions, series[1] / executions))
+        return sorted(stats, key=lambda s: s[3], reverse=True)[:limit]
+
+    def cache_hit_ratios(self, limit=10):
+        """
+        :return: List of (data_source, query, lookups, hit ratio) tuples, with the most cache-hostile queries first
+        """
+        lookups = {}
+        for (data_source, query, result), value in list(self.cache_lookups._values.items()):
+            counts = lookups.setdefault((data_source, query), [0, 0])
+            counts[0] += value
+            if result == 'hit':
+                counts[1] += value
+        stats = [labels + (total, hits / total) for labels, (total, hits) in lookups.items()]
+        return sorted(stats, key=lambda s: (s[3], -s[2]))[:limit]
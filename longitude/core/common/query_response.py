@@ -1,10 +1,122 @@
+from collections.abc import Mapping, Sequence
+
+
+class LongitudeRow(Mapping):
+    """
+    Read-only, dictionary-like view over a row stored as a tuple. The field index is shared by every row of the
+    response, so no per-row dictionary is built. Use dict(row) to get a regular (mutable) dictionary.
+    """
+    __slots__ = ('_values', '_index')
+
+    def __init__(self, values, index):
+        self._values = values
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class LongitudeRows(Sequence):
+    """
+    Read-only sequence of LongitudeRow objects. Row views are created when accessed, not stored.
+    """
+    __slots__ = ('_tuples', '_index')
+
+    def __init__(self, tuples, index):
+        self._tuples = tuples
+        self._index = index
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [LongitudeRow(values, self._index) for values in self._tuples[i]]
+        return LongitudeRow(self._tuples[i], self._index)
+
+    def __len__(self):
+        return len(self._tuples)
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class LongitudeQueryResponse:
-    def __init__(self, rows=None, fields=None, meta=None):
-        self.rows = rows or []
+    def __init__(self, rows=None, fields=None, meta=None, tuples=None):
+        """
+        :param rows: List of rows as dictionaries
+        :param fields: Dictionary of fields, in the same order as the values in the rows
+        :param meta: Dictionary with extra information about the query
+        :param tuples: Rows as tuples/sequences of values, ordered as fields. If given, rows is ignored and the
+            response is kept in compact mode: .rows becomes a read-only view that builds rows on access.
+        """
         self.fields = fields or {}
         self.meta = meta or {}
+        self._tuples = tuples
+        self._rows = None if tuples is not None else (rows or [])
         self._from_cache = False
 
+        # Filled in by the data source and the cache. Used to refresh cached responses before they are gone.
+        self.compute_time_s = None
+        self.expires_at = None
+
+    def __setstate__(self, state):
+        # Responses pickled before compact mode existed store their rows in the 'rows' attribute
+        if 'rows' in state:
+            state['_rows'] = state.pop('rows')
+            state.setdefault('_tuples', None)
+        state.setdefault('compute_time_s', None)
+        state.setdefault('expires_at', None)
+        self.__dict__.update(state)
+
+    @property
+    def is_compact(self):
+        return self._tuples is not None
+
+    @property
+    def rows(self):
+        if self._tuples is not None:
+            return LongitudeRows(self._tuples, self.field_index)
+        return self._rows
+
+    @rows.setter
+    def rows(self, rows):
+        self._rows = rows
+        self._tuples = None
+
+    @property
+    def field_index(self):
+        """Dictionary mapping each field name to its position in the rows."""
+        return {name: i for i, name in enumerate(self.fields)}
+
+    @property
+    def tuples(self):
+        """Rows as tuples of values, ordered as fields."""
+        if self._tuples is not None:
+            return self._tuples
+        return [tuple(row.get(name) for name in self.fields) for row in self._rows]
+
+    def column(self, name):
+        """
+        :param name: Field name
+        :return: List with the values of that field in every row
+        """
+        if self._tuples is not None:
+            position = self.field_index[name]
+            return [values[position] for values in self._tuples]
+        return [row[name] for row in self._rows]
+
     @property
     def from_cache(self):
         return self._from_cache
@@ -0,0 +1,197 @@
+"""
+Client-side rate limiting with token buckets, so bursts of requests are spread over time instead of being rejected by
+the server (i.e. Carto SQL API quotas).
+
+Requests reserve a token and wait until it is available, in arrival order. If the wait would be longer than allowed,
+the request is shed with LongitudeRateLimitExceeded without reserving anything.
+
+Buckets live in the process, shared by the data sources with the same key, or in Redis (through a RedisCache), shared
+by every process. If Redis fails, the process bucket is used meanwhile.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from .exceptions import LongitudeRateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+# Reserves tokens in a bucket stored as a hash (tokens, ts). The clock of the Redis server is used, so every process
+# agrees on it. Tokens can go below zero: that is the debt of the requests already waiting for them.
+# Returns {granted (1 or 0), seconds to wait}, as strings because Redis truncates Lua numbers to integers.
+REDIS_TOKEN_BUCKET_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens < requested then
+    wait = (requested - tokens) / rate
+end
+if max_wait >= 0 and wait > max_wait then
+    return {'0', tostring(wait)}
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - requested), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst / rate + wait) * 1000) + 1000)
+return {'1', tostring(wait)}
+"""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket in the process.
+    """
+
+    def __init__(self, rate_per_s, burst):
+        """
+        :param rate_per_s: Tokens added per second
+        :param burst: Maximum number of tokens
+        """
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self._tokens = burst
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1, max_wait_s=None):
+        """
+        :return: Seconds to wait before using the reserved tokens, or None if the wait would exceed max_wait_s (and
+            nothing was reserved)
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._ts) * self.rate_per_s)
+            self._ts = now
+            wait = max(0, (tokens - self._tokens) / self.rate_per_s)
+            if max_wait_s is not None and wait > max_wait_s:
+                return None
+            self._tokens -= tokens
+            return wait
+
+
+class RedisTokenBucket:
+    """
+    Token bucket in Redis, shared by every process using the same key.
+    """
+
+    def __init__(self, redis_cache, key, rate_per_s, burst):
+        """
+        :param redis_cache: RedisCache whose server stores the bucket. The key is put in its namespace.
+        """
+        self.redis_cache = redis_cache
+        self.key = redis_cache.namespaced(key)
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+
+    def _args(self, tokens, max_wait_s):
+        return [self.rate_per_s, self.burst, tokens, -1 if max_wait_s is None else max_wait_s]
+
+    @staticmethod
+    def _parse(result):
+        granted, wait = result
+        return float(wait) if int(granted) else None
+
+    def reserve(self, tokens=1, max_wait_s=None):
+        return self._parse(
+            self.redis_cache.run_script(REDIS_TOKEN_BUCKET_SCRIPT, [self.key], self._args(tokens, max_wait_s))
+        )
+
+    async def reserve_async(self, tokens=1, max_wait_s=None):
+        return self._parse(await self.redis_cache.run_script_async(
+            REDIS_TOKEN_BUCKET_SCRIPT, [self.key], self._args(tokens, max_wait_s)
+        ))
+
+
+_local_buckets = {}
+_local_buckets_lock = threading.Lock()
+
+
+def local_bucket(key, rate_per_s, burst):
+    """
+    :return: The token bucket of the process for this key and configuration
+    """
+    with _local_buckets_lock:
+        bucket_key = (key, rate_per_s, burst)
+        if bucket_key not in _local_buckets:
+            _local_buckets[bucket_key] = TokenBucket(rate_per_s, burst)
+        return _local_buckets[bucket_key]
+
+
+class RateLimiter:
+    def __init__(self, options, key):
+        """
+        :param key: Identifies the quota (i.e. the Carto user). Limiters with the same key share their bucket.
+        :param rate_limit_per_s: Requests allowed per second. None (default) disables the limiter.
+        :param rate_limit_burst: Requests allowed at once after some idle time (default: rate_limit_per_s, at least 1)
+        :param rate_limit_max_wait_s: Maximum seconds a request waits for its turn. Requests that would wait longer
+            fail at once with LongitudeRateLimitExceeded. None (default) waits as needed.
+        :param rate_limit_key: Overrides the key, i.e. to share a quota between users or to split it by API key
+        :param rate_limit_redis: RedisCache to share the bucket between processes. None (default) keeps it in the
+            process.
+        """
+        self.rate_per_s = options.get('rate_limit_per_s')
+        self.burst = options.get('rate_limit_burst') or max(1, self.rate_per_s or 1)
+        self.max_wait_s = options.get('rate_limit_max_wait_s')
+        self.key = 'rate_limit:%s' % options.get('rate_limit_key', key)
+        self._local = None
+        self._redis = None
+        if self.rate_per_s:
+            self._local = local_bucket(self.key, self.rate_per_s, self.burst)
+            redis_cache = options.get('rate_limit_redis')
+            if redis_cache is not None:
+                self._redis = RedisTokenBucket(redis_cache, self.key, self.rate_per_s, self.burst)
+
+    def __bool__(self):
+        return bool(self.rate_per_s)
+
+    def _reserve(self):
+        if self._redis is not None:
+            try:
+                return self._redis.reserve(max_wait_s=self.max_wait_s)
+            except Exception as e:
+                logger.warning('Shared rate limit is not available, the process one is used: %s' % e)
+        return self._local.reserve(max_wait_s=self.max_wait_s)
+
+    async def _reserve_async(self):
+        if self._redis is not None:
+            try:
+                return await self._redis.reserve_async(max_wait_s=self.max_wait_s)
+            except Exception as e:
+                logger.warning('Shared rate limit is not available, the process one is used: %s' % e)
+        return self._local.reserve(max_wait_s=self.max_wait_s)
+
+    def _shed(self):
+        return LongitudeRateLimitExceeded(
+            'Request to %s would wait more than %s seconds for the rate limit' % (self.key, self.max_wait_s)
+        )
+
+    def acquire(self):
+        """
+        Blocks until the request is allowed
+
+        :raise LongitudeRateLimitExceeded if it would wait more than rate_limit_max_wait_s
+        """
+        if not self.rate_per_s:
+            return
+        wait = self._reserve()
+        if wait is None:
+            raise self._shed()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        if not self.rate_per_s:
+            return
+        wait = await self._reserve_async()
+        if wait is None:
+            raise self._shed()
+        if wait > 0:
+            await asyncio.sleep(wait)
@@ -0,0 +1,201 @@
+"""
+Retries and circuit breaking around the executions of data sources.
+
+Data sources raise LongitudeTransientError for failures that may go away by themselves (dropped connections, rate
+limits, gateway errors...). Those failures are retried, if the query is idempotent, after a jittered exponential
+backoff or after the wait asked by the server (Retry-After). Any other error is raised at once.
+
+The circuit breaker of each data source opens after a number of consecutive transient failures. While open, queries
+fail fast with LongitudeCircuitOpenException instead of waiting for a backend that is down. After a while, a single
+query is let through: the circuit closes again if it succeeds.
+"""
+import asyncio
+import random
+import re
+import threading
+import time
+
+from .exceptions import (LongitudeCircuitOpenException, LongitudeRateLimitExceeded, LongitudeRetriesExceeded,
+                         LongitudeTransientError)
+
+DEFAULT_RETRY_BASE_DELAY_S = 0.1
+DEFAULT_RETRY_MAX_DELAY_S = 10
+DEFAULT_CIRCUIT_RESET_TIMEOUT_S = 30
+
+_READ_QUERY = re.compile(r'^\s*(\(\s*)*(SELECT|WITH|SHOW|EXPLAIN|VALUES|TABLE)\b', re.IGNORECASE)
+_WRITE_KEYWORD = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE|CREATE|DROP|ALTER|TRUNCATE|COPY|INTO)\b', re.IGNORECASE)
+
+
+def is_read_query(query_template):
+    """
+    :return: True if the query only reads data, so it can be executed again safely
+    """
+    query_template = str(query_template)
+    return bool(_READ_QUERY.match(query_template)) and not _WRITE_KEYWORD.search(query_template)
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout_s=DEFAULT_CIRCUIT_RESET_TIMEOUT_S, name=''):
+        """
+        :param failure_threshold: Consecutive transient failures that open the circuit
+        :param reset_timeout_s: Seconds the circuit stays open before letting a query through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.name = name
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        :raise LongitudeCircuitOpenException if the call is not allowed
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout_s:
+                # This call is the trial: the rest keep failing fast until it finishes
+                self.state = self.HALF_OPEN
+                return
+        raise LongitudeCircuitOpenException(
+            'Circuit of %s is open after %s consecutive failures' % (self.name, self._failures)
+        )
+
+    def on_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def on_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def on_abort(self):
+        # A call ended without telling anything about the backend (i.e. cancelled): a trial must be made again later
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class Resilience:
+    def __init__(self, options, name=''):
+        """
+        :param query_retries: Times an idempotent query failed by a transient error is executed again (default: 0)
+        :param retry_base_delay_s: Maximum wait before the first retry (default: 0.1). The maximum doubles for each
+            retry, and the wait is random between 0 and it.
+        :param retry_max_delay_s: Maximum wait between retries (default: 10). If the server asks for a longer wait, the
+            query fails at once with LongitudeRetriesExceeded instead of blocking.
+        :param circuit_failure_threshold: Consecutive transient failures that open the circuit. None (default) disables
+            the circuit breaker.
+        :param circuit_reset_timeout_s: Seconds the circuit stays open before letting a query through (default: 30)
+        """
+        self.retries = options.get('query_retries', 0)
+        self.base_delay_s = options.get('retry_base_delay_s', DEFAULT_RETRY_BASE_DELAY_S)
+        self.max_delay_s = options.get('retry_max_delay_s', DEFAULT_RETRY_MAX_DELAY_S)
+        self.circuit = None
+        failure_threshold = options.get('circuit_failure_threshold')
+        if failure_threshold:
+            self.circuit = CircuitBreaker(
+                failure_threshold, options.get('circuit_reset_timeout_s', DEFAULT_CIRCUIT_RESET_TIMEOUT_S), name
+            )
+
+    def __bool__(self):
+        return bool(self.retries or self.circuit)
+
+    def _delay_s(self, attempt, error, idempotent):
+        """
+        :return: Seconds to wait before the next attempt
+        :raise The error, or LongitudeRetriesExceeded, if there are no more attempts
+        """
+        if not idempotent or not self.retries:
+            raise error
+        if attempt >= self.retries:
+            raise LongitudeRetriesExceeded('Query failed after %s retries: %s' % (self.retries, error)) from error
+        if error.retry_after_s is not None:
+            if error.retry_after_s > self.max_delay_s:
+                raise LongitudeRetriesExceeded(
+                    'Server asked to retry after %s seconds: %s' % (error.retry_after_s, error)
+                ) from error
+            return error.retry_after_s
+        return random.uniform(0, min(self.max_delay_s, self.base_delay_s * 2 ** attempt))
+
+    def _before_call(self):
+        if self.circuit:
+            self.circuit.before_call()
+
+    def _on_success(self):
+        if self.circuit:
+            self.circuit.on_success()
+
+    def _on_failure(self):
+        if self.circuit:
+            self.circuit.on_failure()
+
+    def _on_abort(self):
+        if self.circuit:
+            self.circuit.on_abort()
+
+    def call(self, fn, idempotent=True):
+        """
+        :param fn: Function executing the query
+        :param idempotent: If False, transient errors are not retried (but still count for the circuit)
+        """
+        attempt = 0
+        while True:
+            self._before_call()
+            try:
+                result = fn()
+            except LongitudeTransientError as e:
+                self._on_failure()
+                time.sleep(self._delay_s(attempt, e, idempotent))
+                attempt += 1
+                continue
+            except LongitudeRateLimitExceeded:
+                # Shed by the client-side rate limit: the backend was not reached
+                self._on_abort()
+                raise
+            except Exception:
+                # The backend answered: it is up, even if the query was wrong
+                self._on_success()
+                raise
+            except BaseException:
+                self._on_abort()
+                raise
+            self._on_success()
+            return result
+
+    async def call_async(self, fn, idempotent=True):
+        """
+        Asynchronous version of .call(...). fn returns an awaitable.
+        """
+        attempt = 0
+        while True:
+            self._before_call()
+            try:
+                result = await fn()
+            except LongitudeTransientError as e:
+                self._on_failure()
+                await asyncio.sleep(self._delay_s(attempt, e, idempotent))
+                attempt += 1
+                continue
+            except LongitudeRateLimitExceeded:
+                self._on_abort()
+                raise
+            except Exception:
+                self._on_success()
+                raise
+            except BaseException:
+                self._on_abort()
+                raise
+            self._on_success()
+            return result
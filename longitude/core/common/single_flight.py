@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: while a call for a key is in flight, other threads asking for the
+    same key wait for it and get its result (or its exception) instead of running the function again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key, fn):
+        """
+        :param key: Hashable key identifying the call
+        :param fn: Function without arguments to execute if no call for key is in flight
+        :return: Result of fn, either from this call or from the one in flight
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class _LeaderCancelled(Exception):
+    """
+    Given to the followers of a cancelled call, so one of them runs it again
+    """
+
+
+class AsyncSingleFlight:
+    """
+    Asyncio version of SingleFlight: concurrent coroutines asking for the same key await the one in flight.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def in_flight(self, key):
+        return key in self._calls
+
+    async def do(self, key, coro_fn):
+        """
+        :param key: Hashable key identifying the call
+        :param coro_fn: Coroutine function without arguments to await if no call for key is in flight
+        :return: Result of coro_fn, either from this call or from the one in flight
+        """
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                return await self._lead(key, coro_fn)
+            try:
+                # Shielded, so a cancelled follower does not cancel the call for everybody else
+                return await asyncio.shield(future)
+            except _LeaderCancelled:
+                # Only the leader was cancelled: the first follower to wake up runs the call again
+                continue
+
+    async def _lead(self, key, coro_fn):
+        future = asyncio.get_running_loop().create_future()
+        # Avoids 'exception was never retrieved' warnings when nobody else was waiting
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        try:
+            result = await coro_fn()
+        except asyncio.CancelledError:
+            future.set_exception(_LeaderCancelled())
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
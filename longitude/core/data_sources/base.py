@@ -1,7 +1,14 @@
 import logging
 import os
+import threading
+import time
 
 from ..caches.base import LongitudeCache
+from ..common.instrumentation import Instrumentation
+from ..common.resilience import Resilience, is_read_query
+from ..common.single_flight import SingleFlight
+from .copy_pipeline import (DEFAULT_CHUNK_ROWS, DEFAULT_CHUNK_SIZE_BYTES, encode_rows, parse_csv_header,
+                            run_copy_pipeline, split_csv)
 from ..common.exceptions import (LongitudeQueryCannotBeExecutedException,  # noqa
                                  LongitudeRetriesExceeded)
 
@@ -12,10 +19,27 @@ class DataSource():
         """Base class to create an instance of a data source. This class is used as
         base class for specific interfaces.
         :param cache: Object. Must be a LongitudeCache subclass.
+        :param fetch_size: Rows fetched per round trip when streaming results with .query_iter(...)
+        :param compact_rows: If True, data sources that read rows as tuples keep them that way in the response
+            instead of building a dictionary per row (see LongitudeQueryResponse)
+        :param coalesce_misses: If True (default), concurrent cache misses for the same query are executed only once
+            and every caller gets the same response object
+        :param name: Name of the data source in the metrics and events of observers (default: the class name)
+        :param observers: List of QueryObserver objects notified of the cache lookups, executions, parses and cache
+            writes of the queries (see common.instrumentation)
+        :param query_retries: Times an idempotent query failed by a transient error is executed again (default: 0).
+            See the rest of retry and circuit breaker options in common.resilience.Resilience.
         """
         self.log = logging.getLogger(self.__class__.__module__)
+        self.name = options.get('name', self.__class__.__name__)
+        self._instrumentation = Instrumentation(options.get('observers'))
+        self._resilience = Resilience(options, self.name)
         self._cache = options.get('cache')
         self._use_cache = (True and self._cache)
+        self.fetch_size = options.get('fetch_size', 1000)
+        self.compact_rows = options.get('compact_rows', False)
+        self._coalesce_misses = options.get('coalesce_misses', True)
+        self._single_flight = SingleFlight()
 
         if self._cache:
             if not isinstance(self._cache, LongitudeCache):
@@ -30,8 +54,15 @@ class DataSource():
     def disable_cache(self):
         self._use_cache = False
 
+    @property
+    def thread_safe(self):
+        """
+        Whether queries can run at the same time from several threads (i.e. in common.fan_out)
+        """
+        return True
+
     def query(self, query_template, params=None, cache=True, expiration_time_s=None,
-              query_config=None, **opts):
+              query_config=None, cache_tags=None, **opts):
         """
         This method has to be called to interact with the data source. Each children class will
         have to implement its own .execute_query(...) with the specific behavior for each interface.
@@ -43,37 +74,229 @@ class DataSource():
         :param expiration_time_s: If using cache and cache supports expiration, amount of seconds
             for the payload to be stored
         :param query_config: Specific query configuration. If None, the default one will be used.
+        :param cache_tags: If using cache, tags (i.e. names of the tables read by the query) to invalidate the
+            cached response later with .invalidate_cache_tags(...)
+        :param idempotent: Whether the query can be retried after a transient error. If None (default), only
+            queries that read data (i.e. SELECT) are retried.
         :param opts:
         :return: Result of querying the database
         """
         if params is None:
             params = {}
 
-        response = None
-        if self._cache and self._use_cache and cache:
-            response = self._cache.get(query_template, params)
+        if not self._instrumentation:
+            return self._query(query_template, params, cache, expiration_time_s, query_config, cache_tags, **opts)
 
-        if response:
-            response.mark_as_cached()
-        else:
-            response = self.execute_query(
+        start = time.monotonic()
+        try:
+            response = self._query(query_template, params, cache, expiration_time_s, query_config, cache_tags, **opts)
+        except Exception as e:
+            self._emit_query(query_template, start, None, error=e)
+            raise
+        self._emit_query(query_template, start, response)
+        return response
+
+    def _query(self, query_template, params, cache, expiration_time_s, query_config, cache_tags, **opts):
+        use_cache = self._uses_cache(cache)
+        if use_cache:
+            response = self._cache_get(query_template, params)
+            if response:
+                return self._serve_cached(response, query_template, params, expiration_time_s, query_config,
+                                          cache_tags=cache_tags, **opts)
+
+        return self._query_miss(query_template, params, use_cache, expiration_time_s, query_config,
+                                cache_tags=cache_tags, **opts)
+
+    def _cache_get(self, query_template, params):
+        if not self._instrumentation:
+            return self._cache.get(query_template, params)
+
+        start = time.monotonic()
+        response = self._cache.get(query_template, params)
+        self._instrumentation.emit('on_cache_lookup', self, query_template, bool(response), time.monotonic() - start)
+        return response
+
+    def _emit_query(self, query_template, start, response, error=None):
+        cached = response is not None and response.from_cache
+        self._instrumentation.emit('on_query', self, query_template, time.monotonic() - start, cached, error=error)
+
+    def _uses_cache(self, cache=True):
+        return bool(self._cache and self._use_cache and cache)
+
+    def _serve_cached(self, response, query_template, params, expiration_time_s=None, query_config=None,
+                      cache_tags=None, **opts):
+        response.mark_as_cached()
+        if self._cache.needs_refresh(response):
+            # Stale (or about to be): it is served as it is and refreshed for the next callers
+            self._refresh_in_background(query_template, params, expiration_time_s, query_config,
+                                        cache_tags=cache_tags, **opts)
+        return response
+
+    def _query_miss(self, query_template, params, use_cache, expiration_time_s=None, query_config=None,
+                    cache_tags=None, **opts):
+        def execute():
+            return self._execute_and_cache(query_template, params, use_cache, expiration_time_s, query_config,
+                                           cache_tags=cache_tags, **opts)
+
+        if use_cache and self._coalesce_misses:
+            # Concurrent misses of the same query wait for a single execution and share its response
+            return self._single_flight.do(self._cache_key(query_template, params), execute)
+        return execute()
+
+    def _cache_key(self, query_template, params):
+        return self._cache.cache_key(query_template, params)
+
+    def _refresh_in_background(self, query_template, params, expiration_time_s, query_config, cache_tags=None,
+                               **opts):
+        key = self._cache_key(query_template, params)
+        if self._single_flight.in_flight(key):
+            return
+
+        def refresh():
+            try:
+                self._single_flight.do(key, lambda: self._execute_and_cache(
+                    query_template, params, True, expiration_time_s, query_config, cache_tags=cache_tags, **opts
+                ))
+            except Exception as e:
+                self.log.warning('Background refresh of cached query failed: %s' % e)
+
+        if not self.thread_safe:
+            # A thread would share the connection with the next queries of the caller: it is refreshed right away
+            refresh()
+            return
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def query_many(self, queries, cache=True, expiration_time_s=None, query_config=None, **opts):
+        """
+        Batch version of .query(...). Cached responses are read in a single round trip (if the cache supports it),
+        only the misses are executed and their responses are written back to the cache in another one.
+
+        :param queries: List of (query_template, params) tuples. Params can be None.
+        :param cache: Boolean to indicate if these queries should use cache or not (default: True)
+        :param expiration_time_s: If using cache and cache supports expiration, amount of seconds
+            for the payloads to be stored
+        :param query_config: Specific query configuration. If None, the default one will be used.
+        :param opts:
+        :return: List of responses, in the same order as queries
+        """
+        queries = self._normalize_queries(queries)
+        use_cache = self._uses_cache(cache)
+        cached = self._cache.get_many(queries) if use_cache else None
+        responses, misses = self._resolve_cached(queries, cached, expiration_time_s, query_config, **opts)
+
+        executed = []
+        for indexes in misses:
+            query_template, params = queries[indexes[0]]
+            response = self._execute(query_template, params, query_config, **opts)
+            for i in indexes:
+                responses[i] = response
+            executed.append((query_template, params, response))
+
+        if use_cache and executed:
+            self._cache.put_many(executed, expiration_time_s=expiration_time_s)
+        return responses
+
+    @staticmethod
+    def _normalize_queries(queries):
+        return [(query_template, params if params is not None else {}) for query_template, params in queries]
+
+    def _resolve_cached(self, queries, cached, expiration_time_s, query_config, **opts):
+        """
+        Common part of the batch queries: marks the cached responses (refreshing them if needed) and groups the
+        misses, so repeated queries are executed once.
+
+        :param cached: Responses from the cache for each query. None if the cache is not used.
+        :return: Tuple (list of responses with None for misses, list of lists of indexes of missed queries)
+        """
+        responses = cached or [None] * len(queries)
+        if cached is not None:
+            for (query_template, params), response in zip(queries, responses):
+                if self._instrumentation:
+                    self._instrumentation.emit('on_cache_lookup', self, query_template, bool(response), None)
+                if response:
+                    self._serve_cached(response, query_template, params, expiration_time_s, query_config, **opts)
+
+        misses = {}
+        for i, (query_template, params) in enumerate(queries):
+            if not responses[i]:
+                key = self._cache_key(query_template, params) if cached is not None else i
+                misses.setdefault(key, []).append(i)
+        return responses, list(misses.values())
+
+    def _execute(self, query_template, params, query_config, idempotent=None, **opts):
+        def execute_query():
+            return self.execute_query(
                 query_template=query_template,
                 params=params,
                 query_config=query_config,
                 **opts
             )
 
-            response = self.parse_response(response)
-            if self._cache and self._use_cache and cache:
-                self._cache.put(
-                    query_template,
-                    payload=response,
-                    query_params=params,
-                    expiration_time_s=expiration_time_s
-                )
+        start = time.monotonic()
+        try:
+            if self._resilience:
+                response = self._resilience.call(execute_query, self._is_idempotent(query_template, idempotent))
+            else:
+                response = execute_query()
+        except Exception as e:
+            self._emit_execute(query_template, start, error=e)
+            raise
+        return self._parse(query_template, response, start)
+
+    @staticmethod
+    def _is_idempotent(query_template, idempotent):
+        return is_read_query(query_template) if idempotent is None else idempotent
 
+    def _emit_execute(self, query_template, start, error=None):
+        if self._instrumentation:
+            self._instrumentation.emit('on_execute', self, query_template, time.monotonic() - start, error=error)
+
+    def _parse(self, query_template, response, start):
+        # Common part of the synchronous and asynchronous executions, once the data source has answered
+        self._emit_execute(query_template, start)
+        parse_start = time.monotonic()
+        response = self.parse_response(response)
+        end = time.monotonic()
+        if response is not None:
+            response.compute_time_s = end - start
+        if self._instrumentation:
+            rows = len(response.rows) if response is not None else 0
+            self._instrumentation.emit('on_parse', self, query_template, end - parse_start, rows)
         return response
 
+    def _execute_and_cache(self, query_template, params, use_cache, expiration_time_s, query_config,
+                           cache_tags=None, **opts):
+        response = self._execute(query_template, params, query_config, **opts)
+        if use_cache:
+            start = time.monotonic()
+            self._cache.put(
+                query_template,
+                payload=response,
+                query_params=params,
+                expiration_time_s=expiration_time_s,
+                tags=cache_tags
+            )
+            self._emit_cache_write(query_template, start)
+        return response
+
+    def _emit_cache_write(self, query_template, start):
+        if self._instrumentation:
+            self._instrumentation.emit('on_cache_write', self, query_template, time.monotonic() - start)
+
+    def query_iter(self, query_template, params=None, fetch_size=None, batches=False, **opts):
+        """
+        Streaming alternative to .query(...) for big result sets. Rows are fetched from the data source in chunks
+        of fetch_size rows, so memory usage does not depend on the size of the result. The cache is never used.
+
+        :param query_template: Unformatted SQL query
+        :param params: Values to be passed to the query when formatting it
+        :param fetch_size: Rows fetched per round trip. If None, the 'fetch_size' option is used (default: 1000)
+        :param batches: If True, lists of up to fetch_size rows are yielded instead of single rows
+        :param opts:
+        :return: Generator of rows (dictionaries) or of lists of rows
+        """
+        raise NotImplementedError
+
     def execute_query(self, query_template, params, query_config, **opts):
         """
         :raise LongitudeQueryCannotBeExecutedException
@@ -95,21 +318,76 @@ class DataSource():
         if self._cache:
             self._cache.flush()
 
-    def copy_from_csv(self, csv_file_absolute_path, to_table=None):
+    def invalidate_cache_tags(self, tags):
+        """
+        Removes from the cache every response queried with any of the tags (see the cache_tags argument of .query)
+
+        :param tags: List of tags
+        :return: Number of removed responses
+        """
+        if self._cache:
+            return self._cache.invalidate_tags(tags)
+        return 0
+
+    def copy_from_csv(self, csv_file_absolute_path, to_table=None, chunk_size_bytes=None, workers=1, retries=0,
+                      progress_callback=None):
         """
         This method pushes the content of the csv file into the desired table.
 
         CSV File MUST have header and delimiter must be ',' (comma)
 
+        If chunk_size_bytes is given or workers is greater than 1, the file is split in chunks that are copied in
+        parallel, each one in its own transaction (see copy_pipeline). Otherwise, the file is copied at once.
+
         :param csv_file_absolute_path:
         :param to_table:
-        :return:
+        :param chunk_size_bytes: Approximate size of the chunks (default for chunked copies: 16 MiB)
+        :param workers: Number of chunks copied at the same time, over different connections
+        :param retries: Times a failed chunk is copied again before failing the load
+        :param progress_callback: Function called with the metrics of the load after each copied chunk
+        :return: Metrics of the load (chunks, rows, bytes, retries, elapsed_s, rows_per_s, bytes_per_s) for chunked
+            copies. The response of the data source otherwise.
         """
 
         with open(csv_file_absolute_path, 'rb') as f:
             if to_table is None:
                 to_table = os.path.basename(csv_file_absolute_path)
-            return self.copy_from(data=f, filepath=csv_file_absolute_path, to_table=to_table)
+            if chunk_size_bytes is None and workers <= 1:
+                return self.copy_from(data=f, filepath=csv_file_absolute_path, to_table=to_table)
+
+            columns = parse_csv_header(f.readline())
+            return run_copy_pipeline(
+                lambda data: self.copy_chunk(data, to_table, columns),
+                split_csv(f, chunk_size_bytes or DEFAULT_CHUNK_SIZE_BYTES),
+                workers=workers,
+                retries=retries,
+                progress_callback=progress_callback
+            )
+
+    def copy_from_rows(self, rows, to_table, columns, chunk_rows=DEFAULT_CHUNK_ROWS, workers=1, retries=0,
+                       progress_callback=None):
+        """
+        Pushes rows (i.e. from a generator) into a table, in chunks copied in parallel. See .copy_from_csv(...)
+
+        :param rows: Iterable of sequences of values, in the order of the columns. None values are loaded as NULL.
+        :param columns: List of column names
+        :param chunk_rows: Rows per chunk
+        :return: Metrics of the load
+        """
+        return run_copy_pipeline(
+            lambda data: self.copy_chunk(data, to_table, columns),
+            encode_rows(rows, chunk_rows),
+            workers=workers,
+            retries=retries,
+            progress_callback=progress_callback
+        )
+
+    def copy_chunk(self, data, to_table, columns):
+        """
+        Copies a chunk of CSV data (bytes, without header) into a table, in its own connection and transaction. It is
+        called from several threads at the same time.
+        """
+        raise NotImplementedError
 
     def copy_from(self, data, filepath, to_table):
         raise NotImplementedError
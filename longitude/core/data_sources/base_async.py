@@ -1,10 +1,20 @@
+import asyncio
+import time
+
+from ..common.single_flight import AsyncSingleFlight
 from .base import DataSource
 
 
 class AsyncDataSource(DataSource):
 
+    def __init__(self, options={}):
+        super().__init__(options)
+        self._single_flight = AsyncSingleFlight()
+        # Strong references to background refreshes, so they are not garbage collected while running
+        self._background_tasks = set()
+
     async def query(self, query_template, params=None, cache=True, expiration_time_s=None,
-                    query_config=None, **opts):
+                    query_config=None, cache_tags=None, **opts):
         """
         This method has to be called to interact with the data source. Each children class will
         have to implement its own .execute_query(...) with the specific behavior for each interface.
@@ -16,33 +26,142 @@ class AsyncDataSource(DataSource):
         :param expiration_time_s: If using cache and cache supports expiration, amount of seconds
             for the payload to be stored
         :param query_config: Specific query configuration. If None, the default one will be used.
+        :param cache_tags: If using cache, tags (i.e. names of the tables read by the query) to invalidate the
+            cached response later with .invalidate_cache_tags(...)
         :param opts:
         :return: Result of querying the database
         """
         if params is None:
             params = {}
 
-        response = None
-        if self._cache and self._use_cache and cache:
-            response = await self._cache.get_async(query_template, params)
+        if not self._instrumentation:
+            return await self._query(query_template, params, cache, expiration_time_s, query_config, cache_tags,
+                                     **opts)
+
+        start = time.monotonic()
+        try:
+            response = await self._query(query_template, params, cache, expiration_time_s, query_config, cache_tags,
+                                         **opts)
+        except Exception as e:
+            self._emit_query(query_template, start, None, error=e)
+            raise
+        self._emit_query(query_template, start, response)
+        return response
+
+    async def _query(self, query_template, params, cache, expiration_time_s, query_config, cache_tags, **opts):
+        use_cache = self._uses_cache(cache)
+        if use_cache:
+            response = await self._cache_get(query_template, params)
+            if response:
+                return self._serve_cached(response, query_template, params, expiration_time_s, query_config,
+                                          cache_tags=cache_tags, **opts)
+
+        return await self._query_miss(query_template, params, use_cache, expiration_time_s, query_config,
+                                      cache_tags=cache_tags, **opts)
+
+    async def _cache_get(self, query_template, params):
+        if not self._instrumentation:
+            return await self._cache.get_async(query_template, params)
+
+        start = time.monotonic()
+        response = await self._cache.get_async(query_template, params)
+        self._instrumentation.emit('on_cache_lookup', self, query_template, bool(response), time.monotonic() - start)
+        return response
+
+    async def _query_miss(self, query_template, params, use_cache, expiration_time_s=None, query_config=None,
+                          cache_tags=None, **opts):
+        def execute():
+            return self._execute_and_cache(query_template, params, use_cache, expiration_time_s, query_config,
+                                           cache_tags=cache_tags, **opts)
+
+        if use_cache and self._coalesce_misses:
+            # Concurrent misses of the same query await a single execution and share its response
+            return await self._single_flight.do(self._cache_key(query_template, params), execute)
+        return await execute()
+
+    def _refresh_in_background(self, query_template, params, expiration_time_s, query_config, cache_tags=None,
+                               **opts):
+        key = self._cache_key(query_template, params)
+        if self._single_flight.in_flight(key):
+            return
 
-        if response:
-            response.mark_as_cached()
-        else:
-            response = await self.execute_query(
+        async def refresh():
+            try:
+                await self._single_flight.do(key, lambda: self._execute_and_cache(
+                    query_template, params, True, expiration_time_s, query_config, cache_tags=cache_tags, **opts
+                ))
+            except Exception as e:
+                self.log.warning('Background refresh of cached query failed: %s' % e)
+
+        task = asyncio.ensure_future(refresh())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def query_many(self, queries, cache=True, expiration_time_s=None, query_config=None, **opts):
+        """
+        Batch version of .query(...). Cached responses are read in a single round trip (if the cache supports it),
+        only the misses are executed (concurrently) and their responses are written back to the cache in another one.
+
+        :param queries: List of (query_template, params) tuples. Params can be None.
+        :return: List of responses, in the same order as queries
+        """
+        queries = self._normalize_queries(queries)
+        use_cache = self._uses_cache(cache)
+        cached = await self._cache.get_many_async(queries) if use_cache else None
+        responses, misses = self._resolve_cached(queries, cached, expiration_time_s, query_config, **opts)
+
+        executed = await asyncio.gather(*[
+            self._execute(*queries[indexes[0]], query_config, **opts) for indexes in misses
+        ])
+        for indexes, response in zip(misses, executed):
+            for i in indexes:
+                responses[i] = response
+
+        if use_cache and executed:
+            await self._cache.put_many_async(
+                [queries[indexes[0]] + (response,) for indexes, response in zip(misses, executed)],
+                expiration_time_s=expiration_time_s
+            )
+        return responses
+
+    async def _execute(self, query_template, params, query_config, idempotent=None, **opts):
+        def execute_query():
+            return self.execute_query(
                 query_template=query_template,
                 params=params,
                 query_config=query_config,
                 **opts
             )
 
-            response = self.parse_response(response)
-            if self._cache and self._use_cache and cache:
-                await self._cache.put_async(
-                    query_template,
-                    payload=response,
-                    query_params=params,
-                    expiration_time_s=expiration_time_s
+        start = time.monotonic()
+        try:
+            if self._resilience:
+                response = await self._resilience.call_async(
+                    execute_query, self._is_idempotent(query_template, idempotent)
                 )
+            else:
+                response = await execute_query()
+        except Exception as e:
+            self._emit_execute(query_template, start, error=e)
+            raise
+        return self._parse(query_template, response, start)
 
+    async def _execute_and_cache(self, query_template, params, use_cache, expiration_time_s, query_config,
+                                 cache_tags=None, **opts):
+        response = await self._execute(query_template, params, query_config, **opts)
+        if use_cache:
+            start = time.monotonic()
+            await self._cache.put_async(
+                query_template,
+                payload=response,
+                query_params=params,
+                expiration_time_s=expiration_time_s,
+                tags=cache_tags
+            )
+            self._emit_cache_write(query_template, start)
         return response
+
+    async def invalidate_cache_tags(self, tags):
+        if self._cache:
+            return await self._cache.invalidate_tags_async(tags)
+        return 0
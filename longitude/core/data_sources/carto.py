@@ -1,10 +1,17 @@
+import time
+
 import cartoframes
 from carto.auth import APIKeyAuthClient
 from carto.exceptions import CartoException
-from carto.sql import BatchSQLClient, SQLClient
+from carto.sql import BatchSQLClient, CopySQLClient, SQLClient
 
 from ..common.query_response import LongitudeQueryResponse
-from .base import DataSource, LongitudeQueryCannotBeExecutedException
+from ..common.rate_limit import RateLimiter
+from .base import DataSource
+from .carto_batch import BatchOptions, check_job, is_batch_job, is_pending, job_response, timeout_error
+from .carto_export import DEFAULT_CHUNK_SIZE, CsvRowsParser, batched, copy_to_query
+from .carto_http import HttpOptions, carto_error, http_error, shared_session
+from .copy_pipeline import copy_from_query, parse_csv_header
 
 
 class CartoDataSource(DataSource):
@@ -13,6 +20,15 @@ class CartoDataSource(DataSource):
     DEFAULT_API_VERSION = 'v2'
 
     def __init__(self, user, api_key, options={}):
+        """
+        :param batch: If True, .query(...) runs queries as Batch SQL API jobs and waits for them. Responses have no rows
+            but the job information as meta. See also the options in carto_batch.BatchOptions.
+        :param session: requests.Session used by every Carto client. If None (default), a session shared by the data
+            sources with the same HTTP options is used. See the options in carto_http.HttpOptions.
+        :param rate_limit_per_s: Requests per second sent to Carto. Requests over the limit wait for their turn instead
+            of being rejected by Carto. The limit is per user, unless rate_limit_key is given, and it is shared across
+            processes if rate_limit_redis (a RedisCache) is given. See the options in rate_limit.RateLimiter.
+        """
         super().__init__(options)
 
         self.do_post = options.get('do_post', False)
@@ -21,10 +37,13 @@ class CartoDataSource(DataSource):
         self.base_url_option = options.get('base_url', '')
         self.api_version = options.get('api_version', self.DEFAULT_API_VERSION)
         self.batch = options.get('batch', False)
+        self.batch_options = BatchOptions(options)
 
         self.user = user
         self.api_key = api_key
         self.base_url = self._generate_base_url(user, self.base_url_option)
+        self.session = options.get('session') or shared_session(HttpOptions(options))
+        self.rate_limiter = RateLimiter(options, user)
 
         # Carto Context for DataFrame handling
         self._carto_context = None
@@ -32,12 +51,12 @@ class CartoDataSource(DataSource):
         # Carto client for COPYs
         self._copy_client = None
 
-        self._auth_client = APIKeyAuthClient(api_key=api_key, base_url=self.base_url)
+        self._auth_client = APIKeyAuthClient(api_key=api_key, base_url=self.base_url, session=self.session)
         self._sql_client = SQLClient(self._auth_client, api_version=self.api_version)
 
         self._batch_client = None
         if self.batch:
-            self._batch_client = BatchSQLClient(self._auth_client)
+            self._batch_client = BatchSQLClient(self._auth_client, api_version=self.api_version)
 
     @property
     def cc(self):
@@ -45,13 +64,10 @@ class CartoDataSource(DataSource):
         Creates and returns a CartoContext object to work with Panda Dataframes
         :return:
         """
-        # TODO: The CartoContext documentaton says that SSL must be disabled sometimes if an on
-        #  premise host is used.
-        #  We are not taking this into account. It would need to create a requests.Session()
-        #  object, set its SSL to false and pass it to the CartoContext init.
+        # It shares the session of the rest of clients, so the verify_ssl option applies to it too
         if self._carto_context is None:
             self._carto_context = cartoframes.CartoContext(
-                base_url=self.base_url, api_key=self.api_key
+                base_url=self.base_url, api_key=self.api_key, session=self.session
             )
         return self._carto_context
 
@@ -62,7 +78,18 @@ class CartoDataSource(DataSource):
             base_url = self.SUBDOMAIN_URL_PATTERN % user
         return base_url
 
-    def execute_query(self, query_template, params, query_config, **opts):
+    @property
+    def batch_client(self):
+        if self._batch_client is None:
+            self._batch_client = BatchSQLClient(self._auth_client, api_version=self.api_version)
+        return self._batch_client
+
+    def _uses_cache(self, cache=True):
+        # Batch responses are the metadata of a job: caching them would skip running the job again
+        return not self.batch and super()._uses_cache(cache)
+
+    @staticmethod
+    def _format_query(query_template, params):
         # TODO: Here we are parsing the parameters and taking responsability for it. We do not make
         #  any safe parsing as this will be used in a backend-to-backend context and we build our
         #  own queries.
@@ -77,8 +104,14 @@ class CartoDataSource(DataSource):
         #  the server:
         #   https://github.com/CartoDB/Geographica-Product-Coordination/issues/57
         params = {k: "'" + v + "'" for k, v in params.items()}
-        formatted_query = query_template % params
+        return query_template % params
+
+    def execute_query(self, query_template, params, query_config, **opts):
+        formatted_query = self._format_query(query_template, params)
+        if self.batch:
+            return self._run_batch_jobs([formatted_query])[0]
 
+        self.rate_limiter.acquire()
         try:
             return self._sql_client.send(
                 formatted_query,
@@ -88,9 +121,63 @@ class CartoDataSource(DataSource):
             )
 
         except CartoException as e:
-            raise LongitudeQueryCannotBeExecutedException(str(e))
+            raise carto_error(e) from e
+
+    def batch_query_many(self, queries, timeout_s=None, raise_on_failure=True):
+        """
+        Runs queries as Batch SQL API jobs, which run concurrently in Carto, and waits for all of them. The status of
+        pending jobs is read with an increasing interval (see the batch_poll_* options).
+
+        :param queries: List of (query_template, params) tuples. Params can be None.
+        :param timeout_s: Seconds to wait before cancelling the unfinished jobs. If None, the 'batch_timeout_s' option
+            is used.
+        :param raise_on_failure: If False, failed jobs are returned as any other one, with their status in the meta.
+        :return: List of responses, without rows and with the job information as meta, in the same order as queries
+        """
+        formatted_queries = [self._format_query(query_template, params or {}) for query_template, params in queries]
+        jobs = self._run_batch_jobs(formatted_queries, timeout_s=timeout_s, raise_on_failure=raise_on_failure)
+        return [job_response(job) for job in jobs]
+
+    def batch_query(self, query_template, params=None, timeout_s=None):
+        """
+        Runs a query as a Batch SQL API job and waits for it. See .batch_query_many(...)
+        """
+        return self.batch_query_many([(query_template, params)], timeout_s=timeout_s)[0]
+
+    def _run_batch_jobs(self, formatted_queries, timeout_s=None, raise_on_failure=True):
+        timeout_s = timeout_s or self.batch_options.timeout_s
+        try:
+            jobs = [self._create_job(query) for query in formatted_queries]
+            deadline = time.monotonic() + timeout_s if timeout_s else None
+            delays = self.batch_options.poll_delays()
+            while any(is_pending(job) for job in jobs):
+                delay = next(delays)
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        pending = [job for job in jobs if is_pending(job)]
+                        for job in pending:
+                            self.batch_client.cancel(job['job_id'])
+                        raise timeout_error(pending, timeout_s)
+                    delay = min(delay, remaining)
+                time.sleep(delay)
+                jobs = [self.batch_client.read(job['job_id']) if is_pending(job) else job for job in jobs]
+        except CartoException as e:
+            raise carto_error(e) from e
+
+        if raise_on_failure:
+            for job in jobs:
+                check_job(job)
+        return jobs
+
+    def _create_job(self, query):
+        # Only the creation of jobs counts for the rate limit: polling them is cheap for Carto
+        self.rate_limiter.acquire()
+        return self.batch_client.create(query)
 
     def parse_response(self, response):
+        if is_batch_job(response):
+            return job_response(response)
         return LongitudeQueryResponse(
             rows=response['rows'],
             fields=response['fields'],
@@ -100,14 +187,85 @@ class CartoDataSource(DataSource):
             }
         )
 
-    def copy_from(self, data, filepath, to_table):
+    @property
+    def copy_client(self):
         if self._copy_client is None:
-            from carto.sql import CopySQLClient
-            self._copy_client = CopySQLClient(self._auth_client)
-        headers = data.readline().decode('utf-8')
+            self._copy_client = CopySQLClient(self._auth_client, api_version=self.api_version)
+        return self._copy_client
+
+    def export_iter(self, query_template, params=None, format='csv', chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Streams the result of a query in the given format, without loading it in memory.
+
+        :param format: 'csv' (default) uses the COPY TO endpoint. Other formats (geojson, kml, shp, gpkg...) are
+            requested to the SQL API.
+        :param chunk_size: Size in bytes of the yielded chunks
+        :return: Generator of chunks of bytes
+        """
+        formatted_query = self._format_query(query_template, params or {})
+        self.rate_limiter.acquire()
+        try:
+            if format == 'csv':
+                response = self.copy_client.copyto(copy_to_query(formatted_query))
+            else:
+                response = self._auth_client.send(
+                    self._sql_client.api_url, 'POST', data={'q': formatted_query, 'format': format}, stream=True
+                )
+                if response.status_code >= 400:
+                    raise http_error(
+                        response.status_code, '%s Error: %s' % (response.status_code, response.text), response.headers
+                    )
+        except CartoException as e:
+            raise carto_error(e) from e
+
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    yield chunk
+        finally:
+            response.close()
+
+    def export(self, query_template, file_obj, params=None, format='csv', chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Writes the result of a query in a binary file-like object as it is downloaded. See .export_iter(...)
+
+        :return: Number of written bytes
+        """
+        written = 0
+        for chunk in self.export_iter(query_template, params=params, format=format, chunk_size=chunk_size):
+            file_obj.write(chunk)
+            written += len(chunk)
+        return written
+
+    def query_iter(self, query_template, params=None, fetch_size=None, batches=False, **opts):
+        """
+        Rows are streamed as CSV from the COPY TO endpoint and parsed as they arrive. As CSV has no types, values are
+        strings (and NULL values are '').
+        """
+        rows = self._iter_csv_rows(query_template, params)
+        if batches:
+            yield from batched(rows, fetch_size or self.fetch_size)
+        else:
+            yield from rows
+
+    def _iter_csv_rows(self, query_template, params):
+        parser = CsvRowsParser()
+        for chunk in self.export_iter(query_template, params=params, format='csv'):
+            yield from parser.feed(chunk)
+        yield from parser.close()
+
+    def copy_from(self, data, filepath, to_table):
+        columns = parse_csv_header(data.readline())
         data.seek(0)
-        from_query = 'COPY %s (%s) FROM stdin WITH (FORMAT csv, HEADER true)' % (to_table, headers)
-        return self._copy_client.copyfrom_file_object(from_query, data)
+        self.rate_limiter.acquire()
+        return self.copy_client.copyfrom_file_object(copy_from_query(to_table, columns, header=True), data)
+
+    def copy_chunk(self, data, to_table, columns):
+        self.rate_limiter.acquire()
+        try:
+            return self.copy_client.copyfrom(copy_from_query(to_table, columns), [data])
+        except CartoException as e:
+            raise carto_error(e) from e
 
     def read_dataframe(self, table_name='', *args, **kwargs):
         return self.cc.read(table_name=table_name, *args, **kwargs)
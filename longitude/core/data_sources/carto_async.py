@@ -1,11 +1,16 @@
-import aiohttp
-from cartoasync import Auth, SQLClient
+import asyncio
+import time
+from contextlib import asynccontextmanager
 
-from carto.exceptions import CartoException
+import aiohttp
+from cartoasync import Auth, CartoException, SQLClient
 
 from ..common.query_response import LongitudeQueryResponse
+from ..common.rate_limit import RateLimiter
 from .base_async import AsyncDataSource
-from ..common.exceptions import LongitudeQueryCannotBeExecutedException
+from .carto_batch import BatchOptions, check_job, is_batch_job, is_pending, job_response, timeout_error
+from .carto_export import DEFAULT_CHUNK_SIZE, MAX_GET_QUERY_LENGTH, CsvRowsParser, copy_to_query
+from .carto_http import ConnectorOptions, build_client_session, carto_async_error, http_error
 
 
 class CartoAsyncDataSource(AsyncDataSource):
@@ -14,36 +19,75 @@ class CartoAsyncDataSource(AsyncDataSource):
     DEFAULT_API_VERSION = 'v2'
 
     def __init__(self, user, api_key, options={}):
+        """
+        :param batch: If True, .query(...) runs queries as Batch SQL API jobs and waits for them without blocking the
+            event loop. Responses have no rows but the job information as meta. See also carto_batch.BatchOptions.
+        :param session: aiohttp.ClientSession used for every request. It is never closed by the data source. If None
+            (default), the data source opens its own session, lazily, over a TCPConnector shared by every data source
+            with the same connector options (see carto_http.ConnectorOptions).
+        :param rate_limit_per_s: Requests per second sent to Carto. Requests over the limit wait for their turn, without
+            blocking the loop, instead of being rejected by Carto. See the options in rate_limit.RateLimiter.
+        """
         super().__init__(options)
 
+        self.batch = options.get('batch', False)
+        self.batch_options = BatchOptions(options)
         self.format = options.get('format', 'json')
         self.base_url_option = options.get('base_url', '')
         self.api_version = options.get('api_version', self.DEFAULT_API_VERSION)
         self.session = options.get('session', None)
+        self.connector_options = ConnectorOptions(options)
+        self.rate_limiter = RateLimiter(options, user)
 
         self.user = user
         self.api_key = api_key
         self.base_url = self._generate_base_url(user, self.base_url_option)
 
-        self._auth_client = Auth(api_key=api_key, base_url=self.base_url)
-        self._sql_client = SQLClient(self._auth_client, session=self.session)
+        self._auth_client = Auth(
+            api_key=api_key, base_url=self.base_url, ssl=None if self.connector_options.verify_ssl else False
+        )
+
+        # Managed session, and the event loop it belongs to
+        self._own_session = None
+        self._own_session_loop = None
+        self._sql_client = None
+        if self.session is not None:
+            self._sql_client = SQLClient(self._auth_client, session=self.session)
 
-    # These three methods allows the ussage with the 'async with'. i.e:
+    # These two methods allow the usage with 'async with', which closes the managed session at the end. i.e:
     #       async with CartoAsyncDataSource(**params) as ds:
     #           ...
-    # If you don't want to pass your own 'session' on the constructor method,
-    # this is the other way for the SQLClient to share the same ClientSession between requests.
-    async def __aenter__(self, user=None, api_key=None, options={}):
-        await self._init_session()
+    async def __aenter__(self):
+        await self.get_session()
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
-        await self.session.close()
+        await self.close()
 
-    async def _init_session(self):
-        # async with aiohttp.ClientSession() as session:
-        self.session = aiohttp.ClientSession()
-        self._sql_client = SQLClient(self._auth_client, session=self.session)
+    async def get_session(self):
+        """
+        :return: The session given in the options or, if none, the managed session of the running event loop
+        """
+        if self.session is not None:
+            return self.session
+
+        loop = asyncio.get_event_loop()
+        session = self._own_session
+        if session is None or session.closed or session.connector.closed or self._own_session_loop is not loop:
+            session = self._own_session = build_client_session(self.connector_options)
+            self._own_session_loop = loop
+            self._sql_client = SQLClient(self._auth_client, session=session)
+        return session
+
+    async def close(self):
+        """
+        Closes the managed session. Its connections stay open in the shared connector for other data sources (see
+        carto_http.close_connectors to close them).
+        """
+        if self._own_session is not None:
+            await self._own_session.close()
+            self._own_session = None
+            self._sql_client = None
 
     def _generate_base_url(self, user, base_url_option):
         if base_url_option:
@@ -52,20 +96,186 @@ class CartoAsyncDataSource(AsyncDataSource):
             base_url = self.SUBDOMAIN_URL_PATTERN % user
         return base_url
 
-    async def execute_query(self, query_template, params, query_config, **opts):
+    def _uses_cache(self, cache=True):
+        # Batch responses are the metadata of a job: caching them would skip running the job again
+        return not self.batch and super()._uses_cache(cache)
+
+    @staticmethod
+    def _format_query(query_template, params):
         params = {k: "'" + v + "'" for k, v in params.items()}
-        formatted_query = query_template % params
+        return query_template % params
+
+    async def execute_query(self, query_template, params, query_config, **opts):
+        formatted_query = self._format_query(query_template, params)
+        if self.batch:
+            return (await self._run_batch_jobs([formatted_query]))[0]
 
+        await self.get_session()
+        await self.rate_limiter.acquire_async()
         try:
             return await self._sql_client.send(
                 formatted_query,
                 format=self.format
             )
 
-        except CartoException as e:
-            raise LongitudeQueryCannotBeExecutedException(str(e))
+        except (CartoException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise carto_async_error(e) from e
+
+    async def batch_query_many(self, queries, timeout_s=None, raise_on_failure=True):
+        """
+        Runs queries as Batch SQL API jobs, which run concurrently in Carto, and waits for all of them. The status of
+        pending jobs is read with an increasing interval (see the batch_poll_* options), without blocking the loop.
+
+        :param queries: List of (query_template, params) tuples. Params can be None.
+        :param timeout_s: Seconds to wait before cancelling the unfinished jobs. If None, the 'batch_timeout_s' option
+            is used.
+        :param raise_on_failure: If False, failed jobs are returned as any other one, with their status in the meta.
+        :return: List of responses, without rows and with the job information as meta, in the same order as queries
+        """
+        formatted_queries = [self._format_query(query_template, params or {}) for query_template, params in queries]
+        jobs = await self._run_batch_jobs(formatted_queries, timeout_s=timeout_s, raise_on_failure=raise_on_failure)
+        return [job_response(job) for job in jobs]
+
+    async def batch_query(self, query_template, params=None, timeout_s=None):
+        """
+        Runs a query as a Batch SQL API job and waits for it. See .batch_query_many(...)
+        """
+        return (await self.batch_query_many([(query_template, params)], timeout_s=timeout_s))[0]
+
+    @asynccontextmanager
+    async def _request_session(self):
+        yield await self.get_session()
+
+    async def _batch_request(self, session, method, job_id='', query=None):
+        # cartoasync has no Batch SQL API client: the jobs endpoint is called directly
+        url = '%s/job/%s' % (self._auth_client.sql_api_url, job_id)
+        kwargs = {'params': {'api_key': self.api_key}, 'ssl': self._auth_client.ssl}
+        if query is not None:
+            kwargs['json'] = {'query': query}
+        async with session.request(method, url, **kwargs) as resp:
+            if resp.status >= 400:
+                raise http_error(
+                    resp.status, 'Batch SQL API error %s: %s' % (resp.status, await resp.text()), resp.headers
+                )
+            return await resp.json()
+
+    async def _create_job(self, session, query):
+        # Only the creation of jobs counts for the rate limit: polling them is cheap for Carto
+        await self.rate_limiter.acquire_async()
+        return await self._batch_request(session, 'POST', query=query)
+
+    async def _run_batch_jobs(self, formatted_queries, timeout_s=None, raise_on_failure=True):
+        timeout_s = timeout_s or self.batch_options.timeout_s
+        async with self._request_session() as session:
+            try:
+                jobs = await asyncio.gather(*[
+                    self._create_job(session, query) for query in formatted_queries
+                ])
+                deadline = time.monotonic() + timeout_s if timeout_s else None
+                delays = self.batch_options.poll_delays()
+                while any(is_pending(job) for job in jobs):
+                    delay = next(delays)
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            pending = [job for job in jobs if is_pending(job)]
+                            await asyncio.gather(*[
+                                self._batch_request(session, 'DELETE', job['job_id']) for job in pending
+                            ])
+                            raise timeout_error(pending, timeout_s)
+                        delay = min(delay, remaining)
+                    await asyncio.sleep(delay)
+                    pending = [i for i, job in enumerate(jobs) if is_pending(job)]
+                    read = await asyncio.gather(*[
+                        self._batch_request(session, 'GET', jobs[i]['job_id']) for i in pending
+                    ])
+                    for i, job in zip(pending, read):
+                        jobs[i] = job
+            except aiohttp.ClientError as e:
+                raise carto_async_error(e) from e
+
+        if raise_on_failure:
+            for job in jobs:
+                check_job(job)
+        return jobs
+
+    async def export_iter(self, query_template, params=None, format='csv', chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Asynchronous generator streaming the result of a query in the given format, without loading it in memory.
+
+        :param format: 'csv' (default) uses the COPY TO endpoint. Other formats (geojson, kml, shp, gpkg...) are
+            requested to the SQL API.
+        :param chunk_size: Maximum size in bytes of the yielded chunks
+        """
+        formatted_query = self._format_query(query_template, params or {})
+        if format == 'csv':
+            url = self._auth_client.sql_api_url + '/copyto'
+            query = copy_to_query(formatted_query)
+            if len(query) < MAX_GET_QUERY_LENGTH:
+                method = 'GET'
+                kwargs = {'params': {'api_key': self.api_key, 'q': query}}
+            else:
+                # Long queries go in the body, so the URL stays under the limits of servers and proxies
+                method = 'POST'
+                kwargs = {'params': {'api_key': self.api_key}, 'data': {'q': query}}
+        else:
+            url = self._auth_client.sql_api_url
+            method = 'POST'
+            kwargs = {'params': {'api_key': self.api_key, 'format': format}, 'data': {'q': formatted_query}}
+
+        await self.rate_limiter.acquire_async()
+        async with self._request_session() as session:
+            try:
+                async with session.request(method, url, ssl=self._auth_client.ssl, **kwargs) as resp:
+                    if resp.status >= 400:
+                        raise http_error(resp.status, 'SQL API error %s: %s' % (resp.status, await resp.text()),
+                                         resp.headers)
+                    async for chunk in resp.content.iter_chunked(chunk_size):
+                        yield chunk
+            except aiohttp.ClientError as e:
+                raise carto_async_error(e) from e
+
+    async def export(self, query_template, file_obj, params=None, format='csv', chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Writes the result of a query in a binary file-like object as it is downloaded. See .export_iter(...)
+
+        :return: Number of written bytes
+        """
+        written = 0
+        async for chunk in self.export_iter(query_template, params=params, format=format, chunk_size=chunk_size):
+            file_obj.write(chunk)
+            written += len(chunk)
+        return written
+
+    async def query_iter(self, query_template, params=None, fetch_size=None, batches=False, **opts):
+        """
+        Asynchronous generator version of DataSource.query_iter. Rows are streamed as CSV from the COPY TO endpoint and
+        parsed as they arrive. As CSV has no types, values are strings (and NULL values are '').
+        """
+        fetch_size = fetch_size or self.fetch_size
+        batch = []
+        async for row in self._iter_csv_rows(query_template, params):
+            if not batches:
+                yield row
+                continue
+            batch.append(row)
+            if len(batch) >= fetch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def _iter_csv_rows(self, query_template, params):
+        parser = CsvRowsParser()
+        async for chunk in self.export_iter(query_template, params=params, format='csv'):
+            for row in parser.feed(chunk):
+                yield row
+        for row in parser.close():
+            yield row
 
     def parse_response(self, response):
+        if is_batch_job(response):
+            return job_response(response)
         return LongitudeQueryResponse(
             rows=response['rows'],
             fields=response['fields'],
@@ -0,0 +1,74 @@
+"""
+Helpers shared by the synchronous and asynchronous Carto data sources to run queries as Batch SQL API jobs.
+
+Jobs run in the Carto servers without holding an HTTP request open, so they are not limited by the SQL API timeout.
+They do not return rows: their responses have the job information (id, status, timestamps...) as meta.
+"""
+from carto.sql import BATCH_JOBS_FAILED_STATUSES, BATCH_JOBS_PENDING_STATUSES
+
+from ..common.exceptions import LongitudeQueryCannotBeExecutedException, LongitudeQueryTimeoutException
+from ..common.query_response import LongitudeQueryResponse
+
+DEFAULT_POLL_INTERVAL_S = 1
+DEFAULT_POLL_MAX_INTERVAL_S = 15
+
+
+class BatchOptions:
+    def __init__(self, options):
+        """
+        :param batch_poll_interval_s: Seconds to wait before reading the status of pending jobs the first time (default:
+            1). The wait doubles after each read.
+        :param batch_poll_max_interval_s: Maximum seconds between reads of the status of pending jobs (default: 15)
+        :param batch_timeout_s: Seconds to wait for jobs before cancelling them. None (default) waits forever.
+        """
+        self.poll_interval_s = options.get('batch_poll_interval_s', DEFAULT_POLL_INTERVAL_S)
+        self.poll_max_interval_s = options.get('batch_poll_max_interval_s', DEFAULT_POLL_MAX_INTERVAL_S)
+        self.timeout_s = options.get('batch_timeout_s')
+
+    def poll_delays(self):
+        delay = self.poll_interval_s
+        while True:
+            yield delay
+            delay = min(delay * 2, self.poll_max_interval_s)
+
+
+def is_pending(job):
+    return job.get('status') in BATCH_JOBS_PENDING_STATUSES
+
+
+def is_failed(job):
+    return job.get('status') in BATCH_JOBS_FAILED_STATUSES
+
+
+def check_job(job):
+    if is_failed(job):
+        raise LongitudeQueryCannotBeExecutedException(
+            'Batch SQL job %s %s: %s' % (job.get('job_id'), job.get('status'), job.get('failed_reason'))
+        )
+    return job
+
+
+def timeout_error(jobs, timeout_s):
+    return LongitudeQueryTimeoutException(
+        'Batch SQL jobs %s were not finished after %s seconds and were cancelled' % (
+            ', '.join(job['job_id'] for job in jobs), timeout_s
+        )
+    )
+
+
+def is_batch_job(response):
+    return isinstance(response, dict) and 'job_id' in response and 'rows' not in response
+
+
+def job_response(job):
+    return LongitudeQueryResponse(
+        rows=[],
+        fields={},
+        meta={
+            'job_id': job.get('job_id'),
+            'status': job.get('status'),
+            'failed_reason': job.get('failed_reason'),
+            'created_at': job.get('created_at'),
+            'updated_at': job.get('updated_at')
+        }
+    )
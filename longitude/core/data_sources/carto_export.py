@@ -0,0 +1,89 @@
+"""
+Helpers shared by the synchronous and asynchronous Carto data sources to stream query results instead of loading them
+in memory at once.
+
+CSV exports use the COPY TO endpoint of the SQL API, which streams rows as they are read from the database. Any other
+format (geojson, kml, shp, gpkg...) is requested to the SQL API with its 'format' parameter and streamed as it arrives.
+"""
+import codecs
+import csv
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Longer queries are sent in the body of a POST request, as the Carto client does
+MAX_GET_QUERY_LENGTH = 1024
+
+
+def copy_to_query(formatted_query):
+    return 'COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER true)' % formatted_query
+
+
+class CsvRowsParser:
+    """
+    Incremental parser of CSV data with header. Chunks of bytes are fed as they are downloaded and complete rows are
+    returned as dictionaries as soon as they are available, so memory usage does not depend on the size of the data.
+
+    Values are strings, as CSV has no types. NULL values and empty strings are both returned as ''.
+    """
+
+    def __init__(self, encoding='utf-8'):
+        self.fields = None
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        # Text after the last newline, and lines of a record with a quoted value that is not closed yet
+        self._partial = ''
+        self._record = []
+        self._quotes = 0
+
+    def feed(self, data):
+        """
+        :param data: Chunk of bytes
+        :return: List of the rows completed by the chunk
+        """
+        lines = (self._partial + self._decoder.decode(data)).split('\n')
+        self._partial = lines.pop()
+        return self._parse_lines(lines)
+
+    def close(self):
+        """
+        :return: List of the rows still in the parser, once all the data has been fed
+        """
+        text = self._partial + self._decoder.decode(b'', final=True)
+        self._partial = ''
+        rows = self._parse_lines([text] if text else [])
+        if self._record:
+            rows.extend(self._parse_record())
+        return rows
+
+    def _parse_lines(self, lines):
+        rows = []
+        for line in lines:
+            self._record.append(line)
+            self._quotes += line.count('"')
+            # Newlines inside quoted values do not end the record
+            if self._quotes % 2 == 0:
+                rows.extend(self._parse_record())
+        return rows
+
+    def _parse_record(self):
+        record = '\n'.join(self._record).rstrip('\r')
+        self._record = []
+        self._quotes = 0
+        if not record:
+            return []
+
+        values = next(csv.reader([record]))
+        if self.fields is None:
+            self.fields = values
+            return []
+        return [dict(zip(self.fields, values))]
+
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,242 @@
+"""
+HTTP connection reuse for the Carto data sources.
+
+Every Carto client (SQL, Batch, Copy and the CartoContext of the synchronous data source) sends its requests through
+the same session, so keep-alive connections (and their TLS handshakes) are reused across queries. Sessions are also
+shared by every data source with the same HTTP options in the process.
+
+The asynchronous data source does the same with aiohttp: its session uses a TCPConnector shared by every data source
+with the same connector options in the event loop. Connectors are bound to their loop, so each loop gets its own.
+"""
+import asyncio
+import threading
+import weakref
+
+import aiohttp
+import requests
+from carto.exceptions import CartoException, CartoRateLimitException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ..common.exceptions import LongitudeQueryCannotBeExecutedException, LongitudeTransientError
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.3
+
+DEFAULT_CONNECTOR_LIMIT = 100
+DEFAULT_TTL_DNS_CACHE_S = 300
+DEFAULT_KEEPALIVE_TIMEOUT_S = 15
+
+TOO_MANY_REQUESTS = 429
+
+
+class HttpOptions:
+    def __init__(self, options):
+        """
+        :param http_pool_connections: Number of hosts with pooled connections (default: 10)
+        :param http_pool_maxsize: Connections kept alive per host (default: 10). Set it to the number of threads
+            querying at the same time.
+        :param http_retries: Retries of requests that could not connect (default: 3)
+        :param http_retry_statuses: HTTP statuses retried by the session (default: none). Short queries are sent as
+            GET, writes included, and gateway errors may come after the query ran, so they are better left to the
+            query_retries of the data source, which only retries read queries.
+        :param http_backoff_factor: Seconds to wait before the second retry, doubled for each one (default: 0.3)
+        :param http_keep_alive: If False, connections are closed after each request (default: True)
+        :param verify_ssl: If False, SSL certificates are not verified, as needed by some on premises installations
+            (default: True)
+        """
+        self.pool_connections = options.get('http_pool_connections', DEFAULT_POOL_CONNECTIONS)
+        self.pool_maxsize = options.get('http_pool_maxsize', DEFAULT_POOL_MAXSIZE)
+        self.retries = options.get('http_retries', DEFAULT_RETRIES)
+        self.retry_statuses = tuple(options.get('http_retry_statuses', ()))
+        self.backoff_factor = options.get('http_backoff_factor', DEFAULT_BACKOFF_FACTOR)
+        self.keep_alive = options.get('http_keep_alive', True)
+        self.verify_ssl = options.get('verify_ssl', True)
+
+    def key(self):
+        return (self.pool_connections, self.pool_maxsize, self.retries, self.retry_statuses, self.backoff_factor,
+                self.keep_alive, self.verify_ssl)
+
+
+def build_session(http_options):
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=http_options.pool_connections,
+        pool_maxsize=http_options.pool_maxsize,
+        max_retries=Retry(
+            total=http_options.retries,
+            read=0,
+            status_forcelist=http_options.retry_statuses,
+            backoff_factor=http_options.backoff_factor,
+            raise_on_status=False
+        )
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.verify = http_options.verify_ssl
+    if not http_options.keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def shared_session(http_options):
+    """
+    :return: The requests.Session of the process for these HTTP options
+    """
+    key = http_options.key()
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = build_session(http_options)
+        return _sessions[key]
+
+
+class ConnectorOptions:
+    def __init__(self, options):
+        """
+        :param http_limit: Maximum number of connections open at the same time (default: 100)
+        :param http_limit_per_host: Maximum number of connections open at the same time to the same host. 0 (default)
+            means no limit other than http_limit.
+        :param http_ttl_dns_cache_s: Seconds resolved host names are cached (default: 300). None caches them forever.
+        :param http_keep_alive: If False, connections are closed after each request (default: True)
+        :param http_keepalive_timeout_s: Seconds an idle connection is kept open (default: 15)
+        :param http_timeout_s: Total seconds a request may take, including the download of the response. None
+            (default) means no timeout.
+        :param verify_ssl: If False, SSL certificates are not verified, as needed by some on premises installations
+            (default: True)
+        """
+        self.limit = options.get('http_limit', DEFAULT_CONNECTOR_LIMIT)
+        self.limit_per_host = options.get('http_limit_per_host', 0)
+        self.ttl_dns_cache_s = options.get('http_ttl_dns_cache_s', DEFAULT_TTL_DNS_CACHE_S)
+        self.keep_alive = options.get('http_keep_alive', True)
+        self.keepalive_timeout_s = options.get('http_keepalive_timeout_s', DEFAULT_KEEPALIVE_TIMEOUT_S)
+        self.timeout_s = options.get('http_timeout_s')
+        self.verify_ssl = options.get('verify_ssl', True)
+
+    def key(self):
+        return (self.limit, self.limit_per_host, self.ttl_dns_cache_s, self.keep_alive, self.keepalive_timeout_s,
+                self.verify_ssl)
+
+
+def build_connector(connector_options):
+    kwargs = {
+        'limit': connector_options.limit,
+        'limit_per_host': connector_options.limit_per_host,
+        'use_dns_cache': True,
+        'ttl_dns_cache': connector_options.ttl_dns_cache_s
+    }
+    if connector_options.keep_alive:
+        kwargs['keepalive_timeout'] = connector_options.keepalive_timeout_s
+    else:
+        kwargs['force_close'] = True
+    if not connector_options.verify_ssl:
+        kwargs['ssl'] = False
+    return aiohttp.TCPConnector(**kwargs)
+
+
+# Event loop -> {connector options key: connector}
+_connectors = weakref.WeakKeyDictionary()
+
+
+def shared_connector(connector_options):
+    """
+    Must be called from a coroutine.
+
+    :return: The TCPConnector of the running event loop for these connector options
+    """
+    connectors = _connectors.setdefault(asyncio.get_event_loop(), {})
+    key = connector_options.key()
+    connector = connectors.get(key)
+    if connector is None or connector.closed:
+        connector = connectors[key] = build_connector(connector_options)
+    return connector
+
+
+def build_client_session(connector_options):
+    """
+    :return: An aiohttp.ClientSession over the shared connector. Closing it does not close the connector.
+    """
+    return aiohttp.ClientSession(
+        connector=shared_connector(connector_options),
+        connector_owner=False,
+        timeout=aiohttp.ClientTimeout(total=connector_options.timeout_s)
+    )
+
+
+async def close_connectors():
+    """
+    Closes the shared connectors of the running event loop, i.e. when the application shuts down. Open connections
+    are closed; data sources open new connectors if they are used again.
+    """
+    connectors = _connectors.pop(asyncio.get_event_loop(), {})
+    for connector in connectors.values():
+        await connector.close()
+
+
+def is_transient_status(status):
+    return status == TOO_MANY_REQUESTS or status >= 500
+
+
+def retry_after_s(headers):
+    # Only the delay in seconds form of Retry-After is used (Carto does not send dates)
+    try:
+        return max(0, int(headers['Retry-After']))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def http_error(status, message, headers=None):
+    """
+    :return: Exception for an error response of the Carto APIs: LongitudeTransientError if it can be retried
+    """
+    if is_transient_status(status):
+        return LongitudeTransientError(message, retry_after_s=retry_after_s(headers or {}))
+    return LongitudeQueryCannotBeExecutedException(message)
+
+
+def _carto_cause(e):
+    # Each layer of the carto package wraps the error of the one below (i.e. SQLClient.send wraps the CartoException
+    # of APIKeyAuthClient.send, which wraps the requests error), so wrappers are walked down to the original error
+    seen = set()
+    while isinstance(e, CartoException) and not isinstance(e, CartoRateLimitException) and id(e) not in seen:
+        seen.add(id(e))
+        cause = e.args[0] if e.args and isinstance(e.args[0], BaseException) else e.__cause__
+        if cause is None:
+            break
+        e = cause
+    return e
+
+
+def carto_error(e):
+    """
+    :param e: CartoException raised by the carto package. It wraps the original error (a pyrestcli error with the HTTP
+        status, or a requests error if there was no response), maybe several times.
+    :return: Equivalent Longitude exception
+    """
+    cause = _carto_cause(e)
+    if isinstance(cause, CartoRateLimitException):
+        return LongitudeTransientError(str(e), retry_after_s=cause.retry_after)
+    status = getattr(cause, 'status_code', None)
+    if status is not None:
+        return http_error(status, str(e), getattr(cause, 'headers', None))
+    if isinstance(cause, (requests.ConnectionError, requests.Timeout)):
+        return LongitudeTransientError(str(e))
+    return LongitudeQueryCannotBeExecutedException(str(e))
+
+
+def carto_async_error(e):
+    """
+    :param e: CartoException raised by the cartoasync package, with the HTTP status, or aiohttp error
+    :return: Equivalent Longitude exception
+    """
+    status = getattr(e, 'status', None)
+    if status is not None:
+        return http_error(status, str(e))
+    if isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+        return LongitudeTransientError(str(e) or e.__class__.__name__)
+    return LongitudeQueryCannotBeExecutedException(str(e))
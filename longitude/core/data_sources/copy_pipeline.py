@@ -0,0 +1,181 @@
+"""
+Chunked ingestion through COPY FROM. Big CSV files (or generators of rows) are split in chunks of complete records
+that are copied in parallel, each one over its own connection and transaction, so loads are limited by the database
+instead of by a single Python thread.
+
+Data sources support it by implementing .copy_chunk(data, to_table, columns). A failed chunk is retried as a whole
+(its transaction was rolled back), but chunks already copied stay in the table if the load finally fails.
+"""
+import csv
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+DEFAULT_CHUNK_SIZE_BYTES = 16 * 1024 * 1024
+DEFAULT_CHUNK_ROWS = 50000
+
+
+def quote_identifier(name):
+    return '"%s"' % str(name).replace('"', '""')
+
+
+def copy_from_query(to_table, columns, header=False):
+    """
+    :param to_table: Target table, as written in SQL (it may be schema qualified or quoted)
+    :param columns: Column names. They are quoted, so they keep their case, spaces, commas...
+    """
+    options = 'FORMAT csv, HEADER true' if header else 'FORMAT csv'
+    return 'COPY %s (%s) FROM STDIN WITH (%s)' % (
+        to_table, ', '.join(quote_identifier(column) for column in columns), options
+    )
+
+
+def parse_csv_header(line, encoding='utf-8'):
+    """
+    :param line: First line of a CSV file (bytes or str), including its newline
+    :return: List of column names, following the CSV quoting rules
+    """
+    if isinstance(line, bytes):
+        line = line.decode(encoding)
+    return [name.strip() for name in next(csv.reader([line.rstrip('\r\n')]))]
+
+
+def split_csv(file_obj, chunk_size_bytes=DEFAULT_CHUNK_SIZE_BYTES):
+    """
+    Splits the records of a binary CSV file in chunks of about chunk_size_bytes. Records with quoted newlines are
+    never split. The file must be positioned after its header, if any.
+
+    :return: Generator of (chunk of bytes, number of records) tuples
+    """
+    lines = []
+    size = 0
+    records = 0
+    quotes = 0
+    for line in file_obj:
+        lines.append(line)
+        size += len(line)
+        quotes += line.count(b'"')
+        if quotes % 2:
+            # Inside a quoted value: the record goes on in the next line
+            continue
+        quotes = 0
+        if line.strip():
+            records += 1
+        if size >= chunk_size_bytes:
+            yield b''.join(lines), records
+            lines, size, records = [], 0, 0
+    if lines:
+        yield b''.join(lines), records
+
+
+def _csv_value(value):
+    # Unquoted empty values are NULL for COPY; any other value is quoted, so empty strings stay empty strings
+    if value is None:
+        return ''
+    return '"%s"' % str(value).replace('"', '""')
+
+
+def encode_rows(rows, chunk_rows=DEFAULT_CHUNK_ROWS, encoding='utf-8'):
+    """
+    Encodes rows (sequences of values, in the order of the columns) as CSV for COPY. None values are loaded as NULL.
+
+    :return: Generator of (chunk of bytes, number of rows) tuples
+    """
+    lines = []
+    for row in rows:
+        lines.append(','.join(_csv_value(value) for value in row) + '\n')
+        if len(lines) >= chunk_rows:
+            yield ''.join(lines).encode(encoding), len(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines).encode(encoding), len(lines)
+
+
+class CopyMetrics:
+    """
+    Progress and throughput of a chunked COPY. Updated by the pipeline as chunks are copied.
+    """
+
+    def __init__(self):
+        self.chunks = 0
+        self.rows = 0
+        self.bytes = 0
+        self.retries = 0
+        self._start = time.monotonic()
+        self._end = None
+
+    @property
+    def elapsed_s(self):
+        return (self._end or time.monotonic()) - self._start
+
+    def as_dict(self):
+        elapsed_s = self.elapsed_s
+        return {
+            'chunks': self.chunks,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'elapsed_s': elapsed_s,
+            'rows_per_s': self.rows / elapsed_s if elapsed_s else 0.0,
+            'bytes_per_s': self.bytes / elapsed_s if elapsed_s else 0.0
+        }
+
+
+def run_copy_pipeline(copy_chunk, chunks, workers=1, retries=0, retry_delay_s=1, progress_callback=None):
+    """
+    Copies chunks in parallel. Only a few chunks per worker are read ahead, so memory usage does not depend on the
+    size of the load.
+
+    :param copy_chunk: Function copying a chunk of bytes. It must run in its own connection and transaction.
+    :param chunks: Iterable of (chunk of bytes, number of rows) tuples
+    :param workers: Number of chunks copied at the same time
+    :param retries: Times a failed chunk is copied again before failing the load
+    :param retry_delay_s: Seconds to wait before the first retry of a chunk. The wait doubles with each retry.
+    :param progress_callback: Function called with the metrics (as a dictionary) after each copied chunk
+    :return: Metrics of the load, as a dictionary
+    """
+    metrics = CopyMetrics()
+    lock = threading.Lock()
+
+    def copy(data):
+        for attempt in range(retries + 1):
+            try:
+                return copy_chunk(data)
+            except Exception:
+                if attempt == retries:
+                    raise
+                with lock:
+                    metrics.retries += 1
+                time.sleep(retry_delay_s * 2 ** attempt)
+
+    chunks = iter(chunks)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                while len(in_flight) < workers * 2:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    data, rows = chunk
+                    in_flight[executor.submit(copy, data)] = (len(data), rows)
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    size, rows = in_flight.pop(future)
+                    future.result()
+                    with lock:
+                        metrics.chunks += 1
+                        metrics.rows += rows
+                        metrics.bytes += size
+                    if progress_callback:
+                        progress_callback(metrics.as_dict())
+        except BaseException:
+            for future in in_flight:
+                future.cancel()
+            raise
+
+    metrics._end = time.monotonic()
+    return metrics.as_dict()
@@ -1,6 +1,65 @@
+import re
+
 from psycopg2.extensions import string_types
 
+from ...common.exceptions import LongitudeWrongQueryException
+from ...common.query_response import LongitudeQueryResponse
+
 
 def psycopg2_type_as_string(type_id):
     type_ = string_types.get(type_id)
     return type_.name if type_ else 'unknown'
+
+
+def build_response(names, fields, rows, compact=False, copy_tuples=False, row_as_dict=None):
+    """
+    :param names: Column names, in the same order as the values in the rows
+    :param fields: Dictionary of fields of the response
+    :param rows: Rows as sequences of values
+    :param compact: If True, rows are kept as tuples (see LongitudeQueryResponse). Repeated column names (i.e.
+        SELECT a.id, b.id) can not be told apart by the field index of compact rows, so those responses have
+        dictionary rows, where the last value wins.
+    :param copy_tuples: If True, compact rows are copied into plain tuples (i.e. to drop references to the driver)
+    :param row_as_dict: Function converting a row into a dictionary, if the driver has a better one
+    """
+    if compact and len(set(names)) == len(names):
+        return LongitudeQueryResponse(tuples=[tuple(row) for row in rows] if copy_tuples else rows, fields=fields)
+    if row_as_dict is None:
+        def row_as_dict(row):
+            return dict(zip(names, row))
+    return LongitudeQueryResponse(rows=[row_as_dict(row) for row in rows], fields=fields)
+
+
+_PYFORMAT_PLACEHOLDER = re.compile(r'%%|%\((\w+)\)s|%s')
+
+
+def pyformat_to_numeric(query_template, params):
+    """
+    Converts a query written for psycopg2 (%(name)s or %s placeholders) into one using PostgreSQL numeric
+    placeholders ($1, $2...), as needed by asyncpg, along with the ordered list of arguments.
+
+    :param query_template: Query with psycopg2 placeholders
+    :param params: Dictionary (named placeholders) or sequence (positional placeholders) of values
+    :raise LongitudeWrongQueryException if a placeholder has no matching value
+    :return: Tuple (query, args)
+    """
+    args = []
+    named_positions = {}
+    positional = iter(params or ())
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        name = match.group(1)
+        if name is None:
+            args.append(next(positional))
+            return '$%d' % len(args)
+        if name not in named_positions:
+            args.append(params[name])
+            named_positions[name] = len(args)
+        return '$%d' % named_positions[name]
+
+    try:
+        return _PYFORMAT_PLACEHOLDER.sub(replace, query_template), args
+    except (KeyError, StopIteration) as e:
+        raise LongitudeWrongQueryException('Missing value for query placeholder: %s' % e)
@@ -0,0 +1,266 @@
+"""
+Bulk DataFrame transfers through COPY, much faster than the row by row INSERTs and fetches used by default by pandas.
+
+Query results are copied as CSV into a spooled temporary file (in memory up to a size, then on disk) and parsed into
+columns by pyarrow, if installed, or by the C parser of pandas. Column types come from the query itself, so they do
+not depend on what the parser would infer.
+"""
+import io
+import tempfile
+import uuid
+
+import pandas
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR, encodings
+from sqlalchemy.types import UserDefinedType
+
+from ...common.exceptions import LongitudeConfigError
+from ..copy_pipeline import copy_from_query, encode_rows, quote_identifier
+from .common import psycopg2_type_as_string
+
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+UPSERT = 'upsert'
+
+DEFAULT_SPOOL_MAX_SIZE_BYTES = 64 * 1024 * 1024
+
+_INTEGER_TYPES = ('INTEGER', 'LONGINTEGER')
+_FLOAT_TYPES = ('FLOAT', 'DECIMAL')
+_DATE_TYPES = ('DATE', 'DATETIME', 'DATETIMETZ')
+
+# Since pandas 2, a single format is inferred for the whole column unless told otherwise, but PostgreSQL omits
+# the zero fractions of seconds
+_DATETIME_OPTIONS = {'format': 'ISO8601'} if int(pandas.__version__.split('.')[0]) >= 2 else {}
+
+
+class Geometry(UserDefinedType):
+    """
+    PostGIS geometry column type for the tables created by to_sql, which would create TEXT columns for geometries
+    """
+    cache_ok = True
+
+    def __init__(self, srid=None):
+        self.srid = srid
+
+    def get_col_spec(self, **kwargs):
+        if self.srid is None:
+            return 'geometry'
+        return 'geometry(Geometry, %d)' % self.srid
+
+
+def geometry_dtypes(df, srid=None):
+    """
+    :return: Dictionary with the Geometry type of each column of df holding geometries (i.e. shapely objects), to be
+        used as the 'dtype' argument of to_sql
+    """
+    dtypes = {}
+    for column in df.columns:
+        values = df[column]
+        if values.dtype != object:
+            continue
+        values = values.dropna()
+        if len(values) and hasattr(values.iloc[0], 'wkb_hex'):
+            dtypes[column] = Geometry(srid)
+    return dtypes
+
+
+def _geometry_encoder(srid):
+    if srid is None:
+        return lambda geometry: geometry.wkb_hex
+
+    from shapely import wkb
+    return lambda geometry: wkb.dumps(geometry, hex=True, srid=srid)
+
+
+def _encoded_rows(data_iter, encode_geometry):
+    # Geometries (i.e. shapely objects) are written as hexadecimal WKB, which PostGIS reads as geometry input
+    for row in data_iter:
+        yield [encode_geometry(value) if hasattr(value, 'wkb_hex') else value for value in row]
+
+
+def copy_method(upsert_keys=None, srid=None, chunk_rows=50000):
+    """
+    Builds a callable to be used as the 'method' argument of pandas.DataFrame.to_sql, streaming the rows through
+    COPY FROM STDIN, in CSV chunks built in memory.
+
+    :param upsert_keys: If given, rows are copied into a temporary table and then inserted into the target table,
+        updating the existing rows with the same values in these columns (they must have a unique constraint)
+    :param srid: SRID of the geometry columns, if they need one
+    :param chunk_rows: Rows per COPY buffer
+    """
+    encode_geometry = _geometry_encoder(srid)
+
+    def copy(table, conn, keys, data_iter):
+        target = quote_identifier(table.name)
+        if table.schema:
+            target = '%s.%s' % (quote_identifier(table.schema), target)
+
+        dbapi_connection = conn.connection
+        with dbapi_connection.cursor() as cursor:
+            if not upsert_keys:
+                _copy_rows(cursor, target, keys, data_iter)
+                return
+
+            temporary = quote_identifier('longitude_upsert_%s' % uuid.uuid4().hex)
+            try:
+                cursor.execute('CREATE TEMPORARY TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (temporary, target))
+                _copy_rows(cursor, temporary, keys, data_iter)
+                cursor.execute(upsert_query(target, temporary, keys, upsert_keys))
+            finally:
+                # Temporary tables live as long as the (maybe pooled) connection. In an aborted transaction nothing
+                # can run, but the rollback drops the table anyway.
+                if dbapi_connection.get_transaction_status() != TRANSACTION_STATUS_INERROR:
+                    cursor.execute('DROP TABLE IF EXISTS %s' % temporary)
+
+    def _copy_rows(cursor, copy_target, keys, data_iter):
+        for data, _ in encode_rows(_encoded_rows(data_iter, encode_geometry), chunk_rows):
+            cursor.copy_expert(copy_from_query(copy_target, keys), io.BytesIO(data))
+
+    return copy
+
+
+def upsert_query(target, source, columns, upsert_keys):
+    columns = [quote_identifier(column) for column in columns]
+    keys = [quote_identifier(key) for key in upsert_keys]
+    updates = ['%s = EXCLUDED.%s' % (column, column) for column in columns if column not in keys]
+    action = 'DO UPDATE SET %s' % ', '.join(updates) if updates else 'DO NOTHING'
+    return 'INSERT INTO %s (%s) SELECT %s FROM %s ON CONFLICT (%s) %s' % (
+        target, ', '.join(columns), ', '.join(columns), source, ', '.join(keys), action
+    )
+
+
+def to_sql_arguments(if_exists='fail', method=None, upsert_keys=None, srid=None):
+    """
+    Translates the write_dataframe modes into pandas.DataFrame.to_sql arguments. Upserts always copy.
+
+    :return: Tuple (if_exists, method)
+    """
+    if if_exists == UPSERT:
+        if not upsert_keys:
+            raise LongitudeConfigError('Upserts need the upsert_keys (columns with a unique constraint)')
+        if method not in (None, 'copy'):
+            raise LongitudeConfigError('Upserts are only supported with the copy method')
+        return 'append', copy_method(upsert_keys=upsert_keys, srid=srid)
+
+    if method == 'copy':
+        return if_exists, copy_method(srid=srid)
+    return if_exists, method
+
+
+def copy_to_query(query):
+    return 'COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER true)' % query
+
+
+def describe_query(query):
+    # Runs the query without reading rows, just to get the names and types of its columns
+    return 'SELECT * FROM (%s) AS longitude_query LIMIT 0' % query
+
+
+def _arrow_type(type_name):
+    if type_name in _INTEGER_TYPES:
+        return pyarrow.int64()
+    if type_name in _FLOAT_TYPES:
+        return pyarrow.float64()
+    if type_name == 'BOOLEAN':
+        return pyarrow.bool_()
+    if type_name == 'DATE':
+        return pyarrow.date32()
+    if type_name == 'DATETIME':
+        return pyarrow.timestamp('us')
+    if type_name == 'DATETIMETZ':
+        return pyarrow.timestamp('us', tz='UTC')
+    # Text, JSON, geometries (as hexadecimal EWKB)... and any other type are read as strings
+    return pyarrow.string()
+
+
+def _pandas_dtype(type_name):
+    if type_name in _INTEGER_TYPES:
+        return 'Int64'
+    if type_name in _FLOAT_TYPES:
+        return 'float64'
+    if type_name == 'BOOLEAN':
+        return 'boolean'
+    return str
+
+
+def _read_arrow(spool, column_types, chunksize):
+    reader = pyarrow.csv.open_csv(
+        spool,
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={name: _arrow_type(type_name) for name, type_name in column_types},
+            true_values=['t'],
+            false_values=['f'],
+            strings_can_be_null=True,
+            # COPY writes NULL as an unquoted empty value and empty strings as ""
+            quoted_strings_can_be_null=False
+        )
+    )
+    if chunksize is None:
+        return reader.read_all().to_pandas()
+    return _arrow_chunks(reader, chunksize)
+
+
+def _arrow_chunks(reader, chunksize):
+    # Arrow batches have a size in bytes: they are sliced and joined into DataFrames of chunksize rows
+    pending = []
+    rows = 0
+    for batch in reader:
+        pending.append(batch)
+        rows += batch.num_rows
+        while rows >= chunksize:
+            table = pyarrow.Table.from_batches(pending, schema=reader.schema)
+            yield table.slice(0, chunksize).to_pandas()
+            rest = table.slice(chunksize)
+            pending, rows = rest.to_batches(), rest.num_rows
+    if rows:
+        yield pyarrow.Table.from_batches(pending, schema=reader.schema).to_pandas()
+
+
+def _read_pandas(spool, column_types, chunksize):
+    def parse_dates(df):
+        for name, type_name in column_types:
+            if type_name in _DATE_TYPES:
+                df[name] = pandas.to_datetime(df[name], utc=type_name == 'DATETIMETZ', **_DATETIME_OPTIONS)
+        return df
+
+    frames = pandas.read_csv(
+        spool,
+        dtype={name: _pandas_dtype(type_name) for name, type_name in column_types if type_name not in _DATE_TYPES},
+        true_values=['t'],
+        false_values=['f'],
+        # Unlike pyarrow, the C parser reads empty strings as NULL too
+        keep_default_na=False,
+        na_values=[''],
+        chunksize=chunksize
+    )
+    if chunksize is None:
+        return parse_dates(frames)
+    return (parse_dates(df) for df in frames)
+
+
+def copy_to_dataframe(cursor, query, params=None, chunksize=None, spool_max_size_bytes=DEFAULT_SPOOL_MAX_SIZE_BYTES):
+    """
+    Reads the result of a query into a DataFrame through COPY TO STDOUT.
+
+    :param cursor: psycopg2 cursor
+    :param query: Query template, with psycopg2 placeholders
+    :param params: Values for the placeholders of the query
+    :param chunksize: If given, an iterator of DataFrames with up to chunksize rows is returned
+    :param spool_max_size_bytes: Size of the copied data kept in memory. Bigger results are spooled to disk.
+    :return: DataFrame, or iterator of DataFrames if chunksize is given
+    """
+    query = cursor.mogrify(query, params).decode(encodings[cursor.connection.encoding])
+
+    cursor.execute(describe_query(query))
+    column_types = [(d.name, psycopg2_type_as_string(d.type_code)) for d in cursor.description]
+
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_max_size_bytes)
+    cursor.copy_expert(copy_to_query(query), spool)
+    spool.seek(0)
+
+    if pyarrow is None:
+        return _read_pandas(spool, column_types, chunksize)
+    return _read_arrow(spool, column_types, chunksize)
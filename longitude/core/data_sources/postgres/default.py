@@ -1,31 +1,124 @@
+import io
+import uuid
+from contextlib import contextmanager
+
 import psycopg2
 import psycopg2.extensions
 
-from ...common.query_response import LongitudeQueryResponse
+from ...common.exceptions import (LongitudeQueryCannotBeExecutedException, LongitudeQueryTimeoutException,
+                                  LongitudeTransientError)
+from ...common.resilience import is_read_query
 from ..base import DataSource
-from .common import psycopg2_type_as_string
+from ..copy_pipeline import copy_from_query, parse_csv_header
+from .common import build_response, psycopg2_type_as_string
+from .dataframes import DEFAULT_SPOOL_MAX_SIZE_BYTES, copy_to_dataframe
+from .pool import PostgresConnectionPool
 
 
 class PostgresDataSource(DataSource):
 
     def __init__(self, options={}):
+        """
+        By default, a single connection (and cursor) is shared by every query. Set the 'pool' option to True to borrow
+        a connection from a thread-safe pool for each query instead. In pooled mode every query runs in its own
+        transaction, which is committed if the query succeeds. Otherwise, changes are committed with .commit() (or
+        after each query with the 'auto_commit' option), and queries failed by connection errors are only retried if
+        there are no uncommitted changes, which would be lost.
+
+        Pool options: 'pool_min_size' (1), 'pool_max_size' (10), 'pool_health_check' (True),
+        'pool_idle_timeout_s' (300) and 'pool_checkout_timeout_s' (None, waits forever).
+        """
         super().__init__(options)
-        self._conn = psycopg2.connect(
-            host=options.get('host', 'localhost'),
-            port=options.get('port', 5432),
-            database=options.get('db', ''),
-            user=options.get('user', 'postgres'),
-            password=options.get('password', '')
-        )
+        self._conn = None
+        self._cursor = None
+        self._pool = None
         self._auto_commit = options.get('auto_commit', False)
-
-        self._cursor = self._conn.cursor()
+        # Whether the shared connection has changes not committed yet
+        self._pending_writes = False
+
+        connection_options = {
+            'host': options.get('host', 'localhost'),
+            'port': options.get('port', 5432),
+            'database': options.get('db', ''),
+            'user': options.get('user', 'postgres'),
+            'password': options.get('password', '')
+        }
+        self._connection_options = connection_options
+
+        if options.get('pool', False):
+            self._pool = PostgresConnectionPool(
+                connection_options,
+                min_size=options.get('pool_min_size', 1),
+                max_size=options.get('pool_max_size', 10),
+                health_check=options.get('pool_health_check', True),
+                idle_timeout_s=options.get('pool_idle_timeout_s', 300),
+                checkout_timeout_s=options.get('pool_checkout_timeout_s')
+            )
+        else:
+            self._conn = psycopg2.connect(**connection_options)
+            self._cursor = self._conn.cursor()
 
     def __del__(self):
         if self._cursor:
             self._cursor.close()
         if self._conn:
             self._conn.close()
+        if self._pool:
+            self._pool.closeall()
+
+    @property
+    def pooled(self):
+        return self._pool is not None
+
+    @property
+    def thread_safe(self):
+        # Out of pooled mode every query goes through the same cursor
+        return self.pooled
+
+    @contextmanager
+    def _checkout_connection(self):
+        # Yields the shared connection or, in pooled mode, a borrowed one
+        if self._pool is None:
+            yield self._conn
+        else:
+            with self._pool.connection() as conn:
+                yield conn
+
+    def _reconnect(self):
+        self._conn = psycopg2.connect(**self._connection_options)
+        self._cursor = self._conn.cursor()
+        self._pending_writes = False
+
+    @contextmanager
+    def _checkout_cursor(self):
+        # Yields the shared cursor or, in pooled mode, a fresh cursor over a borrowed connection
+        if self._pool is None:
+            if self._conn.closed:
+                # i.e. dropped by the server, so queries failed by it can be retried
+                self._reconnect()
+            yield self._cursor
+            if self._auto_commit:
+                self.commit()
+        else:
+            with self._pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    yield cursor
+
+    def _in_transaction(self):
+        # Only the shared connection keeps transactions between queries: in pooled mode each query has its own.
+        # psycopg2 begins a transaction before any query, reads included, but only uncommitted writes (or a BEGIN
+        # sent by the caller) are lost with it.
+        return self._pool is None and self._pending_writes
+
+    def _mark_write(self, query_template):
+        if self._pool is None and not is_read_query(query_template):
+            self._pending_writes = True
+
+    def _discard_aborted_transaction(self, in_transaction):
+        # The transaction is aborted: nothing else can run in the shared connection until it is rolled back. If it
+        # was opened by the caller, the caller must roll it back, knowing what was lost.
+        if not in_transaction and self._conn is not None and not self._conn.closed:
+            self._conn.rollback()
 
     def execute_query(self, query_template, params, **opts):
         data = {
@@ -33,33 +126,101 @@ class PostgresDataSource(DataSource):
             'rows': []
         }
 
-        self._cursor.execute(query_template, params)
-
-        if self._cursor.description:
-            data['fields'] = self._cursor.description
-            data['rows'] = self._cursor.fetchall()
-
-        if self._auto_commit:
-            self.commit()
+        in_transaction = False
+        try:
+            with self._checkout_cursor() as cursor:
+                in_transaction = self._in_transaction()
+                cursor.execute(query_template, params)
+                self._mark_write(query_template)
+
+                if cursor.description:
+                    data['fields'] = cursor.description
+                    data['rows'] = cursor.fetchall()
+        except psycopg2.extensions.QueryCanceledError as e:
+            # statement_timeout, or cancelled by the server: running it again would take as long
+            self._discard_aborted_transaction(in_transaction)
+            raise LongitudeQueryTimeoutException(str(e)) from e
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            # Connection errors (and server shutdowns, serialization failures...)
+            self._discard_aborted_transaction(in_transaction)
+            if in_transaction:
+                # Uncommitted changes of the caller were lost with the transaction: a transparent retry would hide it
+                raise LongitudeQueryCannotBeExecutedException(
+                    'Transaction aborted, its uncommitted changes were lost. Call .rollback() to go on: %s' % e
+                ) from e
+            raise LongitudeTransientError(str(e)) from e
 
         return data
 
+    def query_iter(self, query_template, params=None, fetch_size=None, batches=False, **opts):
+        """
+        Uses a named (server-side) cursor, so rows stay in the database until they are fetched.
+        """
+        fetch_size = fetch_size or self.fetch_size
+        with self._checkout_connection() as conn:
+            cursor = conn.cursor(name='longitude_%s' % uuid.uuid4().hex)
+            cursor.itersize = fetch_size
+            try:
+                cursor.execute(query_template, params or {})
+                fields_names = None
+                while True:
+                    chunk = cursor.fetchmany(fetch_size)
+                    if not chunk:
+                        break
+                    if fields_names is None:
+                        # Named cursors only have a description after the first fetch
+                        fields_names = [d.name for d in cursor.description]
+                    rows = [dict(zip(fields_names, row)) for row in chunk]
+                    if batches:
+                        yield rows
+                    else:
+                        yield from rows
+            finally:
+                cursor.close()
+
     def commit(self):
-        self._conn.commit()
+        # In pooled mode, transactions are committed when the connection is given back to the pool
+        if self._conn:
+            self._conn.commit()
+            self._pending_writes = False
+
+    def rollback(self):
+        if self._conn and not self._conn.closed:
+            self._conn.rollback()
+        self._pending_writes = False
 
     def parse_response(self, response):
         if response:
             raw_fields = response['fields']
             fields_names = {n.name: {'type': psycopg2_type_as_string(n.type_code)} for n in raw_fields}
-            rows = [dict(zip(fields_names.keys(), row)) for row in response['rows']]
-            return LongitudeQueryResponse(rows=rows, fields=fields_names)
+            return build_response([n.name for n in raw_fields], fields_names, response['rows'], self.compact_rows)
         return None
 
     def copy_from(self, data, filepath, to_table):
-        headers = data.readline().decode('utf-8').split(',')
-        self._cursor.copy_from(data, to_table, columns=headers, sep=',')
-        if self._auto_commit:
-            self.commit()
+        columns = parse_csv_header(data.readline())
+        with self._checkout_cursor() as cursor:
+            cursor.copy_expert(copy_from_query(to_table, columns), data)
+            self._pending_writes = self._pool is None
+
+    @contextmanager
+    def _dedicated_connection(self):
+        # Parallel copies cannot share the connection of the non pooled mode: each one opens its own
+        if self._pool is not None:
+            with self._pool.connection() as conn:
+                yield conn
+            return
+
+        conn = psycopg2.connect(**self._connection_options)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def copy_chunk(self, data, to_table, columns):
+        with self._dedicated_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(copy_from_query(to_table, columns), io.BytesIO(data))
 
     def write_dataframe(self, *args, **kwargs):
         raise NotImplementedError('Use the SQLAlchemy data source if you need dataframes!')
@@ -69,7 +230,13 @@ class PostgresDataSource(DataSource):
         #  the use of SQLAlchemy for such tasks
         raise NotImplementedError('Use the SQLAlchemy data source if you need dataframes!')
 
-    def query_dataframe(self, *args, **kwargs):
-        # TODO: It is possible to read dataframes using psycopg2, but we do not support it for now to encourage
-        #  the use of SQLAlchemy for such tasks
-        raise NotImplementedError('Use the SQLAlchemy data source if you need dataframes!')
+    def query_dataframe(self, query='', params=None, chunksize=None, spool_max_size_bytes=DEFAULT_SPOOL_MAX_SIZE_BYTES,
+                        **kwargs):
+        """
+        Reads the result of a query through COPY TO STDOUT, parsed into columns by pyarrow (if installed) or pandas.
+
+        :param chunksize: If given, an iterator of DataFrames with up to chunksize rows is returned
+        :param spool_max_size_bytes: Size of the copied data kept in memory. Bigger results are spooled to disk.
+        """
+        with self._checkout_cursor() as cursor:
+            return copy_to_dataframe(cursor, query, params, chunksize, spool_max_size_bytes)
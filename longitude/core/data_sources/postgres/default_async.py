@@ -0,0 +1,134 @@
+import asyncio
+
+import asyncpg
+
+from ...common.exceptions import (LongitudeQueryCannotBeExecutedException, LongitudeQueryTimeoutException,
+                                  LongitudeTransientError)
+from ..base_async import AsyncDataSource
+from .common import build_response, psycopg2_type_as_string, pyformat_to_numeric
+
+# Errors worth retrying: connections lost or refused, and transactions aborted by concurrency. Timeouts are OSError
+# too (since Python 3.11), but they are not retried.
+TRANSIENT_ERRORS = (
+    OSError,
+    asyncpg.ConnectionDoesNotExistError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.TooManyConnectionsError,
+    asyncpg.SerializationError,
+    asyncpg.DeadlockDetectedError
+)
+
+
+class PostgresAsyncDataSource(AsyncDataSource):
+    """
+    Non-blocking PostgreSQL data source built on asyncpg. Queries use the same psycopg2-style placeholders as
+    PostgresDataSource (i.e. %(name)s) and are executed over a connection pool owned by the data source.
+
+    The pool is created lazily on the first query, or when entering the data source as an async context manager:
+
+        async with PostgresAsyncDataSource(options) as ds:
+            ...
+    """
+
+    def __init__(self, options={}):
+        """
+        Pool options: 'pool_min_size' (1), 'pool_max_size' (10), 'pool_idle_timeout_s' (300, inactive connections are
+        closed after that time) and 'command_timeout_s' (None).
+        """
+        super().__init__(options)
+        self.options = {
+            'host': options.get('host', 'localhost'),
+            'port': options.get('port', 5432),
+            'database': options.get('db', ''),
+            'user': options.get('user', 'postgres'),
+            'password': options.get('password', '')
+        }
+        self.pool_min_size = options.get('pool_min_size', 1)
+        self.pool_max_size = options.get('pool_max_size', 10)
+        self.pool_idle_timeout_s = options.get('pool_idle_timeout_s', 300)
+        self.command_timeout_s = options.get('command_timeout_s')
+
+        self._pool = None
+        self._pool_lock = None
+
+    async def __aenter__(self):
+        await self._get_pool()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _get_pool(self):
+        if self._pool is None:
+            # The lock is created here so it is bound to the running event loop
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        min_size=self.pool_min_size,
+                        max_size=self.pool_max_size,
+                        max_inactive_connection_lifetime=self.pool_idle_timeout_s,
+                        command_timeout=self.command_timeout_s,
+                        **self.options
+                    )
+        return self._pool
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def execute_query(self, query_template, params, query_config, **opts):
+        query, args = pyformat_to_numeric(query_template, params)
+        pool = await self._get_pool()
+
+        try:
+            async with pool.acquire() as conn:
+                statement = await conn.prepare(query)
+                return {
+                    'fields': statement.get_attributes(),
+                    'rows': await statement.fetch(*args)
+                }
+        except (asyncio.TimeoutError, asyncpg.QueryCanceledError) as e:
+            # command_timeout or statement_timeout: running it again would most likely time out again
+            raise LongitudeQueryTimeoutException(str(e) or e.__class__.__name__) from e
+        except TRANSIENT_ERRORS as e:
+            raise LongitudeTransientError(str(e)) from e
+        except (asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            raise LongitudeQueryCannotBeExecutedException(str(e)) from e
+
+    async def query_iter(self, query_template, params=None, fetch_size=None, batches=False, **opts):
+        """
+        Asynchronous generator version of DataSource.query_iter. Rows are read through a server-side cursor, inside a
+        transaction, over a connection borrowed from the pool for the whole iteration.
+
+            async for row in ds.query_iter('SELECT * FROM big_table'):
+                ...
+        """
+        fetch_size = fetch_size or self.fetch_size
+        query, args = pyformat_to_numeric(query_template, params)
+        pool = await self._get_pool()
+
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(query, *args)
+                while True:
+                    chunk = await cursor.fetch(fetch_size)
+                    if not chunk:
+                        break
+                    rows = [dict(record) for record in chunk]
+                    if batches:
+                        yield rows
+                    else:
+                        for row in rows:
+                            yield row
+
+    def parse_response(self, response):
+        if response:
+            # Types are named by their OID, as PostgresDataSource does, and not with the names of asyncpg
+            fields_names = {a.name: {'type': psycopg2_type_as_string(a.type.oid)} for a in response['fields']}
+            return build_response([a.name for a in response['fields']], fields_names, response['rows'],
+                                  self.compact_rows, copy_tuples=True, row_as_dict=dict)
+        return None
@@ -0,0 +1,182 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+
+from ...common.exceptions import LongitudeConfigError, LongitudeQueryCannotBeExecutedException
+
+
+class PostgresConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+
+    Connections are borrowed for a single unit of work (i.e. one query) and given back afterwards. Borrowed
+    connections are checked before being handed out, and connections that stay idle for too long are closed as long
+    as the pool keeps, at least, min_size of them open.
+    """
+
+    def __init__(self, connection_options, min_size=1, max_size=10, health_check=True, idle_timeout_s=300,
+                 checkout_timeout_s=None):
+        """
+        :param connection_options: Keyword arguments for psycopg2.connect
+        :param min_size: Connections opened at start and never reaped
+        :param max_size: Maximum number of connections open at the same time
+        :param health_check: If True, borrowed connections are tested with a 'SELECT 1' before being returned
+        :param idle_timeout_s: Seconds a connection can stay idle before being closed. None disables reaping.
+        :param checkout_timeout_s: Seconds to wait for a free connection. None waits forever.
+        """
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise LongitudeConfigError('Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1')
+
+        self._connection_options = connection_options
+        self.min_size = min_size
+        self.max_size = max_size
+        self.health_check = health_check
+        self.idle_timeout_s = idle_timeout_s
+        self.checkout_timeout_s = checkout_timeout_s
+
+        self._condition = threading.Condition()
+        self._idle = []  # List of (connection, last_used_timestamp). Most recently used at the end.
+        self._in_use = set()
+        self._connecting = 0  # Slots reserved by threads that are opening a new connection
+        self._closed = False
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    @property
+    def size(self):
+        """Number of connections currently open (idle or in use)."""
+        with self._condition:
+            return len(self._idle) + self._busy()
+
+    def _busy(self):
+        return len(self._in_use) + self._connecting
+
+    def _connect(self):
+        return psycopg2.connect(**self._connection_options)
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if not self.health_check:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _reap_idle(self):
+        # Must be called with the condition acquired
+        if self.idle_timeout_s is None:
+            return
+        deadline = time.monotonic() - self.idle_timeout_s
+        reapable = len(self._idle) + self._busy() - self.min_size
+        # Least recently used connections are at the beginning of the list
+        while reapable > 0 and self._idle and self._idle[0][1] < deadline:
+            conn, _ = self._idle.pop(0)
+            self._discard(conn)
+            reapable -= 1
+
+    def getconn(self):
+        """
+        Borrows a connection from the pool, opening a new one if none is idle and max_size has not been reached.
+
+        :raise LongitudeQueryCannotBeExecutedException if no connection is available after checkout_timeout_s
+        :return: psycopg2 connection
+        """
+        deadline = None if self.checkout_timeout_s is None else time.monotonic() + self.checkout_timeout_s
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise LongitudeQueryCannotBeExecutedException('Connection pool is closed')
+                self._reap_idle()
+                if self._idle:
+                    conn, _ = self._idle.pop()
+                    break
+                if self._busy() < self.max_size:
+                    conn = None
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise LongitudeQueryCannotBeExecutedException(
+                        'No connection available in pool after %s seconds' % self.checkout_timeout_s
+                    )
+                self._condition.wait(remaining)
+            # The slot is reserved before checking or connecting so other threads cannot exceed max_size
+            self._connecting += 1
+
+        try:
+            if conn is not None and not self._is_healthy(conn):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except BaseException:
+            with self._condition:
+                self._connecting -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._connecting -= 1
+            self._in_use.add(id(conn))
+        return conn
+
+    def putconn(self, conn, close=False):
+        """
+        Gives a borrowed connection back to the pool. Any open transaction is rolled back.
+
+        :param conn: Connection obtained with getconn()
+        :param close: If True, the connection is closed instead of being kept for reuse
+        """
+        if not close and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        with self._condition:
+            self._in_use.discard(id(conn))
+            if close or conn.closed or self._closed:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._reap_idle()
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that borrows a connection and gives it back on exit. The transaction is committed if the block
+        finishes without errors and rolled back otherwise.
+        """
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def closeall(self):
+        with self._condition:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+            self._condition.notify_all()
@@ -1,12 +1,17 @@
+import io
+
 from pandas import read_sql_table, read_sql_query
 
 from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 
-from longitude.core.common.query_response import LongitudeQueryResponse
+from longitude.core.common.exceptions import LongitudeTransientError
 from longitude.core.data_sources.base import DataSource
+from longitude.core.data_sources.copy_pipeline import copy_from_query, parse_csv_header
 
-from .common import psycopg2_type_as_string
+from .common import build_response, psycopg2_type_as_string
+from .dataframes import UPSERT, copy_to_dataframe, geometry_dtypes, to_sql_arguments
 
 
 class SQLAlchemyDataSource(DataSource):
@@ -29,6 +34,11 @@ class SQLAlchemyDataSource(DataSource):
     def create_all(self):
         self.base_class.metadata.create_all(self._engine)
 
+    @property
+    def thread_safe(self):
+        # Every query goes through the same connection
+        return False
+
     def __init__(self, options={}):
         # https://docs.sqlalchemy.org/en/latest/dialects/postgresql.html
 
@@ -57,7 +67,12 @@ class SQLAlchemyDataSource(DataSource):
             'rows': []
         }
 
-        response = self._connection.execute(query_template, params)
+        try:
+            response = self._connection.execute(query_template, params)
+        except DBAPIError as e:
+            if isinstance(e, OperationalError) or e.connection_invalidated:
+                raise LongitudeTransientError(str(e)) from e
+            raise
 
         if response.returns_rows:
             data['fields'] = response.cursor.description
@@ -67,6 +82,27 @@ class SQLAlchemyDataSource(DataSource):
 
         return data
 
+    def query_iter(self, query_template, params=None, fetch_size=None, batches=False, **opts):
+        """
+        Uses the stream_results execution option, so the psycopg2 dialect fetches rows through a server-side cursor.
+        """
+        fetch_size = fetch_size or self.fetch_size
+        connection = self._connection.execution_options(stream_results=True, max_row_buffer=fetch_size)
+        response = connection.execute(query_template, params or {})
+        try:
+            fields_names = list(response.keys())
+            while True:
+                chunk = response.fetchmany(fetch_size)
+                if not chunk:
+                    break
+                rows = [dict(zip(fields_names, row)) for row in chunk]
+                if batches:
+                    yield rows
+                else:
+                    yield from rows
+        finally:
+            response.close()
+
     def commit(self):
         self._connection.commit()
 
@@ -74,22 +110,64 @@ class SQLAlchemyDataSource(DataSource):
         if response:
             raw_fields = response['fields']
             fields_names = {n.name: {'type': psycopg2_type_as_string(n.type_code)} for n in raw_fields}
-            rows = [dict(zip(fields_names.keys(), row)) for row in response['rows']]
-            return LongitudeQueryResponse(rows=rows, fields=fields_names)
+            # SQLAlchemy rows keep a reference to the result metadata, plain tuples are lighter
+            return build_response([n.name for n in raw_fields], fields_names, response['rows'], self.compact_rows,
+                                  copy_tuples=True)
         return None
 
     def copy_from(self, data, filepath, to_table):
-        headers = data.readline().decode('utf-8').split(',')
+        columns = parse_csv_header(data.readline())
         conn = self._engine.raw_connection()
-        conn.cursor().copy_from(data, to_table, columns=headers, sep=',')
+        conn.cursor().copy_expert(copy_from_query(to_table, columns), data)
         if self._auto_commit:
             self.commit()
 
+    def copy_chunk(self, data, to_table, columns):
+        # Raw connections come from the (thread-safe) engine pool, so chunks are copied over different connections
+        conn = self._engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(copy_from_query(to_table, columns), io.BytesIO(data))
+            conn.commit()
+        finally:
+            conn.close()
+
     def read_dataframe(self, table_name='', *args, **kwargs):
         return read_sql_table(table_name=table_name, con=self._engine)
 
-    def query_dataframe(self, query='', *args, **kwargs):
-        return read_sql_query(sql=query, con=self._engine, *args, **kwargs)
+    def query_dataframe(self, query='', *args, copy=False, **kwargs):
+        """
+        :param copy: If True, the result is read through COPY TO STDOUT and parsed into columns by pyarrow (if
+            installed) or pandas, which is much faster for big results. Only the params, chunksize and
+            spool_max_size_bytes keyword arguments are supported then. Otherwise, pandas.read_sql_query is used.
+        """
+        if not copy:
+            return read_sql_query(sql=query, con=self._engine, *args, **kwargs)
 
-    def write_dataframe(self, df, table_name='', *args, **kwargs):
-        return df.to_sql(name=table_name, con=self._engine, *args, **kwargs)
+        conn = self._engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                return copy_to_dataframe(cursor, query, **kwargs)
+        finally:
+            conn.close()
+
+    def write_dataframe(self, df, table_name='', *args, if_exists='fail', method=None, upsert_keys=None, srid=None,
+                        **kwargs):
+        """
+        Writes the DataFrame with pandas.DataFrame.to_sql, which creates the table if needed. With method='copy', rows
+        are streamed through COPY FROM STDIN instead of inserted one by one, geometry values are written as WKB and
+        new tables get geometry columns for them.
+
+        :param if_exists: 'fail', 'replace' or 'append', as in to_sql, or 'upsert' to append the rows updating the
+            existing ones with the same upsert_keys (always copied)
+        :param method: Any of the to_sql methods (None by default, 'multi' or a callable) or 'copy'
+        :param upsert_keys: Columns with a unique constraint used to match rows when upserting
+        :param srid: SRID written along with the geometry values, if their columns need one
+        """
+        copies = method == 'copy' or if_exists == UPSERT
+        if_exists, method = to_sql_arguments(if_exists, method, upsert_keys, srid)
+        dtype = kwargs.get('dtype')
+        if copies and (dtype is None or isinstance(dtype, dict)):
+            # Given column types win over the geometry ones
+            kwargs['dtype'] = {**geometry_dtypes(df, srid), **(dtype or {})}
+        return df.to_sql(table_name, self._engine, *args, if_exists=if_exists, method=method, **kwargs)
@@ -1,8 +1,12 @@
-from unittest import TestCase
+import datetime
+import decimal
+from unittest import TestCase, mock
 
 from longitude.core.common.query_response import LongitudeQueryResponse
 
 from ..caches.base import LongitudeCache
+from ..caches.keys import template_digest
+from ..common.exceptions import LongitudeConfigError
 from longitude.core.tests.utils import async_test
 
 
@@ -47,3 +51,88 @@ class TestLongitudeCache(TestCase):
             await cache.get_async('some query', {})
         with self.assertRaises(NotImplementedError):
             await cache.put_async('some query', payload=LongitudeQueryResponse())
+
+    @mock.patch('longitude.core.caches.base.time.time')
+    def test_stale_payloads_are_kept_longer_and_need_refresh(self, time_mock):
+        time_mock.return_value = 1000
+        cache = LongitudeCache({'expiration_time_s': 60, 'stale_ttl_s': 30})
+        payload = LongitudeQueryResponse()
+
+        self.assertEqual(90, cache._prepare_expiration(payload, None))
+        self.assertEqual(1060, payload.expires_at)
+        self.assertFalse(cache.needs_refresh(payload))
+
+        time_mock.return_value = 1061
+        self.assertTrue(cache.needs_refresh(payload))
+
+    def test_without_early_refresh_expiration_is_untouched(self):
+        cache = LongitudeCache({'expiration_time_s': 60})
+        payload = LongitudeQueryResponse()
+        self.assertEqual(60, cache._prepare_expiration(payload, None))
+        self.assertIsNone(payload.expires_at)
+        self.assertFalse(cache.needs_refresh(payload))
+
+    @mock.patch('longitude.core.caches.base.random.random')
+    @mock.patch('longitude.core.caches.base.time.time')
+    def test_early_refresh_depends_on_compute_time(self, time_mock, random_mock):
+        time_mock.return_value = 1000
+        cache = LongitudeCache({'early_refresh_beta': 1.0})
+        payload = LongitudeQueryResponse()
+        payload.expires_at = 1010
+
+        random_mock.return_value = 0.5
+        payload.compute_time_s = 1
+        self.assertFalse(cache.needs_refresh(payload))
+        payload.compute_time_s = 20
+        self.assertTrue(cache.needs_refresh(payload))
+
+    def test_keys_do_not_depend_on_params_ordering(self):
+        self.assertEqual(
+            LongitudeCache.generate_key('SELECT %(a)s, %(b)s', {'a': 1, 'b': 'x'}),
+            LongitudeCache.generate_key('SELECT %(a)s, %(b)s', {'b': 'x', 'a': 1})
+        )
+
+    def test_keys_distinguish_values_that_are_adapted_differently(self):
+        keys = set(LongitudeCache.generate_key('SELECT %(a)s', {'a': value}) for value in [
+            1, '1', 1.0, True, None, (1, 2), [1, 2], decimal.Decimal('1'), datetime.date(2020, 1, 1),
+            '2020-01-01', b'1', {'1': 1}
+        ])
+        self.assertEqual(12, len(keys))
+
+    def test_templates_digests_are_memoized(self):
+        template_digest.cache_clear()
+        for _ in range(10):
+            LongitudeCache.generate_key('SOME_LONG_QUERY', {'a': 1})
+        self.assertEqual(1, template_digest.cache_info().misses)
+
+    def test_key_hash_is_configurable(self):
+        cache = LongitudeCache({'key_hash': 'blake2b'})
+        self.assertEqual('longitude:', cache.cache_key('SELECT 1', {})[:10])
+        self.assertEqual(32, len(cache.cache_key('SELECT 1', {})[10:]))
+        self.assertNotEqual(LongitudeCache().cache_key('SELECT 1', {}), cache.cache_key('SELECT 1', {}))
+
+        with self.assertRaises(LongitudeConfigError):
+            LongitudeCache({'key_hash': 'md5'})
+
+    def test_overridden_generate_key(self):
+        class CustomKeyCache(LongitudeCache):
+            @staticmethod
+            def generate_key(query_template, params):
+                return '%s-%s' % (query_template, params['a'])
+
+        cache = CustomKeyCache({'key_hash': 'blake2b'})
+        self.assertEqual('longitude:SELECT 1-x', cache.cache_key('SELECT 1', {'a': 'x'}))
+
+    def test_batch_operations_fall_back_to_single_key_ones(self):
+        cache = LongitudeCache()
+        cache.execute_get = mock.MagicMock(return_value=None)
+        cache.execute_put = mock.MagicMock(return_value=False)
+
+        self.assertEqual([None, None], cache.get_many([('q1', {}), ('q2', {})]))
+        self.assertEqual(2, cache.execute_get.call_count)
+
+        self.assertEqual([False], cache.put_many([('q1', {}, LongitudeQueryResponse())], expiration_time_s=5))
+        cache.execute_put.assert_called_once_with(mock.ANY, mock.ANY, expiration_time_s=5)
+
+        with self.assertRaises(TypeError):
+            cache.put_many([('q1', {}, 'not a response')])
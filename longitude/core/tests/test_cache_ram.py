@@ -1,4 +1,5 @@
-from unittest import TestCase
+import threading
+from unittest import TestCase, mock
 
 from longitude.core.common.query_response import LongitudeQueryResponse
 
@@ -31,6 +32,7 @@ class TestRedisCache(TestCase):
         self.assertIsNone(await self.cache.get_async('fake_key'))
         payload = LongitudeQueryResponse()
         payload.meta['value'] = 42
+        self.assertFalse(await self.cache.put_async('key', payload))
         self.assertTrue(await self.cache.put_async('key', payload))
 
         result = await self.cache.get_async('key')
@@ -38,3 +40,150 @@ class TestRedisCache(TestCase):
 
         await self.cache.flush_async()
         self.assertIsNone(await self.cache.get_async('key'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = RamCache({'max_entries': 2})
+        cache.execute_put('a', 1)
+        cache.execute_put('b', 2)
+        cache.execute_get('a')
+        cache.execute_put('c', 3)
+
+        self.assertIsNone(cache.execute_get('b'))
+        self.assertEqual(1, cache.execute_get('a'))
+        self.assertEqual(3, cache.execute_get('c'))
+        self.assertEqual(1, cache.stats['evictions'])
+        self.assertEqual(2, cache.stats['entries'])
+
+    def test_size_limit_evicts_entries(self):
+        cache = RamCache({'max_entries': None, 'max_size_bytes': 1000})
+        cache.execute_put('a', 'x' * 400)
+        cache.execute_put('b', 'x' * 400)
+        cache.execute_put('c', 'x' * 400)
+
+        self.assertIsNone(cache.execute_get('a'))
+        self.assertLessEqual(cache.stats['size_bytes'], 1000)
+
+        # Payloads bigger than the whole cache are not stored
+        cache.execute_put('d', 'x' * 2000)
+        self.assertIsNone(cache.execute_get('d'))
+        self.assertIsNotNone(cache.execute_get('c'))
+
+    @mock.patch('longitude.core.caches.ram.time.monotonic')
+    def test_entries_expire(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        cache = RamCache({'expiration_time_s': 10})
+        cache.execute_put('default', 1)
+        cache.execute_put('custom', 2, expiration_time_s=60)
+
+        monotonic_mock.return_value = 111
+        self.assertIsNone(cache.execute_get('default'))
+        self.assertEqual(2, cache.execute_get('custom'))
+
+        monotonic_mock.return_value = 161
+        self.assertIsNone(cache.execute_get('custom'))
+        self.assertEqual(2, cache.stats['expirations'])
+
+    def test_hits_and_misses_are_counted(self):
+        self.cache.execute_put('a', 1)
+        self.cache.execute_get('a')
+        self.cache.execute_get('b')
+        self.assertEqual(1, self.cache.stats['hits'])
+        self.assertEqual(1, self.cache.stats['misses'])
+
+    def test_instances_do_not_share_values(self):
+        other = RamCache()
+        self.cache.execute_put('a', 1)
+        self.assertIsNone(other.execute_get('a'))
+
+        other.execute_put('b', 2)
+        self.cache.flush()
+        self.assertEqual(2, other.execute_get('b'))
+
+    def test_named_stores_are_shared(self):
+        self.addCleanup(RamCache.drop_shared_store, 'tenant')
+        first = RamCache({'store_name': 'tenant'})
+        second = RamCache({'store_name': 'tenant'})
+
+        payload = LongitudeQueryResponse()
+        first.put('SELECT 1', payload=payload)
+        self.assertIs(payload, second.get('SELECT 1'))
+
+        second.flush()
+        self.assertIsNone(first.get('SELECT 1'))
+
+    def test_flush_of_a_shared_store_keeps_other_namespaces(self):
+        self.addCleanup(RamCache.drop_shared_store, 'tenants')
+        a = RamCache({'store_name': 'tenants', 'namespace': 'a'})
+        b = RamCache({'store_name': 'tenants', 'namespace': 'b'})
+        a.put('SELECT 1', payload=LongitudeQueryResponse(), tags=['t'])
+        b.put('SELECT 1', payload=LongitudeQueryResponse(meta={'tenant': 'b'}), tags=['t'])
+
+        a.flush()
+        self.assertIsNone(a.get('SELECT 1'))
+        self.assertEqual({'tenant': 'b'}, b.get('SELECT 1').meta)
+        self.assertEqual(1, a.stats['entries'])
+        self.assertEqual(1, b.invalidate_tags(['t']))
+
+        # Without namespace, the whole store is flushed
+        a.put('SELECT 1', payload=LongitudeQueryResponse())
+        RamCache({'store_name': 'tenants', 'namespace': ''}).flush()
+        self.assertEqual(0, a.stats['entries'])
+
+    def test_concurrent_access_keeps_limits(self):
+        cache = RamCache({'max_entries': 50})
+
+        def worker(prefix):
+            for i in range(500):
+                cache.execute_put('%s_%d' % (prefix, i), i)
+                cache.execute_get('%s_%d' % (prefix, i // 2))
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats = cache.stats
+        self.assertEqual(50, stats['entries'])
+        self.assertEqual(8 * 500, stats['hits'] + stats['misses'])
+        self.assertEqual(8 * 500 - 50, stats['evictions'])
+
+    def test_batch_get_and_put(self):
+        responses = [LongitudeQueryResponse(meta={'n': n}) for n in range(3)]
+        overwritten = self.cache.put_many([('query_%d' % n, {'n': n}, r) for n, r in enumerate(responses)])
+        self.assertEqual([False, False, False], overwritten)
+
+        results = self.cache.get_many([('query_0', {'n': 0}), ('missing', None), ('query_2', {'n': 2})])
+        self.assertEqual(0, results[0].meta['n'])
+        self.assertIsNone(results[1])
+        self.assertEqual(2, results[2].meta['n'])
+
+    @async_test
+    async def test_batch_get_and_put_async(self):
+        await self.cache.put_many_async([('query', None, LongitudeQueryResponse(meta={'n': 1}))])
+        results = await self.cache.get_many_async([('query', {}), ('other', {})])
+        self.assertEqual(1, results[0].meta['n'])
+        self.assertIsNone(results[1])
+
+    def test_namespaced_keys(self):
+        self.assertTrue(self.cache.cache_key('query', {}).startswith('longitude:'))
+        other = RamCache({'namespace': 'tenant'})
+        self.assertTrue(other.cache_key('query', {}).startswith('tenant:'))
+        self.assertNotIn(':', RamCache({'namespace': ''}).cache_key('query', {}))
+
+    def test_tag_invalidation(self):
+        self.cache.put('query_a', LongitudeQueryResponse(), tags=['table_a'])
+        self.cache.put('query_b', LongitudeQueryResponse(), tags=['table_a', 'table_b'])
+        self.cache.put('query_c', LongitudeQueryResponse(), tags=['table_c'])
+
+        self.assertEqual(2, self.cache.invalidate_tags(['table_b', 'table_a']))
+        self.assertIsNone(self.cache.get('query_a'))
+        self.assertIsNone(self.cache.get('query_b'))
+        self.assertIsNotNone(self.cache.get('query_c'))
+        self.assertEqual(0, self.cache.invalidate_tags(['table_a']))
+
+    @async_test
+    async def test_tag_invalidation_async(self):
+        await self.cache.put_async('query', LongitudeQueryResponse(), tags=['table'])
+        self.assertEqual(1, await self.cache.invalidate_tags_async(['table']))
+        self.assertIsNone(await self.cache.get_async('query'))
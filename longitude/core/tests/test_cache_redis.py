@@ -1,8 +1,14 @@
-from unittest import TestCase, mock
+from unittest import TestCase, mock, skipIf
 
 from longitude.core.common.query_response import LongitudeQueryResponse
 
-from ..caches.redis import RedisCache
+from ..caches.redis import TAG_SCRIPT, RedisCache
+from longitude.core.tests.utils import async_test
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 TESTED_MODULE_PATH = 'longitude.core.caches.redis.%s'
 
@@ -24,15 +30,143 @@ class TestRedisCache(TestCase):
         self.assertIsNone(self.cache.get('fake_key'))
         self.redis_mock.return_value.get.assert_called_once()
 
-        self.redis_mock.return_value.set.return_value = None
+        pipeline = self.redis_mock.return_value.pipeline.return_value
+        pipeline.execute.return_value = [0, True]
         self.assertFalse(self.cache.put('some_key', LongitudeQueryResponse()))
-        self.redis_mock.return_value.exists.return_value = 1
+        pipeline.execute.return_value = [1, True]
         self.assertTrue(self.cache.put('some_key', LongitudeQueryResponse()))
-        self.assertEqual(2, self.redis_mock.return_value.set.call_count)
+        self.assertEqual(2, pipeline.set.call_count)
+        self.assertEqual(2, pipeline.execute.call_count)
+        self.redis_mock.return_value.pipeline.assert_called_with(transaction=True)
+
+    def test_flush_only_unlinks_namespace_keys(self):
+        client = self.redis_mock.return_value
+        client.scan_iter.return_value = iter(['longitude:a', 'longitude:b', 'longitude:c'])
+        client.unlink.return_value = 2
+        cache = RedisCache({'scan_count': 2})
+        cache.flush()
+        client.scan_iter.assert_called_once_with(match='longitude:*', count=2)
+        client.unlink.assert_has_calls([mock.call('longitude:a', 'longitude:b'), mock.call('longitude:c')])
+        client.flushall.assert_not_called()
+        client.flushdb.assert_not_called()
+
+        RedisCache({'namespace': ''}).flush()
+        client.flushdb.assert_called_once()
+        client.flushall.assert_not_called()
 
-        self.redis_mock.return_value.flushall.return_value = None
-        self.cache.flush()
-        self.redis_mock.return_value.flushall.assert_called_once()
+    def test_tags_are_namespaced_sets(self):
+        client = self.redis_mock.return_value
+        pipeline = client.pipeline.return_value
+        pipeline.execute.return_value = [0, True]
+        self.cache.put('some_query', LongitudeQueryResponse(), tags=['table_a'])
+        key = self.cache.cache_key('some_query', {})
+        client.register_script.assert_called_once_with(TAG_SCRIPT)
+        client.register_script.return_value.assert_called_once_with(keys=[key, 'longitude:tag:table_a'], args=[])
+
+        client.zscan_iter.return_value = iter([(key, 1.0)])
+        client.unlink.return_value = 1
+        self.assertEqual(1, self.cache.invalidate_tags(['table_a']))
+        client.zscan_iter.assert_called_once_with('longitude:tag:table_a', count=1000)
+        client.unlink.assert_has_calls([mock.call(key), mock.call('longitude:tag:table_a')])
 
     def test_is_not_ready_if_redis_fails_ping_because_of_timeout(self):
         self.redis_mock.return_value.ping.side_effect = TimeoutError
+
+    def test_connection_pools_are_shared(self):
+        RedisCache({'db': 5})._redis
+        RedisCache({'db': 5})._redis
+        RedisCache({'db': 6, 'max_connections': 3})._redis
+
+        pools = [call[1]['connection_pool'] for call in self.redis_mock.call_args_list]
+        self.assertIs(pools[0], pools[1])
+        self.assertIsNot(pools[0], pools[2])
+        self.assertEqual(3, pools[2].max_connections)
+
+    def test_put_uses_expiration(self):
+        cache = RedisCache({'expiration_time_s': 60})
+        pipeline = self.redis_mock.return_value.pipeline.return_value
+        pipeline.execute.return_value = [0, True]
+
+        cache.execute_put('key', b'payload')
+        pipeline.set.assert_called_with(name='key', value=b'payload', ex=60)
+        cache.execute_put('key', b'payload', expiration_time_s=5)
+        pipeline.set.assert_called_with(name='key', value=b'payload', ex=5)
+
+    def test_bulk_operations_use_a_single_round_trip(self):
+        self.redis_mock.return_value.mget.return_value = [b'a', None]
+        self.assertEqual([b'a', None], self.cache.execute_get_many(['k1', 'k2']))
+        self.redis_mock.return_value.mget.assert_called_once_with(['k1', 'k2'])
+
+        pipeline = self.redis_mock.return_value.pipeline.return_value
+        pipeline.execute.return_value = [1, True, 0, True]
+        self.assertEqual([True, False], self.cache.execute_put_many([('k1', b'a'), ('k2', b'b')]))
+        pipeline.execute.assert_called_once()
+        self.redis_mock.return_value.pipeline.assert_called_with(transaction=False)
+
+    @mock.patch(TESTED_MODULE_PATH % 'StrictRedis')
+    @async_test
+    async def test_async_put_is_a_single_transaction(self, aredis_mock):
+        pipeline = mock.MagicMock()
+        pipeline.exists = mock.AsyncMock()
+        pipeline.set = mock.AsyncMock()
+        pipeline.execute = mock.AsyncMock(return_value=[1, True])
+        aredis_mock.return_value.pipeline = mock.AsyncMock(return_value=pipeline)
+
+        self.assertTrue(await self.cache.execute_put_async('key', b'payload'))
+        aredis_mock.return_value.pipeline.assert_called_once_with(transaction=True)
+        pipeline.execute.assert_called_once()
+
+    def test_pub_sub_channels_are_namespaced(self):
+        client = self.redis_mock.return_value
+        self.cache.publish('channel', 'message')
+        client.publish.assert_called_once_with('longitude:channel', 'message')
+
+        callback = mock.MagicMock()
+        self.cache.subscribe('channel', callback)
+        pubsub = client.pubsub.return_value
+        handler = pubsub.subscribe.call_args[1]['longitude:channel']
+        handler({'data': b'message'})
+        callback.assert_called_once_with(b'message')
+        pubsub.run_in_thread.assert_called_once()
+
+    def test_delete_many_unlinks_keys(self):
+        client = self.redis_mock.return_value
+        client.unlink.return_value = 2
+        self.assertEqual(2, self.cache.execute_delete_many(['a', 'b']))
+        client.unlink.assert_called_once_with('a', 'b')
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestRedisCacheTags(TestCase):
+    # Runs the Lua scripts in a fake server
+    def setUp(self):
+        self.cache = RedisCache()
+        self.cache._redis_client = fakeredis.FakeRedis()
+        self.client = self.cache._redis_client
+
+    def test_tags_expire_with_their_last_key(self):
+        self.cache.put('short', LongitudeQueryResponse(), tags=['t'], expiration_time_s=10)
+        self.cache.put('long', LongitudeQueryResponse(), tags=['t'], expiration_time_s=100)
+        self.cache.put('shorter', LongitudeQueryResponse(), tags=['t'], expiration_time_s=5)
+        self.assertEqual(3, self.client.zcard('longitude:tag:t'))
+        self.assertTrue(95 < self.client.ttl('longitude:tag:t') <= 101)
+
+        self.cache.put('soon', LongitudeQueryResponse(), tags=['u'], expiration_time_s=10)
+        self.cache.put('forever', LongitudeQueryResponse(), tags=['u'])
+        self.assertEqual(-1, self.client.ttl('longitude:tag:u'))
+
+    def test_expired_keys_are_pruned(self):
+        self.cache.put('a', LongitudeQueryResponse(), tags=['t'], expiration_time_s=60)
+        key = self.cache.cache_key('a', {})
+        # Scored as expired a second ago
+        self.client.zadd('longitude:tag:t', {key: 1})
+        self.cache.put('b', LongitudeQueryResponse(), tags=['t'])
+        self.assertEqual([self.cache.cache_key('b', {}).encode()], self.client.zrange('longitude:tag:t', 0, -1))
+
+    def test_invalidation(self):
+        self.cache.put('a', LongitudeQueryResponse(), tags=['t', 'u'])
+        self.cache.put('b', LongitudeQueryResponse(), tags=['u'])
+        self.assertEqual(1, self.cache.invalidate_tags(['t']))
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('b'))
+        self.assertFalse(self.client.exists('longitude:tag:t'))
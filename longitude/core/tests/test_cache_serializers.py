@@ -0,0 +1,117 @@
+import datetime
+import decimal
+from unittest import TestCase, skipIf
+
+from longitude.core.common.query_response import LongitudeQueryResponse
+
+from ..caches import serializers
+from ..caches.base import LongitudeCache
+from ..caches.serializers import (ArrowSerializer, CompressedSerializer, MsgpackSerializer, PickleSerializer,
+                                  build_serializer)
+from ..common.exceptions import LongitudeConfigError
+
+
+def sample_response(compact=False):
+    fields = {'id': {'type': 'INTEGER'}, 'name': {'type': 'STRING'}, 'created': {'type': 'DATETIME'},
+              'amount': {'type': 'DECIMAL'}}
+    tuples = [(i, 'name_%d' % i, datetime.datetime(2020, 1, 1, 12, i), decimal.Decimal('%d.50' % i))
+              for i in range(50)]
+    if compact:
+        response = LongitudeQueryResponse(tuples=tuples, fields=fields, meta={'total_rows': 50})
+    else:
+        rows = [dict(zip(fields, values)) for values in tuples]
+        response = LongitudeQueryResponse(rows=rows, fields=fields, meta={'total_rows': 50})
+    response.expires_at = 1000.5
+    response.compute_time_s = 0.25
+    return response
+
+
+class TestSerializers(TestCase):
+    def assertRoundTrip(self, serializer, compact):
+        original = sample_response(compact)
+        restored = serializer.loads(serializer.dumps(original))
+
+        self.assertEqual(compact, restored.is_compact)
+        self.assertEqual(list(original.rows), list(restored.rows))
+        self.assertEqual(original.fields, restored.fields)
+        self.assertEqual(original.meta, restored.meta)
+        self.assertEqual(1000.5, restored.expires_at)
+        self.assertEqual(0.25, restored.compute_time_s)
+
+    def test_pickle_round_trip(self):
+        self.assertRoundTrip(PickleSerializer(), compact=False)
+        self.assertRoundTrip(PickleSerializer(), compact=True)
+
+    @skipIf(serializers.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_round_trip(self):
+        self.assertRoundTrip(MsgpackSerializer(), compact=False)
+        self.assertRoundTrip(MsgpackSerializer(), compact=True)
+
+    @skipIf(serializers.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_keeps_irregular_rows(self):
+        response = LongitudeQueryResponse(rows=[{'a': 1}, {'b': b'\x00'}], fields={'a': {}})
+        serializer = MsgpackSerializer()
+        self.assertEqual([{'a': 1}, {'b': b'\x00'}], serializer.loads(serializer.dumps(response)).rows)
+
+    @skipIf(serializers.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_is_smaller_than_pickle(self):
+        response = sample_response()
+        self.assertLess(len(MsgpackSerializer().dumps(response)), len(PickleSerializer().dumps(response)))
+
+    @skipIf(serializers.pyarrow is None, 'pyarrow is not installed')
+    def test_arrow_round_trip(self):
+        self.assertRoundTrip(ArrowSerializer(), compact=False)
+        self.assertRoundTrip(ArrowSerializer(), compact=True)
+
+    @skipIf(serializers.pyarrow is None, 'pyarrow is not installed')
+    def test_arrow_refuses_what_it_cannot_keep(self):
+        serializer = ArrowSerializer()
+        empty = LongitudeQueryResponse(fields={'a': {}}, meta={'page': 1})
+        self.assertEqual(empty.meta, serializer.loads(serializer.dumps(empty)).meta)
+
+        for response in (
+                LongitudeQueryResponse(rows=[{}, {}]),
+                LongitudeQueryResponse(tuples=[(1,), (2,)]),
+                LongitudeQueryResponse(rows=[{'a': 1}], fields={'a': {}}, meta={'at': datetime.date(2020, 1, 1)}),
+                LongitudeQueryResponse(rows=[{'a': 1}], fields={'a': {}}, meta={1: (2, 3)})):
+            with self.assertRaises(TypeError):
+                serializer.dumps(response)
+        # Other serializers keep them
+        response = LongitudeQueryResponse(tuples=[(1,), (2,)])
+        self.assertEqual(2, len(PickleSerializer().loads(PickleSerializer().dumps(response)).rows))
+
+    def test_compression_depends_on_threshold(self):
+        serializer = CompressedSerializer(PickleSerializer(), codec='zlib', threshold_bytes=10 ** 6)
+        small = serializer.dumps(sample_response())
+        self.assertEqual(b'\x00', small[:1])
+
+        serializer.threshold_bytes = 0
+        compressed = serializer.dumps(sample_response())
+        self.assertEqual(b'\x01', compressed[:1])
+        self.assertLess(len(compressed), len(small))
+
+        # Any payload can be read, whatever the threshold
+        self.assertEqual(50, len(serializer.loads(small).rows))
+        self.assertEqual(50, len(serializer.loads(compressed).rows))
+
+    @skipIf(serializers.zstandard is None or serializers.lz4_frame is None, 'zstandard/lz4 are not installed')
+    def test_codecs_round_trip(self):
+        for codec in ('zstd', 'lz4'):
+            serializer = CompressedSerializer(PickleSerializer(), codec=codec, threshold_bytes=0)
+            self.assertEqual(50, len(serializer.loads(serializer.dumps(sample_response())).rows))
+
+    def test_build_serializer(self):
+        self.assertIsInstance(build_serializer({}), PickleSerializer)
+        compressed = build_serializer({'compression': 'zlib', 'compression_threshold_bytes': 10})
+        self.assertIsInstance(compressed, CompressedSerializer)
+        self.assertEqual(10, compressed.threshold_bytes)
+
+        with self.assertRaises(LongitudeConfigError):
+            build_serializer({'serializer': 'yaml'})
+        with self.assertRaises(LongitudeConfigError):
+            build_serializer({'compression': 'rar'})
+
+    def test_unreadable_payloads_are_misses(self):
+        cache = LongitudeCache({'serializer': 'pickle'})
+        self.assertIsNone(cache.deserialize_payload(b'not a pickle'))
+        self.assertEqual(50, len(cache.deserialize_payload(cache.serialize_payload(sample_response())).rows))
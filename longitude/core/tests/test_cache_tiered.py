@@ -0,0 +1,112 @@
+from unittest import TestCase, mock
+
+from longitude.core.caches.ram import RamCache
+from longitude.core.caches.tiered import TieredCache
+from longitude.core.common.exceptions import LongitudeConfigError
+from longitude.core.common.query_response import LongitudeQueryResponse
+from longitude.core.tests.utils import async_test
+
+
+class PubSubRamCache(RamCache):
+    """
+    Shared L2 whose pub/sub delivers the messages synchronously to every subscriber
+    """
+
+    def __init__(self, options={}):
+        super().__init__(options)
+        self.subscribers = []
+
+    def publish(self, channel, message):
+        for subscribed_channel, callback in self.subscribers:
+            if subscribed_channel == channel:
+                callback(message.encode('utf-8'))
+
+    async def publish_async(self, channel, message):
+        self.publish(channel, message)
+
+    def subscribe(self, channel, callback):
+        self.subscribers.append((channel, callback))
+        return mock.MagicMock()
+
+
+class TestTieredCache(TestCase):
+    def setUp(self):
+        self.l2 = RamCache()
+        self.cache = TieredCache({'l2': self.l2})
+
+    def test_l2_is_required(self):
+        with self.assertRaises(LongitudeConfigError):
+            TieredCache()
+        with self.assertRaises(LongitudeConfigError):
+            TieredCache({'l2': RamCache(), 'invalidation_channel': 'invalidations'})
+
+    def test_writes_go_to_both_levels(self):
+        self.assertFalse(self.cache.put('query', LongitudeQueryResponse(meta={'n': 1}), {'a': 1}))
+        key = self.cache.cache_key('query', {'a': 1})
+        self.assertEqual(1, self.l2.execute_get(key).meta['n'])
+        self.assertEqual(1, self.cache.l1.execute_get(key).meta['n'])
+
+    def test_l1_hits_do_not_reach_l2(self):
+        self.cache.put('query', LongitudeQueryResponse())
+        self.l2.execute_get = mock.MagicMock()
+        self.assertIsNotNone(self.cache.get('query'))
+        self.l2.execute_get.assert_not_called()
+
+    def test_l2_hits_are_copied_into_l1(self):
+        self.l2.put('query', LongitudeQueryResponse(meta={'n': 2}))
+        self.assertEqual(2, self.cache.get('query').meta['n'])
+        self.assertEqual(2, self.cache.l1.execute_get(self.cache.cache_key('query', {})).meta['n'])
+        self.assertIsNone(self.cache.get('missing'))
+
+    def test_batch_reads_only_ask_l2_for_l1_misses(self):
+        self.cache.put('in_l1', LongitudeQueryResponse(meta={'n': 1}))
+        self.l2.put('in_l2', LongitudeQueryResponse(meta={'n': 2}))
+        self.l2.get_many = mock.MagicMock(wraps=self.l2.get_many)
+
+        results = self.cache.get_many([('in_l1', None), ('in_l2', None), ('missing', None)])
+
+        self.assertEqual([1, 2, None], [r.meta['n'] if r else None for r in results])
+        self.l2.get_many.assert_called_once_with([('in_l2', None), ('missing', None)])
+
+    def test_tag_invalidation_drops_l1(self):
+        self.cache.put('query', LongitudeQueryResponse(), tags=['table'])
+        self.assertEqual(1, self.cache.invalidate_tags(['table']))
+        self.assertIsNone(self.cache.get('query'))
+
+    @async_test
+    async def test_async_read_through_and_write_through(self):
+        await self.cache.put_async('query', LongitudeQueryResponse(meta={'n': 1}))
+        self.cache.l1.flush()
+        self.assertEqual(1, (await self.cache.get_async('query')).meta['n'])
+        self.assertIsNotNone(self.cache.l1.execute_get(self.cache.cache_key('query', {})))
+
+        await self.cache.flush_async()
+        self.assertIsNone(await self.cache.get_async('query'))
+
+
+class TestTieredCacheInvalidation(TestCase):
+    def setUp(self):
+        self.l2 = PubSubRamCache()
+        options = {'l2': self.l2, 'invalidation_channel': 'invalidations'}
+        self.node_a = TieredCache(options)
+        self.node_b = TieredCache(options)
+        self.node_a.put('query', LongitudeQueryResponse(meta={'n': 1}))
+        self.assertEqual(1, self.node_b.get('query').meta['n'])
+
+    def test_writes_invalidate_other_nodes(self):
+        self.node_a.put('query', LongitudeQueryResponse(meta={'n': 2}))
+        self.assertIsNone(self.node_b.l1.execute_get(self.node_b.cache_key('query', {})))
+        self.assertEqual(2, self.node_b.get('query').meta['n'])
+
+    def test_own_messages_are_ignored(self):
+        self.node_a.l1.flush = mock.MagicMock()
+        self.node_a.invalidate_tags(['table'])
+        self.node_a.l1.flush.assert_called_once()
+
+    def test_flush_invalidates_other_nodes(self):
+        self.node_a.flush()
+        self.assertIsNone(self.node_b.l1.execute_get(self.node_b.cache_key('query', {})))
+
+    def test_malformed_messages_are_ignored(self):
+        self.l2.publish('invalidations', 'not json')
+        self.assertIsNotNone(self.node_b.l1.execute_get(self.node_b.cache_key('query', {})))
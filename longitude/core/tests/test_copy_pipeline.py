@@ -0,0 +1,98 @@
+import io
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+from longitude.core.data_sources.base import DataSource
+from longitude.core.data_sources.copy_pipeline import (copy_from_query, encode_rows, parse_csv_header,
+                                                       run_copy_pipeline, split_csv)
+
+
+class ChunkRecordingDataSource(DataSource):
+    def __init__(self, options={}, failures=0):
+        super().__init__(options)
+        self.chunks = []
+        self.failures = failures
+        self._lock = threading.Lock()
+
+    def copy_chunk(self, data, to_table, columns):
+        with self._lock:
+            if self.failures:
+                self.failures -= 1
+                raise IOError('connection lost')
+            self.chunks.append((data, to_table, columns))
+
+
+class TestCopyPipelineHelpers(TestCase):
+    def test_header_follows_csv_rules(self):
+        self.assertEqual(['id', 'name, full', 'geom'], parse_csv_header(b'id,"name, full", geom\r\n'))
+        self.assertEqual('COPY t ("a", "b") FROM STDIN WITH (FORMAT csv)', copy_from_query('t', ['a', 'b']))
+
+    def test_records_are_not_split(self):
+        data = b'1,"multi\nline"\n2,b\n3,c\n'
+        chunks = list(split_csv(io.BytesIO(data), chunk_size_bytes=4))
+        self.assertEqual([(b'1,"multi\nline"\n', 1), (b'2,b\n', 1), (b'3,c\n', 1)], chunks)
+        self.assertEqual([(data, 3)], list(split_csv(io.BytesIO(data))))
+
+    def test_rows_encoding(self):
+        chunks = list(encode_rows([(1, None, ''), ('a"b', 2.5, 'x')], chunk_rows=1))
+        self.assertEqual([(b'"1",,""\n', 1), (b'"a""b","2.5","x"\n', 1)], chunks)
+
+
+class TestRunCopyPipeline(TestCase):
+    def test_chunks_are_copied_in_parallel_with_progress(self):
+        running = []
+        max_running = []
+        progress = []
+        lock = threading.Lock()
+
+        def copy_chunk(data):
+            with lock:
+                running.append(data)
+                max_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(data)
+
+        chunks = [(b'%d\n' % i, 1) for i in range(8)]
+        metrics = run_copy_pipeline(copy_chunk, chunks, workers=4, progress_callback=progress.append)
+
+        self.assertEqual(4, max(max_running))
+        self.assertEqual(8, metrics['chunks'])
+        self.assertEqual(8, metrics['rows'])
+        self.assertEqual(16, metrics['bytes'])
+        self.assertEqual(list(range(1, 9)), [p['chunks'] for p in progress])
+        self.assertGreater(metrics['rows_per_s'], 0)
+
+    @mock.patch('longitude.core.data_sources.copy_pipeline.time.sleep')
+    def test_failed_chunks_are_retried(self, sleep_mock):
+        ds = ChunkRecordingDataSource(failures=2)
+        metrics = ds.copy_from_rows([(1, 'a'), (2, 'b')], 'table', ['id', 'name'], chunk_rows=1, retries=2)
+        self.assertEqual(2, metrics['retries'])
+        self.assertEqual(2, len(ds.chunks))
+        self.assertEqual([1, 2], [c[0][0] for c in sleep_mock.call_args_list])
+
+        ds = ChunkRecordingDataSource(failures=3)
+        with self.assertRaises(IOError):
+            run_copy_pipeline(lambda data: ds.copy_chunk(data, 't', []), [(b'1\n', 1)], retries=2, retry_delay_s=0)
+
+
+class TestCopyFromCsv(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'id,"the name"\n' + b''.join(b'%d,name %d\n' % (i, i) for i in range(100)))
+        self.addCleanup(os.remove, self.path)
+
+    def test_file_is_split_in_chunks(self):
+        ds = ChunkRecordingDataSource()
+        metrics = ds.copy_from_csv(self.path, to_table='people', chunk_size_bytes=100, workers=3)
+
+        self.assertEqual(100, metrics['rows'])
+        self.assertEqual(len(ds.chunks), metrics['chunks'])
+        self.assertGreater(len(ds.chunks), 1)
+        self.assertTrue(all(c[1:] == ('people', ['id', 'the name']) for c in ds.chunks))
+        lines = sorted(b''.join(c[0] for c in ds.chunks).splitlines())
+        self.assertEqual(sorted(b'%d,name %d' % (i, i) for i in range(100)), lines)
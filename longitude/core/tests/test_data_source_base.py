@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import time
+from unittest import TestCase, mock
+
+from longitude.core.caches.ram import RamCache
+from longitude.core.tests.utils import FakeAsyncDataSource, FakeDataSource, NotThreadSafeDataSource, async_test
+
+
+class TestStaleWhileRevalidate(TestCase):
+    @staticmethod
+    def _wait_for(condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_responses_measure_compute_time(self):
+        ds = FakeDataSource()
+        self.assertIsNotNone(ds.query('some query').compute_time_s)
+
+    @mock.patch('longitude.core.caches.base.time.time')
+    def test_stale_response_is_served_and_refreshed_in_background(self, time_mock):
+        time_mock.return_value = 1000
+        ds = FakeDataSource({'cache': RamCache({'expiration_time_s': 60, 'stale_ttl_s': 600})})
+        self.assertEqual(1, ds.query('some query').meta['execution'])
+
+        time_mock.return_value = 1061
+        stale = ds.query('some query')
+        self.assertTrue(stale.from_cache)
+        self.assertEqual(1, stale.meta['execution'])
+
+        self._wait_for(lambda: ds.executions == 2)
+        self._wait_for(lambda: ds.query('some query').meta['execution'] == 2)
+        self.assertEqual(2, ds.query('some query').meta['execution'])
+
+    @mock.patch('longitude.core.caches.base.time.time')
+    def test_data_sources_that_are_not_thread_safe_refresh_in_the_caller_thread(self, time_mock):
+        time_mock.return_value = 1000
+        ds = NotThreadSafeDataSource({'cache': RamCache({'expiration_time_s': 60, 'stale_ttl_s': 600})})
+        # Leaves room for a query from another thread to overlap
+        ds.delay_s = 0.01
+        ds.query('some query')
+
+        time_mock.return_value = 1061
+        stale = ds.query('some query')
+        self.assertEqual(1, stale.meta['execution'])
+        # Refreshed before returning, so the next query cannot overlap with it
+        self.assertEqual(2, ds.executions)
+        self.assertEqual(2, ds.query('some query').meta['execution'])
+        self.assertEqual(3, ds.query('other query', cache=False).meta['execution'])
+        self.assertEqual({threading.get_ident()}, ds.threads)
+
+    @mock.patch('longitude.core.caches.base.time.time')
+    def test_fresh_responses_are_not_refreshed(self, time_mock):
+        time_mock.return_value = 1000
+        ds = FakeDataSource({'cache': RamCache({'expiration_time_s': 60, 'stale_ttl_s': 600})})
+        ds.query('some query')
+        ds.query('some query')
+        self.assertEqual(1, ds.executions)
+
+    @async_test
+    async def test_async_stale_response_is_refreshed_in_background(self):
+        with mock.patch('longitude.core.caches.base.time.time') as time_mock:
+            time_mock.return_value = 1000
+            ds = FakeAsyncDataSource({'cache': RamCache({'expiration_time_s': 60, 'stale_ttl_s': 600})})
+            await ds.query('some query')
+
+            time_mock.return_value = 1061
+            stale = await ds.query('some query')
+            self.assertEqual(1, stale.meta['execution'])
+            await asyncio.gather(*ds._background_tasks)
+
+            self.assertEqual(2, ds.executions)
+            self.assertEqual(2, (await ds.query('some query')).meta['execution'])
+
+
+class TestQueryMany(TestCase):
+    def test_only_misses_are_executed_and_cached_in_batch(self):
+        cache = RamCache()
+        ds = FakeDataSource({'cache': cache})
+        ds.query('cached query')
+        cache.execute_get_many = mock.MagicMock(wraps=cache.execute_get_many)
+        cache.execute_put_many = mock.MagicMock(wraps=cache.execute_put_many)
+
+        results = ds.query_many([('cached query', None), ('new query', {'a': 1}), ('new query', {'a': 1})])
+
+        self.assertTrue(results[0].from_cache)
+        self.assertFalse(results[1].from_cache)
+        self.assertIs(results[1], results[2])
+        self.assertEqual(2, ds.executions)
+        cache.execute_get_many.assert_called_once()
+        cache.execute_put_many.assert_called_once()
+        self.assertTrue(ds.query('new query', {'a': 1}).from_cache)
+
+    def test_without_cache_every_query_is_executed(self):
+        ds = FakeDataSource()
+        results = ds.query_many([('q', None), ('q', None)])
+        self.assertEqual([1, 2], [r.meta['execution'] for r in results])
+
+    @async_test
+    async def test_async_misses_are_executed_concurrently(self):
+        ds = FakeAsyncDataSource({'cache': RamCache()})
+        await ds.query('cached query')
+        results = await ds.query_many([('cached query', None), ('q1', None), ('q2', None)])
+
+        self.assertTrue(results[0].from_cache)
+        self.assertEqual(3, ds.executions)
+        self.assertTrue((await ds.query('q2')).from_cache)
+
+
+class TestCacheTags(TestCase):
+    def test_tagged_queries_are_invalidated(self):
+        ds = FakeDataSource({'cache': RamCache()})
+        ds.query('SELECT * FROM a', cache_tags=['a'])
+        ds.query('SELECT * FROM b', cache_tags=['b'])
+
+        self.assertEqual(1, ds.invalidate_cache_tags(['a']))
+        self.assertFalse(ds.query('SELECT * FROM a').from_cache)
+        self.assertTrue(ds.query('SELECT * FROM b').from_cache)
+
+    @async_test
+    async def test_async_tagged_queries_are_invalidated(self):
+        ds = FakeAsyncDataSource({'cache': RamCache()})
+        await ds.query('SELECT * FROM a', cache_tags=['a'])
+
+        self.assertEqual(1, await ds.invalidate_cache_tags(['a']))
+        self.assertFalse((await ds.query('SELECT * FROM a')).from_cache)
@@ -1,9 +1,13 @@
+import io
 from unittest import TestCase, mock
 
 from carto.exceptions import CartoException
 
+from ..caches.ram import RamCache
+from ..common.exceptions import LongitudeQueryTimeoutException
 from ..data_sources.base import LongitudeQueryCannotBeExecutedException
 from ..data_sources.carto import CartoDataSource
+from ..data_sources.carto_export import CsvRowsParser
 
 
 class TestCartoDataSource(TestCase):
@@ -22,9 +26,152 @@ class TestCartoDataSource(TestCase):
         self.assertEqual([], result.rows)
         self.assertEqual(42, result.meta['response_time'])
 
+    def test_clients_share_a_pooled_session(self):
+        ds = CartoDataSource(user='', api_key='', options={'http_pool_maxsize': 32, 'verify_ssl': False})
+        other = CartoDataSource(user='other', api_key='', options={'http_pool_maxsize': 32, 'verify_ssl': False})
+
+        self.assertIs(ds.session, other.session)
+        self.assertIs(ds.session, ds._auth_client.session)
+        self.assertFalse(ds.session.verify)
+        adapter = ds.session.get_adapter('https://user.carto.com')
+        self.assertEqual(32, adapter._pool_maxsize)
+        # Only connection errors: a gateway error may come after a write query (sent as GET) ran
+        self.assertFalse(adapter.max_retries.status_forcelist)
+        self.assertEqual(0, adapter.max_retries.read)
+        self.assertIsNot(ds.session, CartoDataSource(user='', api_key='').session)
+
+    def test_custom_session(self):
+        session = mock.MagicMock()
+        ds = CartoDataSource(user='', api_key='', options={'session': session})
+        self.assertIs(session, ds._auth_client.session)
+
+    @mock.patch('longitude.core.data_sources.carto.cartoframes.CartoContext')
+    def test_carto_context_uses_the_session(self, carto_context_mock):
+        ds = CartoDataSource(user='', api_key='')
+        ds.cc
+        self.assertIs(ds.session, carto_context_mock.call_args[1]['session'])
+
     def test_wrong_query(self):
         ds = CartoDataSource(user='', api_key='')
         ds._sql_client = mock.MagicMock()
         ds._sql_client.send.side_effect = CartoException
         with self.assertRaises(LongitudeQueryCannotBeExecutedException):
             ds.query('some irrelevant query')
+
+
+@mock.patch('longitude.core.data_sources.carto.time.sleep')
+class TestCartoBatch(TestCase):
+    def setUp(self):
+        self.ds = CartoDataSource(user='', api_key='', options={
+            'batch': True, 'batch_poll_interval_s': 1, 'batch_poll_max_interval_s': 3
+        })
+        self.ds._batch_client = mock.MagicMock()
+
+    def test_query_waits_for_job_with_backoff(self, sleep_mock):
+        self.ds._batch_client.create.return_value = {'job_id': 'a', 'status': 'pending'}
+        self.ds._batch_client.read.side_effect = [
+            {'job_id': 'a', 'status': 'running'},
+            {'job_id': 'a', 'status': 'running'},
+            {'job_id': 'a', 'status': 'running'},
+            {'job_id': 'a', 'status': 'done'}
+        ]
+        result = self.ds.query('INSERT INTO t SELECT 1', cache=False)
+
+        self.ds._batch_client.create.assert_called_once_with('INSERT INTO t SELECT 1')
+        self.assertEqual([1, 2, 3, 3], [c[0][0] for c in sleep_mock.call_args_list])
+        self.assertEqual('done', result.meta['status'])
+        self.assertEqual([], result.rows)
+
+    def test_batch_queries_are_never_cached(self, sleep_mock):
+        ds = CartoDataSource(user='', api_key='', options={'batch': True, 'cache': RamCache()})
+        ds._batch_client = mock.MagicMock()
+        ds._batch_client.create.side_effect = [{'job_id': 'a', 'status': 'done'}, {'job_id': 'b', 'status': 'done'}]
+
+        self.assertEqual('a', ds.query('INSERT INTO t SELECT 1').meta['job_id'])
+        self.assertEqual('b', ds.query('INSERT INTO t SELECT 1').meta['job_id'])
+        self.assertEqual(2, ds._batch_client.create.call_count)
+
+    def test_many_jobs_are_submitted_before_polling(self, sleep_mock):
+        self.ds._batch_client.create.side_effect = [{'job_id': 'a', 'status': 'pending'},
+                                                    {'job_id': 'b', 'status': 'done'}]
+        self.ds._batch_client.read.return_value = {'job_id': 'a', 'status': 'failed', 'failed_reason': 'oops'}
+
+        with self.assertRaises(LongitudeQueryCannotBeExecutedException):
+            self.ds.batch_query_many([('q1', None), ('q2', None)])
+
+        self.ds._batch_client.create.side_effect = [{'job_id': 'a', 'status': 'pending'},
+                                                    {'job_id': 'b', 'status': 'done'}]
+        results = self.ds.batch_query_many([('q1', None), ('q2', None)], raise_on_failure=False)
+        self.assertEqual(['failed', 'done'], [r.meta['status'] for r in results])
+        self.assertEqual('oops', results[0].meta['failed_reason'])
+        self.ds._batch_client.read.assert_called_with('a')
+
+    @mock.patch('longitude.core.data_sources.carto.time.monotonic')
+    def test_unfinished_jobs_are_cancelled_after_timeout(self, monotonic_mock, sleep_mock):
+        monotonic_mock.side_effect = [0, 0, 1, 5]
+        self.ds._batch_client.create.return_value = {'job_id': 'a', 'status': 'pending'}
+        self.ds._batch_client.read.return_value = {'job_id': 'a', 'status': 'running'}
+
+        with self.assertRaises(LongitudeQueryTimeoutException):
+            self.ds.batch_query('slow query', timeout_s=2)
+        self.ds._batch_client.cancel.assert_called_once_with('a')
+
+
+class TestCsvRowsParser(TestCase):
+    def test_rows_split_in_any_chunk(self):
+        data = 'id,name\n1,"multi\nline, quoted"\n2,ñandú\n3,\n'.encode('utf-8')
+        for size in (1, 2, 5, len(data)):
+            parser = CsvRowsParser()
+            rows = []
+            for i in range(0, len(data), size):
+                rows.extend(parser.feed(data[i:i + size]))
+            rows.extend(parser.close())
+            self.assertEqual([
+                {'id': '1', 'name': 'multi\nline, quoted'},
+                {'id': '2', 'name': 'ñandú'},
+                {'id': '3', 'name': ''}
+            ], rows)
+
+    def test_last_row_without_newline(self):
+        parser = CsvRowsParser()
+        self.assertEqual([], parser.feed(b'a,b\r\n1,2'))
+        self.assertEqual([{'a': '1', 'b': '2'}], parser.close())
+
+
+class TestCartoStreaming(TestCase):
+    def setUp(self):
+        self.ds = CartoDataSource(user='', api_key='')
+        self.ds._copy_client = mock.MagicMock()
+        self.response = self.ds._copy_client.copyto.return_value
+        self.response.iter_content.return_value = [b'id,na', b'me\n1,a\n2,b\n', b'3,c\n']
+
+    def test_query_iter_streams_copy_to(self):
+        rows = list(self.ds.query_iter('SELECT * FROM t WHERE x = %(x)s', {'x': 'y'}))
+        self.ds._copy_client.copyto.assert_called_once_with(
+            "COPY (SELECT * FROM t WHERE x = 'y') TO STDOUT WITH (FORMAT csv, HEADER true)"
+        )
+        self.assertEqual(['1', '2', '3'], [r['id'] for r in rows])
+        self.response.close.assert_called_once()
+
+        batches = list(self.ds.query_iter('SELECT * FROM t', fetch_size=2, batches=True))
+        self.assertEqual([2, 1], [len(b) for b in batches])
+
+    def test_export_writes_chunks(self):
+        file_obj = io.BytesIO()
+        self.assertEqual(20, self.ds.export('SELECT * FROM t', file_obj))
+        self.assertEqual(b'id,name\n1,a\n2,b\n3,c\n', file_obj.getvalue())
+
+    def test_other_formats_use_the_sql_api(self):
+        self.ds._auth_client = mock.MagicMock()
+        response = self.ds._auth_client.send.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'{"type": ', b'"FeatureCollection"}']
+
+        self.assertEqual(b'{"type": "FeatureCollection"}', b''.join(self.ds.export_iter('q', format='geojson')))
+        self.ds._auth_client.send.assert_called_once_with(
+            'api/v2/sql', 'POST', data={'q': 'q', 'format': 'geojson'}, stream=True
+        )
+
+        response.status_code = 400
+        with self.assertRaises(LongitudeQueryCannotBeExecutedException):
+            list(self.ds.export_iter('q', format='geojson'))
@@ -0,0 +1,178 @@
+import io
+from unittest import TestCase, mock
+
+from ..caches.ram import RamCache
+from ..common.exceptions import LongitudeQueryCannotBeExecutedException
+from ..data_sources.carto_async import CartoAsyncDataSource
+from ..data_sources.carto_export import MAX_GET_QUERY_LENGTH
+from ..data_sources.carto_http import close_connectors
+from .utils import async_test
+
+
+class FakeResponse:
+    def __init__(self, status, data):
+        self.status = status
+        self.headers = {}
+        self.data = data
+
+    async def json(self):
+        return self.data
+
+    async def text(self):
+        return str(self.data)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class TestCartoAsyncBatch(TestCase):
+    def setUp(self):
+        self.session = mock.MagicMock()
+        self.ds = CartoAsyncDataSource(user='user', api_key='key', options={
+            'session': self.session, 'batch': True, 'batch_poll_interval_s': 0
+        })
+
+    def _respond(self, *responses):
+        self.session.request.side_effect = [FakeResponse(status, data) for status, data in responses]
+
+    @async_test
+    async def test_query_polls_job_until_done(self):
+        self._respond((201, {'job_id': 'a', 'status': 'pending'}),
+                      (200, {'job_id': 'a', 'status': 'running'}),
+                      (200, {'job_id': 'a', 'status': 'done'}))
+        result = await self.ds.query('INSERT INTO t SELECT 1', cache=False)
+
+        self.assertEqual('done', result.meta['status'])
+        methods = [c[0][0] for c in self.session.request.call_args_list]
+        self.assertEqual(['POST', 'GET', 'GET'], methods)
+        post = self.session.request.call_args_list[0]
+        self.assertEqual('https://user.carto.com/api/v2/sql/job/', post[0][1])
+        self.assertEqual({'query': 'INSERT INTO t SELECT 1'}, post[1]['json'])
+        self.assertEqual('https://user.carto.com/api/v2/sql/job/a', self.session.request.call_args_list[1][0][1])
+
+    @async_test
+    async def test_batch_queries_are_never_cached(self):
+        ds = CartoAsyncDataSource(user='user', api_key='key', options={
+            'session': self.session, 'batch': True, 'cache': RamCache()
+        })
+        self.session.request.side_effect = [FakeResponse(201, {'job_id': 'a', 'status': 'done'}),
+                                            FakeResponse(201, {'job_id': 'b', 'status': 'done'})]
+        self.assertEqual('a', (await ds.query('INSERT INTO t SELECT 1')).meta['job_id'])
+        self.assertEqual('b', (await ds.query('INSERT INTO t SELECT 1')).meta['job_id'])
+
+    @async_test
+    async def test_many_jobs_and_failures(self):
+        self._respond((201, {'job_id': 'a', 'status': 'done'}),
+                      (201, {'job_id': 'b', 'status': 'failed', 'failed_reason': 'oops'}))
+        with self.assertRaises(LongitudeQueryCannotBeExecutedException):
+            await self.ds.batch_query_many([('q1', None), ('q2', None)])
+
+        self._respond((201, {'job_id': 'a', 'status': 'done'}),
+                      (201, {'job_id': 'b', 'status': 'failed', 'failed_reason': 'oops'}))
+        results = await self.ds.batch_query_many([('q1', None), ('q2', None)], raise_on_failure=False)
+        self.assertEqual(['done', 'failed'], [r.meta['status'] for r in results])
+
+    @async_test
+    async def test_api_errors(self):
+        self._respond((401, {'error': ['Unauthorized']}))
+        with self.assertRaises(LongitudeQueryCannotBeExecutedException):
+            await self.ds.batch_query('q')
+
+
+class FakeStreamResponse(FakeResponse):
+    def __init__(self, status, chunks):
+        super().__init__(status, chunks)
+        self.content = mock.MagicMock()
+        self.content.iter_chunked = self._iter_chunked
+
+    async def _iter_chunked(self, size):
+        for chunk in self.data:
+            yield chunk
+
+
+class TestCartoAsyncStreaming(TestCase):
+    def setUp(self):
+        self.session = mock.MagicMock()
+        self.ds = CartoAsyncDataSource(user='user', api_key='key', options={'session': self.session})
+        self.session.request.side_effect = lambda *args, **kwargs: FakeStreamResponse(
+            200, [b'id,name\n1,', b'a\n2,b\n'])
+
+    @async_test
+    async def test_query_iter_streams_copy_to(self):
+        rows = [row async for row in self.ds.query_iter('SELECT * FROM t')]
+        self.assertEqual([{'id': '1', 'name': 'a'}, {'id': '2', 'name': 'b'}], rows)
+
+        method, url = self.session.request.call_args[0]
+        self.assertEqual('GET', method)
+        self.assertEqual('https://user.carto.com/api/v2/sql/copyto', url)
+        self.assertEqual('COPY (SELECT * FROM t) TO STDOUT WITH (FORMAT csv, HEADER true)',
+                         self.session.request.call_args[1]['params']['q'])
+
+        batches = [batch async for batch in self.ds.query_iter('SELECT * FROM t', fetch_size=1, batches=True)]
+        self.assertEqual([[{'id': '1', 'name': 'a'}], [{'id': '2', 'name': 'b'}]], batches)
+
+    @async_test
+    async def test_long_queries_are_posted_in_the_body(self):
+        query = 'SELECT * FROM t WHERE name IN (%s)' % ', '.join(["'x'"] * MAX_GET_QUERY_LENGTH)
+        rows = [row async for row in self.ds.query_iter(query)]
+        self.assertEqual(2, len(rows))
+
+        method, url = self.session.request.call_args[0]
+        kwargs = self.session.request.call_args[1]
+        self.assertEqual('POST', method)
+        self.assertEqual('https://user.carto.com/api/v2/sql/copyto', url)
+        self.assertEqual({'api_key': 'key'}, kwargs['params'])
+        self.assertEqual('COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER true)' % query, kwargs['data']['q'])
+
+    @async_test
+    async def test_export(self):
+        file_obj = io.BytesIO()
+        self.assertEqual(16, await self.ds.export('SELECT * FROM t', file_obj, format='geojson'))
+        self.assertEqual('geojson', self.session.request.call_args[1]['params']['format'])
+
+        self.session.request.side_effect = lambda *args, **kwargs: FakeStreamResponse(400, [])
+        with self.assertRaises(LongitudeQueryCannotBeExecutedException):
+            await self.ds.export('SELECT * FROM t', file_obj)
+
+
+class TestCartoAsyncSessions(TestCase):
+    @async_test
+    async def test_managed_sessions_share_the_connector(self):
+        ds = CartoAsyncDataSource(user='user', api_key='key', options={'http_limit_per_host': 20})
+        other = CartoAsyncDataSource(user='other', api_key='key', options={'http_limit_per_host': 20})
+        session = await ds.get_session()
+        other_session = await other.get_session()
+
+        self.assertIs(session, await ds.get_session())
+        self.assertIsNot(session, other_session)
+        self.assertIs(session.connector, other_session.connector)
+        self.assertEqual(20, session.connector.limit_per_host)
+
+        await ds.close()
+        self.assertTrue(session.closed)
+        self.assertFalse(other_session.connector.closed)
+
+        await close_connectors()
+        self.assertTrue(other_session.connector.closed)
+        new_session = await other.get_session()
+        self.assertFalse(new_session.connector.closed)
+        await other.close()
+        await close_connectors()
+
+    @async_test
+    async def test_context_manager_closes_the_managed_session(self):
+        async with CartoAsyncDataSource(user='user', api_key='key', options={'verify_ssl': False}) as ds:
+            session = await ds.get_session()
+            self.assertFalse(ds._auth_client.ssl)
+        self.assertTrue(session.closed)
+        await close_connectors()
+
+    @async_test
+    async def test_given_session_is_not_closed(self):
+        session = mock.MagicMock()
+        async with CartoAsyncDataSource(user='user', api_key='key', options={'session': session}) as ds:
+            self.assertIs(session, await ds.get_session())
+        session.close.assert_not_called()
@@ -1,9 +1,30 @@
-from unittest import TestCase, mock
+import io
+from collections import namedtuple
+from unittest import TestCase, mock, skipIf
 
+import pandas
+import psycopg2
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from ..common.exceptions import (LongitudeQueryCannotBeExecutedException, LongitudeQueryTimeoutException,
+                                 LongitudeTransientError)
 from ..data_sources.postgres.default import PostgresDataSource
 
 TESTED_MODULE_PATH = 'longitude.core.data_sources.postgres.default.%s'
 
+Column = namedtuple('Column', ['name', 'type_code'])
+
+PEOPLE_CSV = (
+    b'id,name,active,born,score\n'
+    b'1,ann,t,2000-01-01 10:00:00+01,1.5\n'
+    b'2,"",f,2001-02-03 04:05:06.5+00,2\n'
+    b'3,,,,\n'
+)
+
 
 class TestSQLAlchemyDataSource(TestCase):
     def setUp(self):
@@ -56,3 +77,220 @@ class TestSQLAlchemyDataSource(TestCase):
 
         self.assertCountEqual([], data['fields'])
         self.assertCountEqual([], data['rows'])
+
+    def test_pooled_query_borrows_and_returns_connection(self):
+        connection = self.connection_mock.return_value
+        connection.closed = 0
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.description = ['field_A']
+        cursor.fetchall.return_value = [(1,)]
+
+        ds = PostgresDataSource({'pool': True, 'pool_min_size': 0, 'pool_max_size': 2})
+        data = ds.execute_query(query_template='some valid query', params={}, query_config=None)
+
+        self.assertEqual([(1,)], data['rows'])
+        cursor.execute.assert_called_with('some valid query', {})
+        connection.commit.assert_called_once()
+        self.assertEqual(1, ds._pool.size)
+        self.assertIsNone(ds._cursor)
+
+    def test_query_iter_uses_named_cursor_and_fetches_in_chunks(self):
+        field_a, field_b = mock.MagicMock(), mock.MagicMock()
+        field_a.name, field_b.name = 'a', 'b'
+        cursor = mock.MagicMock()
+        cursor.description = [field_a, field_b]
+        cursor.fetchmany.side_effect = [[(1, 'x'), (2, 'y')], [(3, 'z')], []]
+
+        ds = PostgresDataSource()
+        self.connection_mock.return_value.cursor.side_effect = lambda name=None: cursor
+
+        rows = list(ds.query_iter('some big query', fetch_size=2))
+
+        self.assertEqual([{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}, {'a': 3, 'b': 'z'}], rows)
+        cursor.fetchmany.assert_called_with(2)
+        self.assertEqual(2, cursor.itersize)
+        cursor.close.assert_called_once()
+
+    def test_query_iter_yields_batches(self):
+        field_a = mock.MagicMock()
+        field_a.name = 'a'
+        cursor = mock.MagicMock()
+        cursor.description = [field_a]
+        cursor.fetchmany.side_effect = [[(1,), (2,)], [(3,)], []]
+
+        ds = PostgresDataSource({'fetch_size': 2})
+        self.connection_mock.return_value.cursor.side_effect = lambda name=None: cursor
+
+        self.assertEqual([[{'a': 1}, {'a': 2}], [{'a': 3}]], list(ds.query_iter('some big query', batches=True)))
+
+    def test_parse_response_in_compact_mode_keeps_tuples(self):
+        field_a = mock.MagicMock(type_code=23)
+        field_a.name = 'a'
+        rows = [(1,), (2,)]
+
+        ds = PostgresDataSource({'compact_rows': True})
+        response = ds.parse_response({'fields': [field_a], 'rows': rows})
+
+        self.assertIs(rows, response.tuples)
+        self.assertEqual([{'a': 1}, {'a': 2}], response.rows)
+
+    def test_repeated_column_names_keep_their_positions(self):
+        fields = []
+        for name in ('id', 'id', 'name'):
+            field = mock.MagicMock(type_code=23)
+            field.name = name
+            fields.append(field)
+        rows = [(1, 2, 'a')]
+
+        for compact in (True, False):
+            response = PostgresDataSource({'compact_rows': compact}).parse_response({'fields': fields, 'rows': rows})
+            self.assertFalse(response.is_compact)
+            self.assertEqual([{'id': 2, 'name': 'a'}], response.rows)
+
+    def test_copy_from_parses_header_and_uses_csv_format(self):
+        cursor = self.connection_mock.return_value.cursor.return_value
+        data = io.BytesIO(b'id,"name, full"\n1,"a, b"\n')
+        PostgresDataSource().copy_from(data, None, 'people')
+        query, copied = cursor.copy_expert.call_args[0]
+        self.assertEqual('COPY people ("id", "name, full") FROM STDIN WITH (FORMAT csv)', query)
+        self.assertIs(data, copied)
+
+    def test_chunks_are_copied_over_dedicated_connections(self):
+        ds = PostgresDataSource()
+        self.connection_mock.reset_mock()
+        ds.copy_chunk(b'1,a\n', 'people', ['id', 'name'])
+
+        self.connection_mock.assert_called_once()
+        dedicated = self.connection_mock.return_value
+        cursor = dedicated.cursor.return_value.__enter__.return_value
+        self.assertEqual(b'1,a\n', cursor.copy_expert.call_args[0][1].read())
+        dedicated.commit.assert_called_once()
+        dedicated.close.assert_called_once()
+
+    def mock_copy_to(self, csv):
+        cursor = self.connection_mock.return_value.cursor.return_value
+        cursor.mogrify.return_value = b"SELECT * FROM people WHERE name <> 'x'"
+        cursor.connection.encoding = 'UTF8'
+        cursor.description = [
+            Column('id', 23), Column('name', 25), Column('active', 16), Column('born', 1184), Column('score', 701)
+        ]
+        cursor.copy_expert.side_effect = lambda query, file_obj: file_obj.write(csv)
+        return cursor
+
+    def check_typed_columns(self, arrow):
+        cursor = self.mock_copy_to(PEOPLE_CSV)
+        with mock.patch('longitude.core.data_sources.postgres.dataframes.pyarrow', arrow):
+            df = PostgresDataSource().query_dataframe('SELECT * FROM people WHERE name <> %s', ['x'])
+
+        self.assertEqual([1, 2, 3], list(df['id']))
+        self.assertEqual(True, df['active'][0])
+        self.assertTrue(pandas.isna(df['active'][2]))
+        self.assertEqual(pandas.Timestamp('2000-01-01 09:00', tz='UTC'), df['born'][0])
+        self.assertEqual([1.5, 2.0], list(df['score'][:2]))
+        self.assertTrue(pandas.isna(df['name'][2]))
+        # Only pyarrow tells NULL from empty strings
+        self.assertEqual(arrow is not None, df['name'][1] == '')
+
+        self.assertEqual(
+            "COPY (SELECT * FROM people WHERE name <> 'x') TO STDOUT WITH (FORMAT csv, HEADER true)",
+            cursor.copy_expert.call_args[0][0]
+        )
+        cursor.execute.assert_called_with(
+            "SELECT * FROM (SELECT * FROM people WHERE name <> 'x') AS longitude_query LIMIT 0"
+        )
+
+    def test_query_dataframe_copies_typed_columns(self):
+        self.check_typed_columns(None)
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_query_dataframe_copies_typed_columns_with_pyarrow(self):
+        self.check_typed_columns(pyarrow)
+
+    def check_chunks(self, arrow):
+        self.mock_copy_to(PEOPLE_CSV)
+        with mock.patch('longitude.core.data_sources.postgres.dataframes.pyarrow', arrow):
+            chunks = list(PostgresDataSource().query_dataframe('SELECT * FROM people', chunksize=2))
+        self.assertEqual([[1, 2], [3]], [list(df['id']) for df in chunks])
+
+    def test_query_dataframe_in_chunks(self):
+        self.check_chunks(None)
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_query_dataframe_in_chunks_with_pyarrow(self):
+        self.check_chunks(pyarrow)
+
+    def test_query_dataframe_without_rows(self):
+        self.mock_copy_to(b'id,name,active,born,score\n')
+        df = PostgresDataSource().query_dataframe('SELECT * FROM people')
+        self.assertEqual(['id', 'name', 'active', 'born', 'score'], list(df.columns))
+        self.assertEqual(0, len(df))
+
+    def test_connection_errors_are_transient_and_reconnect(self):
+        ds = PostgresDataSource({'query_retries': 1, 'retry_base_delay_s': 0})
+        conn = self.connection_mock.return_value
+        conn.closed = 0
+        conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        conn.cursor.return_value.execute.side_effect = [psycopg2.OperationalError('server closed the connection'),
+                                                        None]
+        conn.cursor.return_value.description = None
+
+        with mock.patch.object(conn, 'rollback') as rollback_mock:
+            ds.query('SELECT 1')
+        rollback_mock.assert_called_once()
+
+        self.connection_mock.reset_mock()
+        conn.closed = 2
+        conn.cursor.return_value.execute.side_effect = psycopg2.OperationalError('gone')
+        with self.assertRaises(LongitudeTransientError):
+            ds.query('SELECT 1', idempotent=False)
+        self.connection_mock.assert_called_once()
+
+    def test_errors_inside_an_open_transaction_are_not_retried(self):
+        ds = PostgresDataSource({'query_retries': 3, 'retry_base_delay_s': 0})
+        conn = self.connection_mock.return_value
+        conn.closed = 0
+        conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        execute = conn.cursor.return_value.execute
+        conn.cursor.return_value.description = None
+
+        # Reads alone leave the implicit transaction of psycopg2 open, but nothing is lost by retrying
+        execute.side_effect = [None, psycopg2.OperationalError('server closed the connection'), None]
+        with mock.patch.object(conn, 'rollback') as rollback_mock:
+            ds.query('SELECT 1')
+            ds.query('SELECT 2')
+            rollback_mock.assert_called_once()
+
+        # Uncommitted writes are
+        execute.reset_mock()
+        execute.side_effect = [None, psycopg2.extensions.TransactionRollbackError('deadlock'), None]
+        with mock.patch.object(conn, 'rollback') as rollback_mock:
+            ds.query('INSERT INTO t VALUES (1)')
+            with self.assertRaises(LongitudeQueryCannotBeExecutedException) as context:
+                ds.query('SELECT 1')
+            self.assertNotIsInstance(context.exception, LongitudeTransientError)
+            rollback_mock.assert_not_called()
+            ds.rollback()
+            rollback_mock.assert_called_once()
+            ds.query('SELECT 1')
+        self.assertEqual(3, execute.call_count)
+
+        # Until they are committed
+        execute.side_effect = [None, psycopg2.OperationalError('server closed the connection'), None]
+        with mock.patch.object(conn, 'rollback'):
+            ds.query('INSERT INTO t VALUES (1)')
+            ds.commit()
+            ds.query('SELECT 1')
+
+    def test_query_timeouts_are_not_transient(self):
+        ds = PostgresDataSource({'query_retries': 3, 'retry_base_delay_s': 0, 'circuit_failure_threshold': 1})
+        conn = self.connection_mock.return_value
+        conn.closed = 0
+        conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        conn.cursor.return_value.execute.side_effect = psycopg2.extensions.QueryCanceledError('statement timeout')
+
+        with mock.patch.object(conn, 'rollback') as rollback_mock:
+            with self.assertRaises(LongitudeQueryTimeoutException):
+                ds.query('SELECT pg_sleep(10)')
+            rollback_mock.assert_called_once()
+        self.assertEqual(1, conn.cursor.return_value.execute.call_count)
+        self.assertEqual('closed', ds._resilience.circuit.state)
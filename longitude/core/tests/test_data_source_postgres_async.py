@@ -0,0 +1,123 @@
+import asyncio
+from unittest import TestCase, mock
+
+import asyncpg
+
+from ..caches.ram import RamCache
+from ..common.exceptions import (LongitudeQueryCannotBeExecutedException, LongitudeQueryTimeoutException,
+                                 LongitudeTransientError, LongitudeWrongQueryException)
+from ..data_sources.postgres.common import pyformat_to_numeric
+from ..data_sources.postgres.default_async import PostgresAsyncDataSource
+from longitude.core.tests.utils import async_test
+
+TESTED_MODULE_PATH = 'longitude.core.data_sources.postgres.default_async.%s'
+
+
+class TestPyformatToNumeric(TestCase):
+    def test_named_placeholders_are_numbered_once(self):
+        query, args = pyformat_to_numeric(
+            'SELECT * FROM t WHERE a = %(a)s AND b = %(b)s OR a > %(a)s AND c LIKE \'x%%\'',
+            {'a': 1, 'b': 2}
+        )
+        self.assertEqual('SELECT * FROM t WHERE a = $1 AND b = $2 OR a > $1 AND c LIKE \'x%\'', query)
+        self.assertEqual([1, 2], args)
+
+    def test_positional_placeholders(self):
+        self.assertEqual(('SELECT $1, $2', ['a', 'b']), pyformat_to_numeric('SELECT %s, %s', ('a', 'b')))
+
+    def test_missing_values_raise(self):
+        with self.assertRaises(LongitudeWrongQueryException):
+            pyformat_to_numeric('SELECT %(a)s', {})
+
+
+class TestPostgresAsyncDataSource(TestCase):
+    def setUp(self):
+        patcher = mock.patch(TESTED_MODULE_PATH % 'asyncpg.create_pool', new_callable=mock.AsyncMock)
+        self.addCleanup(patcher.stop)
+        self.create_pool_mock = patcher.start()
+
+        self.pool = mock.MagicMock()
+        self.pool.close = mock.AsyncMock()
+        self.create_pool_mock.return_value = self.pool
+        self.conn = self.pool.acquire.return_value.__aenter__.return_value
+        self.statement = mock.MagicMock()
+        self.statement.fetch = mock.AsyncMock(return_value=[{'id': 1, 'name': 'A'}])
+        self.conn.prepare = mock.AsyncMock(return_value=self.statement)
+
+        id_field = mock.MagicMock(type=mock.MagicMock())
+        id_field.name = 'id'
+        id_field.type.name = 'int4'
+        id_field.type.oid = 23
+        name_field = mock.MagicMock(type=mock.MagicMock())
+        name_field.name = 'name'
+        name_field.type.name = 'text'
+        name_field.type.oid = 25
+        self.statement.get_attributes.return_value = (id_field, name_field)
+
+    @async_test
+    async def test_query_uses_pool_and_returns_longitude_response(self):
+        ds = PostgresAsyncDataSource({'pool_max_size': 5})
+        result = await ds.query('SELECT id, name FROM t WHERE id = %(id)s', {'id': 1})
+
+        self.conn.prepare.assert_called_once_with('SELECT id, name FROM t WHERE id = $1')
+        self.statement.fetch.assert_called_once_with(1)
+        self.assertEqual([{'id': 1, 'name': 'A'}], result.rows)
+        # The same types as PostgresDataSource
+        self.assertEqual({'id': {'type': 'INTEGER'}, 'name': {'type': 'STRING'}}, result.fields)
+        self.assertEqual(5, self.create_pool_mock.call_args[1]['max_size'])
+
+        await ds.query('SELECT 1')
+        self.create_pool_mock.assert_called_once()
+
+    @async_test
+    async def test_context_manager_closes_pool(self):
+        async with PostgresAsyncDataSource() as ds:
+            self.assertIs(self.pool, ds._pool)
+        self.pool.close.assert_called_once()
+        self.assertIsNone(ds._pool)
+
+    @async_test
+    async def test_wrong_query(self):
+        self.conn.prepare.side_effect = asyncpg.PostgresError('boom')
+        ds = PostgresAsyncDataSource()
+        with self.assertRaises(LongitudeQueryCannotBeExecutedException):
+            await ds.query('some irrelevant query')
+
+    @async_test
+    async def test_timeouts_are_not_transient(self):
+        ds = PostgresAsyncDataSource({'query_retries': 3, 'retry_base_delay_s': 0})
+        for error in (asyncio.TimeoutError(), asyncpg.QueryCanceledError('statement timeout')):
+            self.statement.fetch.reset_mock()
+            self.statement.fetch.side_effect = error
+            with self.assertRaises(LongitudeQueryTimeoutException) as context:
+                await ds.query('SELECT pg_sleep(10)')
+            self.assertNotIsInstance(context.exception, LongitudeTransientError)
+            self.assertIs(error, context.exception.__cause__)
+            self.statement.fetch.assert_called_once()
+
+        self.statement.fetch.side_effect = ConnectionResetError('reset')
+        with self.assertRaises(LongitudeTransientError):
+            await ds.query('SELECT 1', idempotent=False)
+
+    @async_test
+    async def test_cached_query_is_not_executed_again(self):
+        ds = PostgresAsyncDataSource({'cache': RamCache()})
+        await ds.query('SELECT id, name FROM t')
+        result = await ds.query('SELECT id, name FROM t')
+
+        self.assertTrue(result.from_cache)
+        self.statement.fetch.assert_called_once()
+
+    @async_test
+    async def test_query_iter_uses_cursor(self):
+        cursor = mock.MagicMock()
+        cursor.fetch = mock.AsyncMock(side_effect=[[{'id': 1}, {'id': 2}], [{'id': 3}], []])
+        self.conn.cursor = mock.AsyncMock(return_value=cursor)
+        self.conn.transaction = mock.MagicMock()
+
+        ds = PostgresAsyncDataSource()
+        rows = [row async for row in ds.query_iter('SELECT id FROM t WHERE id > %(id)s', {'id': 0}, fetch_size=2)]
+
+        self.assertEqual([{'id': 1}, {'id': 2}, {'id': 3}], rows)
+        self.conn.cursor.assert_called_once_with('SELECT id FROM t WHERE id > $1', 0)
+        cursor.fetch.assert_called_with(2)
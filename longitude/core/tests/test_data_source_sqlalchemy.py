@@ -1,5 +1,16 @@
-from unittest import TestCase, mock
+from unittest import TestCase, mock, skipIf
 
+import pandas
+import psycopg2.extensions
+
+try:
+    from shapely import wkb
+    from shapely.geometry import Point
+except ImportError:
+    wkb = None
+
+from ..common.exceptions import LongitudeConfigError
+from ..data_sources.postgres.dataframes import Geometry, copy_method, upsert_query
 from ..data_sources.postgres.sqlalchemy import SQLAlchemyDataSource
 
 TESTED_MODULE_PATH = 'longitude.core.data_sources.postgres.sqlalchemy.%s'
@@ -45,3 +56,131 @@ class TestSQLAlchemyDataSource(TestCase):
         self.assertTrue('rows' in data.keys())
         self.assertTrue('fields' in data.keys())
         self.connection.execute.assert_called_once()
+
+    def test_query_iter_streams_results(self):
+        response = self.connection.execution_options.return_value.execute.return_value
+        response.keys.return_value = ['a']
+        response.fetchmany.side_effect = [[(1,), (2,)], []]
+
+        carto_ds = SQLAlchemyDataSource()
+        rows = list(carto_ds.query_iter('some big query', fetch_size=10))
+
+        self.assertEqual([{'a': 1}, {'a': 2}], rows)
+        self.connection.execution_options.assert_called_once_with(stream_results=True, max_row_buffer=10)
+        response.close.assert_called_once()
+
+    def test_write_dataframe_copy_is_opt_in(self):
+        df = mock.MagicMock()
+        carto_ds = SQLAlchemyDataSource()
+        carto_ds.write_dataframe(df, 'some_table', index=False)
+        self.assertIsNone(df.to_sql.call_args[1]['method'])
+        self.assertNotIn('dtype', df.to_sql.call_args[1])
+
+        carto_ds.write_dataframe(df, 'some_table', index=False, method='copy')
+        args, kwargs = df.to_sql.call_args
+        self.assertEqual(('some_table', self.create_engine_mock.return_value), args)
+        self.assertEqual('fail', kwargs['if_exists'])
+        self.assertTrue(callable(kwargs['method']))
+        self.assertFalse(kwargs['index'])
+
+    def test_copied_geometries_get_geometry_columns(self):
+        class FakeGeometry:
+            wkb_hex = '0101'
+
+        df = pandas.DataFrame({'id': [1, 2], 'geom': [None, FakeGeometry()], 'name': ['a', 'b']})
+        with mock.patch.object(pandas.DataFrame, 'to_sql') as to_sql_mock:
+            SQLAlchemyDataSource().write_dataframe(df, 'some_table', if_exists='replace', method='copy', srid=4326,
+                                                   dtype={'name': 'varchar(10)'})
+        dtype = to_sql_mock.call_args[1]['dtype']
+        self.assertEqual(['geom', 'name'], sorted(dtype))
+        self.assertIsInstance(dtype['geom'], Geometry)
+        self.assertEqual('geometry(Geometry, 4326)', dtype['geom'].get_col_spec())
+        self.assertEqual('geometry', Geometry().get_col_spec())
+        self.assertEqual('varchar(10)', dtype['name'])
+
+    def test_write_dataframe_keeps_to_sql_methods(self):
+        df = mock.MagicMock()
+        SQLAlchemyDataSource().write_dataframe(df, 'some_table', if_exists='append', method='multi')
+        self.assertEqual('multi', df.to_sql.call_args[1]['method'])
+        self.assertEqual('append', df.to_sql.call_args[1]['if_exists'])
+
+    def test_write_dataframe_upsert_needs_keys(self):
+        with self.assertRaises(LongitudeConfigError):
+            SQLAlchemyDataSource().write_dataframe(mock.MagicMock(), 'some_table', if_exists='upsert')
+        with self.assertRaises(LongitudeConfigError):
+            SQLAlchemyDataSource().write_dataframe(mock.MagicMock(), 'some_table', if_exists='upsert',
+                                                   upsert_keys=['id'], method='multi')
+
+    @mock.patch(TESTED_MODULE_PATH % 'copy_to_dataframe')
+    @mock.patch(TESTED_MODULE_PATH % 'read_sql_query')
+    def test_query_dataframe_copy_is_opt_in(self, read_sql_query_mock, copy_to_dataframe_mock):
+        carto_ds = SQLAlchemyDataSource()
+        carto_ds.query_dataframe('SELECT 1')
+        read_sql_query_mock.assert_called_once()
+
+        carto_ds.query_dataframe('SELECT %s', copy=True, params=[1], chunksize=10)
+        raw_connection = self.create_engine_mock.return_value.raw_connection.return_value
+        copy_to_dataframe_mock.assert_called_once_with(
+            raw_connection.cursor.return_value.__enter__.return_value, 'SELECT %s', params=[1], chunksize=10
+        )
+        raw_connection.close.assert_called_once()
+
+
+class TestCopyMethod(TestCase):
+
+    def setUp(self):
+        self.table = mock.MagicMock(schema=None)
+        self.table.name = 'some_table'
+        self.conn = mock.MagicMock()
+        self.cursor = self.conn.connection.cursor.return_value.__enter__.return_value
+
+    def copied(self):
+        return [(c[0][0], c[0][1].getvalue()) for c in self.cursor.copy_expert.call_args_list]
+
+    def test_rows_are_copied_as_csv(self):
+        self.table.schema = 'public'
+        copy_method(chunk_rows=2)(self.table, self.conn, ['id', 'name'], iter([(1, 'a'), (2, None), (3, 'c"')]))
+
+        query = 'COPY "public"."some_table" ("id", "name") FROM STDIN WITH (FORMAT csv)'
+        self.assertEqual([(query, b'"1","a"\n"2",\n'), (query, b'"3","c"""\n')], self.copied())
+        self.cursor.execute.assert_not_called()
+
+    @skipIf(wkb is None, 'shapely is not installed')
+    def test_geometries_are_copied_as_wkb(self):
+        point = Point(1, 2)
+        copy_method()(self.table, self.conn, ['geom'], iter([(point,)]))
+        self.assertEqual(('"%s"\n' % point.wkb_hex).encode(), self.copied()[0][1])
+
+        copy_method(srid=4326)(self.table, self.conn, ['geom'], iter([(point,)]))
+        self.assertEqual(('"%s"\n' % wkb.dumps(point, hex=True, srid=4326)).encode(), self.copied()[1][1])
+
+    def test_upsert_goes_through_a_temporary_table(self):
+        copy_method(upsert_keys=['id'])(self.table, self.conn, ['id', 'name'], iter([(1, 'a')]))
+
+        create, upsert, drop = [c[0][0] for c in self.cursor.execute.call_args_list]
+        temporary = self.copied()[0][0].split(' ')[1]
+        self.assertEqual('CREATE TEMPORARY TABLE %s (LIKE "some_table" INCLUDING DEFAULTS)' % temporary, create)
+        self.assertEqual(
+            'INSERT INTO "some_table" ("id", "name") SELECT "id", "name" FROM %s '
+            'ON CONFLICT ("id") DO UPDATE SET "name" = EXCLUDED."name"' % temporary,
+            upsert
+        )
+        self.assertEqual('DROP TABLE IF EXISTS %s' % temporary, drop)
+
+    def test_failed_upserts_drop_the_temporary_table(self):
+        self.cursor.execute.side_effect = [None, psycopg2.IntegrityError('no unique constraint'), None]
+        self.conn.connection.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        with self.assertRaises(psycopg2.IntegrityError):
+            copy_method(upsert_keys=['id'])(self.table, self.conn, ['id', 'name'], iter([(1, 'a')]))
+        self.assertTrue(self.cursor.execute.call_args[0][0].startswith('DROP TABLE IF EXISTS'))
+
+        # Aborted transactions drop it on rollback
+        self.cursor.execute.reset_mock()
+        self.cursor.execute.side_effect = [None, psycopg2.IntegrityError('no unique constraint')]
+        self.conn.connection.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+        with self.assertRaises(psycopg2.IntegrityError):
+            copy_method(upsert_keys=['id'])(self.table, self.conn, ['id', 'name'], iter([(1, 'a')]))
+        self.assertEqual(2, self.cursor.execute.call_count)
+
+    def test_upsert_of_keys_only_does_nothing_on_conflict(self):
+        self.assertTrue(upsert_query('"t"', '"tmp"', ['id'], ['id']).endswith('ON CONFLICT ("id") DO NOTHING'))
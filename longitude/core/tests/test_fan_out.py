@@ -0,0 +1,148 @@
+import asyncio
+import threading
+from collections import Counter
+from unittest import TestCase
+
+from longitude.core.caches.ram import RamCache
+from longitude.core.common.exceptions import LongitudeQueryTimeoutException
+from longitude.core.common.fan_out import _limits, _normalize, fan_out, fan_out_async
+from longitude.core.tests.utils import (WAIT_S, FakeAsyncDataSource, FakeDataSource, NotThreadSafeDataSource,
+                                        RecordingObserver, async_test)
+
+
+class TestFanOut(TestCase):
+    def test_queries_run_concurrently_and_keep_their_order(self):
+        a, b = FakeDataSource(), FakeDataSource()
+        # Each query waits for the other two: they only finish if they run at the same time
+        a.barrier = b.barrier = threading.Barrier(3, timeout=WAIT_S)
+        results = fan_out([(a, 'meet', {'n': 1}), (b, 'meet', {'n': 2}), (a, 'meet', {'n': 3})])
+        self.assertEqual([1, 2, 3], [r.meta['params']['n'] for r in results])
+
+    def test_identical_queries_are_executed_once(self):
+        ds = FakeDataSource()
+        results = fan_out([(ds, '0', {'a': 1}), (ds, '0', {'a': 1}), (ds, '0', {'a': 2})])
+        self.assertEqual(2, ds.executions)
+        self.assertIs(results[0], results[1])
+
+    def test_cached_queries_are_not_executed(self):
+        ds = FakeDataSource({'cache': RamCache()})
+        ds.query('0')
+        results = fan_out([(ds, '0'), (ds, '1'), (ds, '0', None, {'cache': False})])
+        self.assertTrue(results[0].from_cache)
+        self.assertFalse(results[1].from_cache)
+        self.assertFalse(results[2].from_cache)
+        self.assertEqual(3, ds.executions)
+
+    def test_observers_are_notified(self):
+        observer = RecordingObserver()
+        ds = FakeDataSource({'cache': RamCache(), 'observers': [observer]})
+        ds.query('0')
+        observer.events.clear()
+
+        fan_out([(ds, '0'), (ds, '1')])
+        self.assertEqual(Counter([
+            ('lookup', True), ('query', True, None),
+            ('lookup', False), ('execute', None), ('parse', 0), ('write',), ('query', False, None)
+        ]), Counter(observer.events))
+
+    def test_concurrency_is_limited_per_data_source(self):
+        ds = FakeDataSource()
+        # Queries go through in pairs
+        ds.barrier = threading.Barrier(2, timeout=WAIT_S)
+        fan_out([(ds, 'meet', {'n': n}) for n in range(6)], max_concurrency_per_source=2)
+        self.assertEqual(2, ds.max_running)
+
+    def test_data_sources_that_are_not_thread_safe_run_one_query_at_a_time(self):
+        ds, other, async_ds = NotThreadSafeDataSource(), FakeDataSource(), FakeAsyncDataSource()
+        queries = _normalize([(ds, '0'), (other, '0'), (async_ds, '0')])
+        self.assertEqual({id(ds): 1}, _limits(queries, None, int))
+        self.assertEqual({id(ds): 1, id(other): 4, id(async_ds): 4}, _limits(queries, 4, int))
+
+        other.barrier = threading.Barrier(2, timeout=WAIT_S)
+        fan_out([(ds, '0', {'n': n}) for n in range(4)] + [(other, 'meet', {'n': n}) for n in range(2)],
+                max_concurrency_per_source=4)
+        self.assertEqual(1, ds.max_running)
+        self.assertEqual(4, ds.executions)
+        self.assertEqual(2, other.max_running)
+
+    def test_timeouts(self):
+        ds = FakeDataSource()
+        self.addCleanup(ds.release.set)
+        with self.assertRaises(LongitudeQueryTimeoutException):
+            fan_out([(ds, 'block'), (ds, '0')], timeout_s=0.05)
+
+        results = fan_out([(ds, 'block', None, {'timeout_s': 0.05}), (ds, '0')], return_exceptions=True)
+        self.assertIsInstance(results[0], LongitudeQueryTimeoutException)
+        self.assertEqual('0', results[1].meta['query'])
+
+    def test_errors(self):
+        ds = FakeDataSource()
+        with self.assertRaises(ValueError):
+            fan_out([(ds, 'fail'), (ds, '0')])
+        results = fan_out([(ds, 'fail'), (ds, '0')], return_exceptions=True)
+        self.assertIsInstance(results[0], ValueError)
+
+    def test_async_data_sources_are_rejected(self):
+        with self.assertRaises(TypeError):
+            fan_out([(FakeAsyncDataSource(), '0')])
+
+
+class TestFanOutAsync(TestCase):
+    @async_test
+    async def test_mixed_data_sources_run_concurrently(self):
+        loop = asyncio.get_running_loop()
+        sync_ds, async_ds = FakeDataSource(), FakeAsyncDataSource({'cache': RamCache()})
+        await async_ds.query('0')
+
+        # The asynchronous queries wait for each other and for the one in the executor
+        async_ds.parties, async_ds.met = 3, asyncio.Event()
+        sync_ds.on_query = lambda: loop.call_soon_threadsafe(async_ds.arrive)
+        results = await fan_out_async([
+            (sync_ds, '0'), (async_ds, 'meet', {'n': 1}), (async_ds, '0'), (async_ds, 'meet', {'n': 2})
+        ])
+        self.assertEqual(['0', 'meet', '0', 'meet'], [r.meta['query'] for r in results])
+        self.assertEqual({'n': 2}, results[3].meta['params'])
+        self.assertTrue(results[2].from_cache)
+        self.assertEqual(3, async_ds.executions)
+        self.assertEqual(2, async_ds.max_running)
+
+    @async_test
+    async def test_misses_are_coalesced_with_other_queries(self):
+        ds = FakeAsyncDataSource({'cache': RamCache()})
+        ds.parties, ds.met = 2, asyncio.Event()
+        direct = asyncio.ensure_future(ds.query('meet'))
+        while not ds.executions:
+            await asyncio.sleep(0)
+
+        # The fan-out waits for the query in flight instead of executing it again
+        fanned = asyncio.ensure_future(fan_out_async([(ds, 'meet')]))
+        for _ in range(10):
+            await asyncio.sleep(0)
+        ds.met.set()
+        self.assertIs(await direct, (await fanned)[0])
+        self.assertEqual(1, ds.executions)
+
+    @async_test
+    async def test_timeouts(self):
+        ds = FakeAsyncDataSource()
+        results = await fan_out_async([(ds, 'block'), (ds, '0')], timeout_s=0.05, return_exceptions=True)
+        self.assertIsInstance(results[0], LongitudeQueryTimeoutException)
+        self.assertEqual('0', results[1].meta['query'])
+        self.assertEqual(0, ds.running)
+
+    @async_test
+    async def test_concurrency_is_limited_per_data_source(self):
+        ds = FakeAsyncDataSource()
+        await fan_out_async([(ds, 'yield', {'n': n}) for n in range(4)])
+        self.assertEqual(4, ds.max_running)
+
+        ds = FakeAsyncDataSource()
+        await fan_out_async([(ds, 'yield', {'n': n}) for n in range(4)], max_concurrency_per_source=2)
+        self.assertEqual(2, ds.max_running)
+
+    @async_test
+    async def test_synchronous_data_sources_that_are_not_thread_safe_run_one_query_at_a_time(self):
+        ds = NotThreadSafeDataSource()
+        await fan_out_async([(ds, '0', {'n': n}) for n in range(4)])
+        self.assertEqual(1, ds.max_running)
+        self.assertEqual(4, ds.executions)
@@ -0,0 +1,121 @@
+from unittest import TestCase
+
+from longitude.core.caches.ram import RamCache
+from longitude.core.common.instrumentation import (Instrumentation, MetricsObserver, QueryObserver,
+                                                   template_label)
+from longitude.core.tests.utils import FakeAsyncDataSource, FakeDataSource, RecordingObserver, async_test
+
+
+class TestInstrumentation(TestCase):
+    def test_query_lifecycle_is_observed(self):
+        observer = RecordingObserver()
+        ds = FakeDataSource({'cache': RamCache(), 'observers': [observer]})
+        ds.query('some query')
+        ds.query('some query')
+
+        self.assertEqual([
+            ('lookup', False), ('execute', None), ('parse', 0), ('write',), ('query', False, None),
+            ('lookup', True), ('query', True, None)
+        ], observer.events)
+
+    def test_errors_are_observed(self):
+        observer = RecordingObserver()
+        ds = FakeDataSource({'observers': [observer]})
+        with self.assertRaises(ValueError):
+            ds.query('fail')
+
+        self.assertEqual('execute', observer.events[0][0])
+        self.assertIsInstance(observer.events[0][1], ValueError)
+        self.assertIsInstance(observer.events[1][2], ValueError)
+
+    def test_batched_lookups_have_no_duration(self):
+        observer = RecordingObserver()
+        ds = FakeDataSource({'cache': RamCache(), 'observers': [observer]})
+        ds.query('a')
+        observer.events = []
+        ds.query_many([('a', None), ('b', None)])
+        self.assertEqual([('lookup', True), ('lookup', False), ('execute', None), ('parse', 0)], observer.events)
+
+    @async_test
+    async def test_async_query_lifecycle_is_observed(self):
+        observer = RecordingObserver()
+        ds = FakeAsyncDataSource({'cache': RamCache(), 'observers': [observer]})
+        await ds.query('some query')
+        await ds.query('some query')
+
+        self.assertEqual([
+            ('lookup', False), ('execute', None), ('parse', 0), ('write',), ('query', False, None),
+            ('lookup', True), ('query', True, None)
+        ], observer.events)
+
+    def test_failing_observers_do_not_break_queries(self):
+        class BrokenObserver(QueryObserver):
+            def on_query(self, *args, **kwargs):
+                raise RuntimeError('broken')
+
+        ds = FakeDataSource({'observers': [BrokenObserver()]})
+        with self.assertLogs('longitude.core.common.instrumentation', level='WARNING'):
+            self.assertEqual(1, ds.query('some query').meta['execution'])
+
+    def test_observers_must_be_query_observers(self):
+        with self.assertRaises(TypeError):
+            Instrumentation([object()])
+
+    def test_template_labels_collapse_whitespace_and_are_truncated(self):
+        self.assertEqual('SELECT * FROM t', template_label('SELECT *\n    FROM t  '))
+        self.assertEqual('SELECT ...', template_label('SELECT * FROM t', max_length=10))
+
+
+class TestMetricsObserver(TestCase):
+    def test_counters_and_histograms_per_data_source_and_template(self):
+        metrics = MetricsObserver()
+        ds = FakeDataSource({'cache': RamCache(), 'observers': [metrics], 'name': 'db'})
+        ds.query('SELECT 1')
+        ds.query('SELECT 1')
+        ds.query('SELECT 2', cache=False)
+
+        self.assertEqual(1, metrics.queries.value('db', 'SELECT 1', 'hit'))
+        self.assertEqual(1, metrics.queries.value('db', 'SELECT 1', 'miss'))
+        self.assertEqual(1, metrics.queries.value('db', 'SELECT 2', 'miss'))
+        self.assertEqual(1, metrics.cache_lookups.value('db', 'SELECT 1', 'hit'))
+        self.assertEqual(0, metrics.cache_lookups.value('db', 'SELECT 2', 'miss'))
+        self.assertEqual(1, metrics.execute_duration.count('db', 'SELECT 1'))
+        self.assertEqual(2, metrics.query_duration.count('db', 'SELECT 1', 'false')
+                         + metrics.query_duration.count('db', 'SELECT 1', 'true'))
+        self.assertEqual(1, metrics.cache_write_duration.count('db', 'SELECT 1'))
+
+    def test_errors_are_counted(self):
+        metrics = MetricsObserver()
+        ds = FakeDataSource({'observers': [metrics]})
+        with self.assertRaises(ValueError):
+            ds.query('fail')
+        self.assertEqual(1, metrics.queries.value('FakeDataSource', 'fail', 'error'))
+
+    def test_prometheus_exposition(self):
+        metrics = MetricsObserver({'duration_buckets_s': (0.1, 1)})
+        ds = FakeDataSource({'observers': [metrics], 'name': 'db'})
+        ds.query('SELECT "a"')
+        text = metrics.expose()
+
+        self.assertIn('# TYPE longitude_queries_total counter', text)
+        self.assertIn('longitude_queries_total{data_source="db",query="SELECT \\"a\\"",result="miss"} 1', text)
+        self.assertIn('# TYPE longitude_execute_duration_seconds histogram', text)
+        self.assertIn('longitude_execute_duration_seconds_bucket{data_source="db",query="SELECT \\"a\\"",le="0.1"} 1',
+                      text)
+        self.assertIn('longitude_execute_duration_seconds_bucket{data_source="db",query="SELECT \\"a\\"",le="+Inf"} 1',
+                      text)
+        self.assertIn('longitude_execute_duration_seconds_count{data_source="db",query="SELECT \\"a\\""} 1', text)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_slowest_and_cache_hostile_queries(self):
+        metrics = MetricsObserver()
+        ds = FakeDataSource({'observers': [metrics], 'name': 'db'})
+        metrics.on_execute(ds, 'fast', 0.01)
+        metrics.on_execute(ds, 'slow', 2)
+        metrics.on_execute(ds, 'slow', 4)
+        metrics.on_cache_lookup(ds, 'cached', True, None)
+        metrics.on_cache_lookup(ds, 'uncached', False, None)
+        metrics.on_cache_lookup(ds, 'uncached', True, None)
+
+        self.assertEqual([('db', 'slow', 2, 3.0), ('db', 'fast', 1, 0.01)], metrics.slowest_queries())
+        self.assertEqual([('db', 'uncached', 2, 0.5), ('db', 'cached', 1, 1.0)], metrics.cache_hit_ratios())
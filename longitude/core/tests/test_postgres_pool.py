@@ -0,0 +1,80 @@
+import threading
+from unittest import TestCase, mock
+
+import psycopg2
+
+from ..common.exceptions import LongitudeConfigError, LongitudeQueryCannotBeExecutedException
+from ..data_sources.postgres.pool import PostgresConnectionPool
+
+TESTED_MODULE_PATH = 'longitude.core.data_sources.postgres.pool.%s'
+
+
+class TestPostgresConnectionPool(TestCase):
+    def setUp(self):
+        patcher = mock.patch(TESTED_MODULE_PATH % 'psycopg2.connect')
+        self.addCleanup(patcher.stop)
+        self.connect_mock = patcher.start()
+        self.connect_mock.side_effect = self._new_connection
+
+    @staticmethod
+    def _new_connection(**kwargs):
+        conn = mock.MagicMock()
+        conn.closed = 0
+        return conn
+
+    def test_wrong_sizes_raise_config_error(self):
+        with self.assertRaises(LongitudeConfigError):
+            PostgresConnectionPool({}, min_size=3, max_size=2)
+
+    def test_min_size_connections_are_opened_at_start(self):
+        pool = PostgresConnectionPool({}, min_size=2, max_size=4)
+        self.assertEqual(2, self.connect_mock.call_count)
+        self.assertEqual(2, pool.size)
+
+    def test_connections_are_reused(self):
+        pool = PostgresConnectionPool({}, min_size=0, max_size=4)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(conn, pool.getconn())
+        self.assertEqual(1, self.connect_mock.call_count)
+
+    def test_unhealthy_connections_are_replaced_on_borrow(self):
+        pool = PostgresConnectionPool({}, min_size=1, max_size=1)
+        broken = pool._idle[0][0]
+        broken.cursor.return_value.__enter__.return_value.execute.side_effect = psycopg2.OperationalError
+
+        conn = pool.getconn()
+        self.assertIsNot(broken, conn)
+        broken.close.assert_called_once()
+        self.assertEqual(1, pool.size)
+
+    def test_checkout_times_out_when_pool_is_exhausted(self):
+        pool = PostgresConnectionPool({}, min_size=0, max_size=1, checkout_timeout_s=0.01)
+        pool.getconn()
+        with self.assertRaises(LongitudeQueryCannotBeExecutedException):
+            pool.getconn()
+
+    def test_waiting_thread_gets_returned_connection(self):
+        pool = PostgresConnectionPool({}, min_size=0, max_size=1, checkout_timeout_s=5)
+        conn = pool.getconn()
+        borrowed = []
+        waiter = threading.Thread(target=lambda: borrowed.append(pool.getconn()))
+        waiter.start()
+        pool.putconn(conn)
+        waiter.join(5)
+        self.assertEqual([conn], borrowed)
+
+    def test_idle_connections_above_min_size_are_reaped(self):
+        pool = PostgresConnectionPool({}, min_size=1, max_size=3, idle_timeout_s=0)
+        conns = [pool.getconn() for _ in range(3)]
+        for conn in conns:
+            pool.putconn(conn)
+        self.assertEqual(1, pool.size)
+
+    def test_broken_connections_are_discarded(self):
+        pool = PostgresConnectionPool({}, min_size=0, max_size=1)
+        with self.assertRaises(psycopg2.OperationalError):
+            with pool.connection() as conn:
+                raise psycopg2.OperationalError
+        conn.close.assert_called_once()
+        self.assertEqual(0, pool.size)
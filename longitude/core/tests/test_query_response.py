@@ -0,0 +1,51 @@
+import pickle
+from unittest import TestCase
+
+from longitude.core.common.query_response import LongitudeQueryResponse
+
+
+class TestLongitudeQueryResponse(TestCase):
+    fields = {'id': {'type': 'INTEGER'}, 'name': {'type': 'STRING'}}
+
+    def test_default_mode_keeps_rows_as_given(self):
+        rows = [{'id': 1, 'name': 'A'}]
+        response = LongitudeQueryResponse(rows=rows, fields=self.fields)
+        self.assertFalse(response.is_compact)
+        self.assertIs(rows, response.rows)
+        self.assertEqual([(1, 'A')], response.tuples)
+        self.assertEqual([1], response.column('id'))
+
+    def test_compact_mode_builds_rows_on_access(self):
+        response = LongitudeQueryResponse(tuples=[(1, 'A'), (2, 'B')], fields=self.fields)
+        self.assertTrue(response.is_compact)
+        self.assertEqual(2, len(response.rows))
+        self.assertEqual('B', response.rows[1]['name'])
+        self.assertEqual({'id': 1, 'name': 'A'}, dict(response.rows[0]))
+        self.assertEqual([{'id': 1, 'name': 'A'}, {'id': 2, 'name': 'B'}], response.rows)
+        self.assertEqual([{'id': 2, 'name': 'B'}], response.rows[1:])
+        self.assertEqual(['A', 'B'], response.column('name'))
+        self.assertEqual([1, 2], [row['id'] for row in response.rows])
+
+    def test_compact_rows_are_read_only(self):
+        response = LongitudeQueryResponse(tuples=[(1, 'A')], fields=self.fields)
+        with self.assertRaises(TypeError):
+            response.rows[0]['id'] = 2
+
+    def test_assigning_rows_leaves_compact_mode(self):
+        response = LongitudeQueryResponse(tuples=[(1, 'A')], fields=self.fields)
+        response.rows = [{'id': 2, 'name': 'B'}]
+        self.assertFalse(response.is_compact)
+        self.assertEqual([(2, 'B')], response.tuples)
+
+    def test_pickle_round_trip(self):
+        response = LongitudeQueryResponse(tuples=[(1, 'A')], fields=self.fields, meta={'a': 1})
+        restored = pickle.loads(pickle.dumps(response))
+        self.assertEqual([{'id': 1, 'name': 'A'}], restored.rows)
+        self.assertEqual({'a': 1}, restored.meta)
+
+    def test_responses_pickled_by_older_versions_can_be_loaded(self):
+        response = LongitudeQueryResponse()
+        response.__dict__ = {'rows': [{'id': 1}], 'fields': {'id': {}}, 'meta': {}, '_from_cache': False}
+        restored = pickle.loads(pickle.dumps(response))
+        self.assertEqual([{'id': 1}], restored.rows)
+        self.assertFalse(restored.is_compact)
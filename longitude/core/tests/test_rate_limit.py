@@ -0,0 +1,191 @@
+import time
+from unittest import TestCase, mock, skipIf
+
+from longitude.core.caches.redis import RedisCache
+from longitude.core.common.exceptions import LongitudeRateLimitExceeded
+from longitude.core.common.rate_limit import REDIS_TOKEN_BUCKET_SCRIPT, RateLimiter, RedisTokenBucket, TokenBucket
+from longitude.core.data_sources.carto import CartoDataSource
+from longitude.core.data_sources.carto_async import CartoAsyncDataSource
+from longitude.core.tests.utils import async_test
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+TESTED_MODULE_PATH = 'longitude.core.common.rate_limit.%s'
+
+
+class TestTokenBucket(TestCase):
+    @mock.patch(TESTED_MODULE_PATH % 'time.monotonic')
+    def test_requests_over_the_burst_wait_for_their_turn(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        bucket = TokenBucket(rate_per_s=2, burst=2)
+
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0.5, bucket.reserve())
+        self.assertEqual(1, bucket.reserve())
+
+        # Tokens come back with time, up to the burst
+        monotonic_mock.return_value = 110
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0.5, bucket.reserve())
+
+    @mock.patch(TESTED_MODULE_PATH % 'time.monotonic')
+    def test_requests_that_would_wait_too_long_are_shed(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        bucket = TokenBucket(rate_per_s=1, burst=1)
+
+        self.assertEqual(0, bucket.reserve(max_wait_s=1))
+        self.assertEqual(1, bucket.reserve(max_wait_s=1))
+        self.assertIsNone(bucket.reserve(max_wait_s=1))
+        # Shed requests reserve nothing
+        monotonic_mock.return_value = 101
+        self.assertEqual(1, bucket.reserve(max_wait_s=1))
+
+
+@mock.patch(TESTED_MODULE_PATH % 'time.sleep')
+class TestRateLimiter(TestCase):
+    def test_disabled_by_default(self, sleep_mock):
+        limiter = RateLimiter({}, 'user')
+        self.assertFalse(limiter)
+        limiter.acquire()
+        sleep_mock.assert_not_called()
+
+    def test_limiters_with_the_same_key_share_the_bucket(self, sleep_mock):
+        options = {'rate_limit_per_s': 0.001, 'rate_limit_burst': 1}
+        RateLimiter(options, 'shared_user').acquire()
+        RateLimiter(options, 'shared_user').acquire()
+        self.assertAlmostEqual(1000, sleep_mock.call_args[0][0], delta=1)
+        RateLimiter(options, 'other_user').acquire()
+        self.assertEqual(1, sleep_mock.call_count)
+
+    def test_shedding(self, sleep_mock):
+        limiter = RateLimiter({'rate_limit_per_s': 0.001, 'rate_limit_max_wait_s': 5}, 'shed_user')
+        limiter.acquire()
+        with self.assertRaises(LongitudeRateLimitExceeded):
+            limiter.acquire()
+        sleep_mock.assert_not_called()
+
+    def test_shared_bucket_in_redis(self, sleep_mock):
+        cache = RedisCache({'namespace': 'app'})
+        with mock.patch.object(cache, 'run_script', return_value=[b'1', b'0.25']) as run_script_mock:
+            limiter = RateLimiter({'rate_limit_per_s': 4, 'rate_limit_redis': cache}, 'redis_user')
+            limiter.acquire()
+        run_script_mock.assert_called_once_with(REDIS_TOKEN_BUCKET_SCRIPT, ['app:rate_limit:redis_user'], [4, 4, 1, -1])
+        sleep_mock.assert_called_once_with(0.25)
+
+        with mock.patch.object(cache, 'run_script', return_value=[b'0', b'30']):
+            with self.assertRaises(LongitudeRateLimitExceeded):
+                limiter.acquire()
+
+    def test_process_bucket_is_used_if_redis_fails(self, sleep_mock):
+        cache = RedisCache()
+        with mock.patch.object(cache, 'run_script', side_effect=ConnectionError):
+            limiter = RateLimiter({'rate_limit_per_s': 1, 'rate_limit_redis': cache}, 'redis_down_user')
+            limiter.acquire()
+            limiter.acquire()
+        self.assertAlmostEqual(1, sleep_mock.call_args[0][0], delta=0.1)
+
+    @mock.patch(TESTED_MODULE_PATH % 'asyncio.sleep')
+    @async_test
+    async def test_async_shared_bucket_in_redis(self, asyncio_sleep_mock, sleep_mock):
+        cache = RedisCache()
+        run_script_mock = mock.AsyncMock(return_value=[b'1', b'0.5'])
+        with mock.patch.object(cache, 'run_script_async', run_script_mock):
+            await RateLimiter({'rate_limit_per_s': 2, 'rate_limit_redis': cache}, 'async_user').acquire_async()
+        run_script_mock.assert_called_once()
+        asyncio_sleep_mock.assert_called_once_with(0.5)
+        sleep_mock.assert_not_called()
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestRedisTokenBucket(TestCase):
+    # Runs the Lua script in a fake server
+    def setUp(self):
+        self.cache = RedisCache({'namespace': 'app'})
+        self.cache._redis_client = fakeredis.FakeRedis()
+        self.client = self.cache._redis_client
+
+    def test_requests_over_the_burst_wait_for_their_turn(self):
+        bucket = RedisTokenBucket(self.cache, 'rate_limit:user', rate_per_s=0.5, burst=2)
+
+        self.assertEqual([0, 0], [bucket.reserve(), bucket.reserve()])
+        # Reservations go into debt: each one waits for the previous ones
+        self.assertAlmostEqual(2, bucket.reserve(), delta=0.01)
+        self.assertAlmostEqual(4, bucket.reserve(), delta=0.01)
+        self.assertAlmostEqual(-2, float(self.client.hget('app:rate_limit:user', 'tokens')), delta=0.01)
+
+        # Shed requests reserve nothing
+        self.assertIsNone(bucket.reserve(max_wait_s=5))
+        self.assertAlmostEqual(-2, float(self.client.hget('app:rate_limit:user', 'tokens')), delta=0.01)
+
+        # The bucket expires once it would be full again
+        self.assertTrue(5 < self.client.pttl('app:rate_limit:user') / 1000 <= 9)
+
+    def test_tokens_come_back_with_time_up_to_the_burst(self):
+        bucket = RedisTokenBucket(self.cache, 'rate_limit:user', rate_per_s=1, burst=3)
+        for _ in range(4):
+            bucket.reserve()
+        # As if the last reservation was made 2.5 seconds ago, and then 10 seconds ago
+        self.client.hset('app:rate_limit:user', 'ts', time.time() - 2.5)
+        self.assertAlmostEqual(0, bucket.reserve(), delta=0.01)
+        self.assertAlmostEqual(0.5, float(self.client.hget('app:rate_limit:user', 'tokens')), delta=0.05)
+
+        self.client.hset('app:rate_limit:user', 'ts', time.time() - 10)
+        self.assertEqual([0, 0, 0], [bucket.reserve() for _ in range(3)])
+        self.assertAlmostEqual(1, bucket.reserve(), delta=0.01)
+
+    @mock.patch(TESTED_MODULE_PATH % 'time.sleep')
+    def test_limiters_share_the_bucket_across_processes(self, sleep_mock):
+        options = {'rate_limit_per_s': 0.001, 'rate_limit_burst': 1, 'rate_limit_redis': self.cache}
+        RateLimiter(options, 'process_user').acquire()
+        # Another process has its own local bucket, but the same one in Redis
+        with mock.patch(TESTED_MODULE_PATH % '_local_buckets', {}):
+            RateLimiter(options, 'process_user').acquire()
+        self.assertAlmostEqual(1000, sleep_mock.call_args[0][0], delta=1)
+
+
+@mock.patch(TESTED_MODULE_PATH % 'time.sleep')
+class TestCartoRateLimit(TestCase):
+    def test_queries_wait_for_the_rate_limit(self, sleep_mock):
+        ds = CartoDataSource(user='carto_user', api_key='', options={'rate_limit_per_s': 0.001})
+        ds._sql_client = mock.MagicMock()
+        ds._sql_client.send.return_value = {'rows': [], 'fields': {}}
+        ds.query('some query')
+        sleep_mock.assert_not_called()
+        ds.query('some query')
+        sleep_mock.assert_called_once()
+        self.assertEqual(2, ds._sql_client.send.call_count)
+
+    def test_shed_queries_are_not_sent(self, sleep_mock):
+        ds = CartoDataSource(user='carto_shed_user', api_key='', options={
+            'rate_limit_per_s': 0.001, 'rate_limit_max_wait_s': 1
+        })
+        ds._sql_client = mock.MagicMock()
+        ds._sql_client.send.return_value = {'rows': [], 'fields': {}}
+        ds.query('some query')
+        with self.assertRaises(LongitudeRateLimitExceeded):
+            ds.query('some query')
+        self.assertEqual(1, ds._sql_client.send.call_count)
+
+    def test_key_option(self, sleep_mock):
+        ds = CartoDataSource(user='carto_user', api_key='', options={
+            'rate_limit_per_s': 1, 'rate_limit_key': 'api_key_1'
+        })
+        self.assertEqual('rate_limit:api_key_1', ds.rate_limiter.key)
+
+    @mock.patch(TESTED_MODULE_PATH % 'asyncio.sleep')
+    @async_test
+    async def test_async_queries_wait_for_the_rate_limit(self, asyncio_sleep_mock, sleep_mock):
+        ds = CartoAsyncDataSource(user='carto_async_user', api_key='', options={
+            'rate_limit_per_s': 0.001, 'session': mock.MagicMock()
+        })
+        ds._sql_client = mock.MagicMock()
+        ds._sql_client.send = mock.AsyncMock(return_value={'rows': [], 'fields': {}})
+        await ds.query('some query')
+        await ds.query('some query')
+        asyncio_sleep_mock.assert_called_once()
+        self.assertEqual(2, ds._sql_client.send.call_count)
@@ -0,0 +1,173 @@
+from unittest import TestCase, mock
+
+import requests
+from carto.auth import APIKeyAuthClient
+from carto.exceptions import CartoException, CartoRateLimitException
+from carto.sql import SQLClient
+from pyrestcli.exceptions import BadRequestException, ServerErrorException
+
+from longitude.core.common.exceptions import (LongitudeCircuitOpenException, LongitudeQueryCannotBeExecutedException,
+                                              LongitudeRateLimitExceeded, LongitudeRetriesExceeded,
+                                              LongitudeTransientError)
+from longitude.core.common.resilience import CircuitBreaker, Resilience, is_read_query
+from longitude.core.data_sources.carto_http import carto_error
+from longitude.core.tests.utils import FakeAsyncDataSource, FakeDataSource, async_test
+
+
+class TestReadQueries(TestCase):
+    def test_read_queries(self):
+        self.assertTrue(is_read_query('  select * from t'))
+        self.assertTrue(is_read_query('WITH a AS (SELECT 1) SELECT * FROM a'))
+        self.assertTrue(is_read_query('SELECT update_time FROM t'))
+        self.assertFalse(is_read_query('WITH a AS (DELETE FROM t RETURNING *) SELECT * FROM a'))
+        self.assertFalse(is_read_query('SELECT * INTO t2 FROM t'))
+        self.assertFalse(is_read_query('UPDATE t SET a = 1'))
+
+
+@mock.patch('longitude.core.common.resilience.time.sleep')
+class TestRetries(TestCase):
+    def test_transient_errors_are_retried(self, sleep_mock):
+        ds = FakeDataSource({'query_retries': 2, 'retry_base_delay_s': 1}, [LongitudeTransientError('down')] * 2)
+        self.assertIsNotNone(ds.query('SELECT 1'))
+        self.assertEqual(3, ds.executions)
+        delays = [c[0][0] for c in sleep_mock.call_args_list]
+        self.assertTrue(0 <= delays[0] <= 1 and 0 <= delays[1] <= 2)
+
+    def test_retries_exceeded(self, sleep_mock):
+        error = LongitudeTransientError('down')
+        ds = FakeDataSource({'query_retries': 2}, [error] * 3)
+        with self.assertRaises(LongitudeRetriesExceeded) as context:
+            ds.query('SELECT 1')
+        self.assertIs(error, context.exception.__cause__)
+        self.assertEqual(3, ds.executions)
+
+    def test_writes_and_other_errors_are_not_retried(self, sleep_mock):
+        ds = FakeDataSource({'query_retries': 2}, [LongitudeTransientError('down')])
+        with self.assertRaises(LongitudeTransientError):
+            ds.query('INSERT INTO t VALUES (1)')
+
+        ds = FakeDataSource({'query_retries': 2}, [ValueError('wrong')])
+        with self.assertRaises(ValueError):
+            ds.query('SELECT 1')
+
+        ds = FakeDataSource({'query_retries': 2}, [LongitudeTransientError('down')])
+        self.assertIsNotNone(ds.query('INSERT INTO t VALUES (1)', idempotent=True))
+        self.assertEqual(1, sleep_mock.call_count)
+
+    def test_retry_after_is_respected(self, sleep_mock):
+        ds = FakeDataSource({'query_retries': 1}, [LongitudeTransientError('slow down', retry_after_s=3)])
+        ds.query('SELECT 1')
+        sleep_mock.assert_called_once_with(3)
+
+        ds = FakeDataSource({'query_retries': 1, 'retry_max_delay_s': 10},
+                            [LongitudeTransientError('slow down', retry_after_s=60)])
+        with self.assertRaises(LongitudeRetriesExceeded):
+            ds.query('SELECT 1')
+        self.assertEqual(1, ds.executions)
+
+    @async_test
+    async def test_async_transient_errors_are_retried(self, sleep_mock):
+        ds = FakeAsyncDataSource({'query_retries': 1, 'retry_base_delay_s': 0}, [LongitudeTransientError('down')])
+        self.assertIsNotNone(await ds.query('SELECT 1'))
+        self.assertEqual(2, ds.executions)
+
+
+@mock.patch('longitude.core.common.resilience.time.monotonic')
+class TestCircuitBreaker(TestCase):
+    def test_circuit_opens_and_fails_fast(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        ds = FakeDataSource({'circuit_failure_threshold': 2, 'circuit_reset_timeout_s': 30},
+                            [LongitudeTransientError('down')] * 2)
+        for _ in range(2):
+            with self.assertRaises(LongitudeTransientError):
+                ds.query('SELECT 1')
+        with self.assertRaises(LongitudeCircuitOpenException):
+            ds.query('SELECT 1')
+        self.assertEqual(2, ds.executions)
+
+        # After the reset timeout, a trial query closes the circuit
+        monotonic_mock.return_value = 131
+        self.assertIsNotNone(ds.query('SELECT 1'))
+        self.assertEqual(CircuitBreaker.CLOSED, ds._resilience.circuit.state)
+
+    def test_failed_trial_opens_the_circuit_again(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        circuit = CircuitBreaker(1, reset_timeout_s=30)
+        circuit.on_failure()
+        monotonic_mock.return_value = 131
+        circuit.before_call()
+        self.assertEqual(CircuitBreaker.HALF_OPEN, circuit.state)
+        with self.assertRaises(LongitudeCircuitOpenException):
+            circuit.before_call()
+
+        circuit.on_failure()
+        self.assertEqual(CircuitBreaker.OPEN, circuit.state)
+        with self.assertRaises(LongitudeCircuitOpenException):
+            circuit.before_call()
+
+    def test_query_errors_do_not_open_the_circuit(self, monotonic_mock):
+        resilience = Resilience({'circuit_failure_threshold': 1})
+        with self.assertRaises(ValueError):
+            resilience.call(mock.MagicMock(side_effect=ValueError))
+        self.assertEqual(CircuitBreaker.CLOSED, resilience.circuit.state)
+
+    def test_shed_queries_do_not_close_the_circuit(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        resilience = Resilience({'circuit_failure_threshold': 1, 'circuit_reset_timeout_s': 30})
+        with self.assertRaises(LongitudeTransientError):
+            resilience.call(mock.MagicMock(side_effect=LongitudeTransientError('down')))
+
+        # The trial is shed before reaching the backend, so another one is needed
+        monotonic_mock.return_value = 131
+        with self.assertRaises(LongitudeRateLimitExceeded):
+            resilience.call(mock.MagicMock(side_effect=LongitudeRateLimitExceeded('shed')))
+        self.assertEqual(CircuitBreaker.OPEN, resilience.circuit.state)
+
+    @async_test
+    async def test_async_shed_queries_do_not_close_the_circuit(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        resilience = Resilience({'circuit_failure_threshold': 1, 'circuit_reset_timeout_s': 30})
+        resilience.circuit.on_failure()
+
+        monotonic_mock.return_value = 131
+        with self.assertRaises(LongitudeRateLimitExceeded):
+            await resilience.call_async(mock.AsyncMock(side_effect=LongitudeRateLimitExceeded('shed')))
+        self.assertEqual(CircuitBreaker.OPEN, resilience.circuit.state)
+
+
+class TestCartoErrors(TestCase):
+    @staticmethod
+    def sql_client_error(**request):
+        # Error raised by a real SQLClient.send when the HTTP session does as given
+        session = mock.MagicMock()
+        session.request.configure_mock(**request)
+        try:
+            SQLClient(APIKeyAuthClient('https://user.carto.com/', 'key', session=session)).send('SELECT 1')
+        except CartoException as e:
+            return e
+
+    def test_server_errors_and_rate_limits_are_transient(self):
+        error = carto_error(CartoException(ServerErrorException('oops', 503, {'Retry-After': '3'})))
+        self.assertIsInstance(error, LongitudeTransientError)
+        self.assertEqual(3, error.retry_after_s)
+
+        response = mock.MagicMock(text='limited', headers={
+            'Carto-Rate-Limit-Limit': '10', 'Carto-Rate-Limit-Remaining': '0', 'Retry-After': '2',
+            'Carto-Rate-Limit-Reset': '0'
+        })
+        self.assertEqual(2, carto_error(CartoRateLimitException(response)).retry_after_s)
+
+    def test_connection_errors_are_transient(self):
+        for request_error in (requests.ConnectionError('reset'), requests.Timeout('timed out')):
+            raised = self.sql_client_error(side_effect=request_error)
+            # The SQL client wraps the CartoException of the auth client
+            self.assertIsInstance(raised.args[0], CartoException)
+
+            error = carto_error(raised)
+            self.assertIsInstance(error, LongitudeTransientError)
+            self.assertIsNone(error.retry_after_s)
+
+    def test_query_errors_are_not_transient(self):
+        error = carto_error(CartoException(BadRequestException('syntax error', 400, {})))
+        self.assertIsInstance(error, LongitudeQueryCannotBeExecutedException)
+        self.assertNotIsInstance(error, LongitudeTransientError)
@@ -0,0 +1,148 @@
+import asyncio
+import threading
+from unittest import TestCase, mock
+
+from longitude.core.caches.ram import RamCache
+from longitude.core.common import single_flight as single_flight_module
+from longitude.core.common.single_flight import AsyncSingleFlight, SingleFlight
+from longitude.core.tests.utils import FakeAsyncDataSource, FakeDataSource, async_test
+
+
+class TestSingleFlight(TestCase):
+    def test_concurrent_calls_are_executed_once(self):
+        single_flight = SingleFlight()
+        calls = []
+        results = []
+        waiting = threading.Semaphore(0)
+
+        class CountingEvent(threading.Event):
+            def wait(self, timeout=None):
+                waiting.release()
+                return super().wait(timeout)
+
+        class CountedCall(single_flight_module._Call):
+            def __init__(self):
+                super().__init__()
+                self.event = CountingEvent()
+
+        def fn():
+            calls.append(1)
+            # The call stays in flight until every follower waits for it
+            for _ in range(9):
+                waiting.acquire(timeout=5)
+            return 'result'
+
+        with mock.patch.object(single_flight_module, '_Call', CountedCall):
+            threads = [threading.Thread(target=lambda: results.append(single_flight.do('key', fn)))
+                       for _ in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(['result'] * 10, results)
+        self.assertFalse(single_flight.in_flight('key'))
+
+    def test_errors_are_shared_and_not_remembered(self):
+        single_flight = SingleFlight()
+
+        def fail():
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            single_flight.do('key', fail)
+        self.assertEqual(1, single_flight.do('key', lambda: 1))
+
+    @async_test
+    async def test_cancelled_leader_does_not_cancel_followers(self):
+        single_flight = AsyncSingleFlight()
+        calls = []
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def fn():
+            calls.append(1)
+            started.set()
+            await release.wait()
+            return 'result'
+
+        leader = asyncio.ensure_future(single_flight.do('key', fn))
+        await started.wait()
+        followers = [asyncio.ensure_future(single_flight.do('key', fn)) for _ in range(3)]
+        # Lets the followers start awaiting the leader
+        await asyncio.sleep(0)
+
+        started.clear()
+        leader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+
+        # A follower runs the call again, and the rest wait for it
+        await asyncio.wait_for(started.wait(), 5)
+        release.set()
+
+        self.assertEqual(['result'] * 3, await asyncio.gather(*followers))
+        self.assertEqual(2, len(calls))
+        self.assertFalse(single_flight.in_flight('key'))
+
+    @async_test
+    async def test_concurrent_coroutines_are_executed_once(self):
+        single_flight = AsyncSingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        results = await asyncio.gather(*[single_flight.do('key', fn) for _ in range(10)])
+        self.assertEqual(1, len(calls))
+        self.assertEqual(['result'] * 10, results)
+        self.assertFalse(single_flight.in_flight('key'))
+
+    @async_test
+    async def test_async_errors_are_shared(self):
+        single_flight = AsyncSingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError
+
+        results = await asyncio.gather(*[single_flight.do('key', fail) for _ in range(3)], return_exceptions=True)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+
+class TestDataSourceCoalescing(TestCase):
+    def test_concurrent_misses_execute_query_once(self):
+        ds = FakeDataSource({'cache': RamCache()})
+        ds.delay_s = 0.05
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(ds.query('some query'))) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, ds.executions)
+        self.assertTrue(all(r.meta['execution'] == 1 for r in results))
+
+    def test_coalescing_can_be_disabled(self):
+        ds = FakeDataSource({'cache': RamCache(), 'coalesce_misses': False})
+        ds.delay_s = 0.05
+        threads = [threading.Thread(target=lambda: ds.query('some query')) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(5, ds.executions)
+
+    @async_test
+    async def test_concurrent_async_misses_execute_query_once(self):
+        ds = FakeAsyncDataSource({'cache': RamCache()})
+        ds.delay_s = 0.05
+        results = await asyncio.gather(*[ds.query('some query') for _ in range(10)])
+
+        self.assertEqual(1, ds.executions)
+        self.assertTrue(all(r.meta['execution'] == 1 for r in results))
+        self.assertTrue((await ds.query('some query')).from_cache)
@@ -1,10 +1,159 @@
 import asyncio
+import threading
+import time
+
+from longitude.core.common.instrumentation import QueryObserver
+from longitude.core.common.query_response import LongitudeQueryResponse
+from longitude.core.data_sources.base import DataSource
+from longitude.core.data_sources.base_async import AsyncDataSource
+
+# Upper bound for waits that only time out if the code under test is broken
+WAIT_S = 5
 
 
 def async_test(f):
     def wrapper(*args, **kwargs):
-        coro = asyncio.coroutine(f)
-        future = coro(*args, **kwargs)
+        future = f(*args, **kwargs)
         loop = asyncio.get_event_loop()
         loop.run_until_complete(future)
     return wrapper
+
+
+class FakeDataSource(DataSource):
+    """
+    Data source whose query templates tell what each execution does: 'fail' raises ValueError, 'meet' waits for the
+    other parties at the barrier and 'block' waits for the release event. Other queries answer at once, after delay_s.
+
+    The errors in failures are raised first, one per execution. Executions and concurrent executions are counted, and
+    responses have the number of the execution, the query template and the params in their meta.
+    """
+
+    def __init__(self, options={}, failures=()):
+        super().__init__(options)
+        self.failures = list(failures)
+        self.delay_s = 0
+        self.barrier = None
+        self.release = threading.Event()
+        self.on_query = None
+        self.executions = 0
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def execute_query(self, query_template, params, query_config, **opts):
+        with self._lock:
+            self.executions += 1
+            execution = self.executions
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            if self.on_query:
+                self.on_query()
+            if self.failures:
+                raise self.failures.pop(0)
+            if query_template == 'fail':
+                raise ValueError('failed')
+            if self.delay_s:
+                time.sleep(self.delay_s)
+            if query_template == 'meet':
+                self.barrier.wait()
+            if query_template == 'block':
+                self.release.wait(WAIT_S)
+            return {'execution': execution, 'query': query_template, 'params': params}
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def parse_response(self, response):
+        return LongitudeQueryResponse(meta=response)
+
+
+class NotThreadSafeDataSource(FakeDataSource):
+    """
+    Fails if it is used from several threads at the same time, like the data sources sharing their connection
+    """
+    thread_safe = False
+
+    def __init__(self, options={}, failures=()):
+        super().__init__(options, failures)
+        self.threads = set()
+        self._in_use = threading.Lock()
+
+    def execute_query(self, query_template, params, query_config, **opts):
+        if not self._in_use.acquire(blocking=False):
+            raise RuntimeError('Data source used concurrently')
+        try:
+            self.threads.add(threading.get_ident())
+            return super().execute_query(query_template, params, query_config, **opts)
+        finally:
+            self._in_use.release()
+
+
+class FakeAsyncDataSource(AsyncDataSource):
+    """
+    Asynchronous version of FakeDataSource. Queries that 'meet' wait until parties queries have arrived (see
+    .arrive()), 'block' waits for ever and 'yield' gives way to the other tasks a few times.
+    """
+
+    def __init__(self, options={}, failures=()):
+        super().__init__(options)
+        self.failures = list(failures)
+        self.delay_s = 0
+        self.parties = 0
+        self.arrived = 0
+        self.met = None
+        self.executions = 0
+        self.running = 0
+        self.max_running = 0
+
+    def arrive(self):
+        self.arrived += 1
+        if self.arrived >= self.parties:
+            self.met.set()
+
+    async def execute_query(self, query_template, params, query_config, **opts):
+        self.executions += 1
+        execution = self.executions
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if self.failures:
+                raise self.failures.pop(0)
+            if query_template == 'fail':
+                raise ValueError('failed')
+            if self.delay_s:
+                await asyncio.sleep(self.delay_s)
+            if query_template == 'meet':
+                self.arrive()
+                await asyncio.wait_for(self.met.wait(), WAIT_S)
+            if query_template == 'block':
+                await asyncio.Event().wait()
+            if query_template == 'yield':
+                for _ in range(3):
+                    await asyncio.sleep(0)
+            return {'execution': execution, 'query': query_template, 'params': params}
+        finally:
+            self.running -= 1
+
+    def parse_response(self, response):
+        return LongitudeQueryResponse(meta=response)
+
+
+class RecordingObserver(QueryObserver):
+    def __init__(self):
+        self.events = []
+
+    def on_cache_lookup(self, data_source, query_template, hit, duration_s):
+        self.events.append(('lookup', hit))
+
+    def on_execute(self, data_source, query_template, duration_s, error=None):
+        self.events.append(('execute', error))
+
+    def on_parse(self, data_source, query_template, duration_s, rows):
+        self.events.append(('parse', rows))
+
+    def on_cache_write(self, data_source, query_template, duration_s):
+        self.events.append(('write',))
+
+    def on_query(self, data_source, query_template, duration_s, cached, error=None):
+        self.events.append(('query', cached, error))
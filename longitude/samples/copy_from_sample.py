@@ -17,6 +17,19 @@ def copy_from_sample(ds):
     r = ds.query("SELECT name FROM " + to_table + " WHERE color=%(color)s", params={'color': 'green'})
     [print(row.get('name')) for row in r.rows]
 
+    # Chunked copy: big files are split and copied in parallel, with retries and progress
+    # ########################################
+    ds.query('TRUNCATE %s' % to_table, needs_commit=True)
+    metrics = ds.copy_from_csv(
+        csv_file_absolute_path=filepath,
+        to_table=to_table,
+        chunk_size_bytes=64,
+        workers=4,
+        retries=2,
+        progress_callback=lambda progress: print('%(chunks)d chunks, %(rows)d rows copied' % progress)
+    )
+    print('%(rows)d rows in %(elapsed_s).2f seconds (%(rows_per_s).0f rows/s)' % metrics)
+
 
 if __name__ == "__main__":
 
@@ -25,15 +25,12 @@ import sys
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
+from longitude.core.common.fan_out import fan_out  # noqa
 from longitude.core.data_sources.postgres.default import PostgresDataSource  # noqa
 from longitude.core.data_sources.carto import CartoDataSource  # noqa
 from longitude.samples.config import config  # noqa
 
-
-def run_query(ds):
-    data = ds.query('select * from country_population limit 30')
-
-    return data
+QUERY = 'select * from country_population limit 30'
 
 
 if __name__ == "__main__":
@@ -44,11 +41,11 @@ if __name__ == "__main__":
     )
     postgres = PostgresDataSource({'user': 'user', 'password': 'userpass'})
 
-    carto_data = run_query(carto)
+    # Both queries run at the same time: it takes as long as the slowest one
+    carto_data, pg_data = fan_out([(carto, QUERY), (postgres, QUERY)], timeout_s=30)
     print(carto_data.meta)
     print('------ \n')
 
-    pg_data = run_query(postgres)
     # Notice that there is no meta-data for postgres results
     print(pg_data.meta)
     [print(r) for r in pg_data.rows[:1]]
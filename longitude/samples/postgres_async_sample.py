@@ -0,0 +1,32 @@
+import os
+import sys
+import asyncio
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))  # noqa
+from longitude.core.caches.ram import RamCache  # noqa
+from longitude.core.data_sources.postgres.default_async import PostgresAsyncDataSource  # noqa
+from longitude.samples.config import config  # noqa
+
+
+async def main():
+    options = {
+        'user': config['pg_user'],
+        'password': config['pg_password'],
+        'pool_max_size': 20,
+        'cache': RamCache()
+    }
+
+    async with PostgresAsyncDataSource(options) as ds:
+        # Parallel execution of coroutines, each one over its own pooled connection:
+        results = await asyncio.gather(*[
+            ds.query('select id, name from country_population where id = %(id)s', {'id': i}) for i in range(1, 11)
+        ])
+        [print(r.rows) for r in results]
+
+        # Same query again. This time it comes from the cache.
+        cached = await ds.query('select id, name from country_population where id = %(id)s', {'id': 1})
+        print('From cache: {}'.format(cached.from_cache))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())